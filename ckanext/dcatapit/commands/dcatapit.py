@@ -3,15 +3,19 @@
 
 import logging
 import re
+import time
 import traceback
 import json
 import uuid
+import itertools
+import multiprocessing
 from datetime import datetime
 from pprint import pprint
 
 import ckan.plugins.toolkit as toolkit
 from ckan.lib.munge import munge_tag
 from ckan.logic.schema import tag_name_validator
+from ckan.logic.validators import tag_length_validator
 import ckanext.dcatapit.interfaces as interfaces
 from ckanext.dcatapit.model.license import (
     load_from_graph as load_licenses_from_graph,
@@ -19,12 +23,17 @@ from ckanext.dcatapit.model.license import (
 
 from ckanext.dcatapit.model.subtheme import (
     load_subthemes, clear_subthemes)
+from ckanext.dcatapit.model import (
+    vocabularies_changed, DCATAPITTagVocabulary, dcatapit_vocabulary_table)
+from ckan.model import meta
 from ckan.model.meta import Session
-from ckan.model import Package, Group, GroupExtra, Tag, PackageExtra, PackageTag, repo
+from ckan.model import Package, Group, GroupExtra, Tag, PackageExtra, PackageTag, Vocabulary, repo
+from ckan.model.tag import tag_table
+from ckan.model.types import make_uuid
 from ckan.logic import ValidationError
 from ckan.lib.navl.dictization_functions import Invalid
 
-from sqlalchemy import and_
+from sqlalchemy import and_, bindparam
 from ckan.lib.base import config
 from ckan.lib.cli import CkanCommand
 
@@ -78,12 +87,15 @@ class DCATAPITCommands(CkanCommand):
 
      To run data migration on database with data from older dcatapit installation, run
 
-     paster --plugin=ckanext-dcatapit vocabulary migrate_data [--limit=X] [--offset=Y] [--skip-orgs]
+     paster --plugin=ckanext-dcatapit vocabulary migrate_data [--limit=X] [--offset=Y] [--skip-orgs] [--workers=N] [--checkpoint=FILE]
 
      additional switches:
       -l/--limit - limit processing packages to given count of packages
       -o/--offset - start processing packages from given count offset
       -s/--skip-orgs - do not process organizations
+      -w/--workers - number of processes migrating packages in parallel, default: 1
+      -c/--checkpoint - file with ids of migrated packages. Packages listed there are skipped,
+                        so interrupted migration can be resumed by running it again with the same file
 
     '''
 
@@ -134,6 +146,10 @@ class DCATAPITCommands(CkanCommand):
                                help="Limit number of processed datasets during data migration")
         self.parser.add_option('-s', '--skip-orgs', default=False, action='store_true',
                                dest='skip_orgs', help="Skip organizations in data migration")
+        self.parser.add_option('-w', '--workers', default=1, type=int,
+                               help="Number of processes migrating datasets in parallel")
+        self.parser.add_option('-c', '--checkpoint', default=None,
+                               help="File with ids of already migrated datasets, used to resume data migration")
         
     def command(self):
         '''
@@ -154,7 +170,9 @@ class DCATAPITCommands(CkanCommand):
         elif cmd == 'migrate_data':
             self.migrate_data(offset=self.options.offset,
                               limit=self.options.limit,
-                              skip_orgs=self.options.skip_orgs)
+                              skip_orgs=self.options.skip_orgs,
+                              workers=self.options.workers,
+                              checkpoint=self.options.checkpoint)
         else:
             print self.usage
             log.error('ERROR: Command "%s" not recognized' % (cmd,))
@@ -167,8 +185,9 @@ class DCATAPITCommands(CkanCommand):
         setup_license_models()
         setup_subtheme_models()
 
-    def migrate_data(self, limit=None, offset=None, skip_orgs=False):
-        do_migrate_data(limit=limit, offset=offset, skip_orgs=skip_orgs)
+    def migrate_data(self, limit=None, offset=None, skip_orgs=False, workers=1, checkpoint=None):
+        do_migrate_data(limit=limit, offset=offset, skip_orgs=skip_orgs,
+                        workers=workers, checkpoint=checkpoint)
 
     def load(self):
         ##
@@ -200,6 +219,7 @@ class DCATAPITCommands(CkanCommand):
             clear_licenses()
             load_licenses_from_graph(filename, url)
             Session.commit()
+            vocabularies_changed()
             return
 
         if vocab_name == SUBTHEME_NAME:
@@ -213,6 +233,7 @@ class DCATAPITCommands(CkanCommand):
                 return
             load_subthemes(theme_map, eurovoc)
             Session.commit()
+            vocabularies_changed()
             return
             
         do_load(vocab_name, url=url, filename=filename, format=format)
@@ -277,7 +298,7 @@ def do_load_vocab(g, vocab_name):
                 'localized_text': label
             })
 
-        print 'Loaded concept: URI[{0}] ID[{1}] languages[{2}]'.format(about, identifier, len(langs))
+        log.debug('Loaded concept: URI[%s] ID[%s] languages[%s]', about, identifier, len(langs))
 
     return pref_labels, concepts
 
@@ -295,6 +316,7 @@ def do_load(vocab_name, url=None, filename=None, format=None):
     ##
     print "Loading graph for", vocab_name
 
+    start = time.time()
     g = Graph()
     for prefix, namespace in namespaces.iteritems():
         g.bind(prefix, namespace)
@@ -319,67 +341,118 @@ def do_load(vocab_name, url=None, filename=None, format=None):
         vocab_load = do_load_vocab
 
     pref_labels, concepts = vocab_load(g, vocab_name)
-    ##
-    # Creating the Tag Vocabulary using the given name
-    ##
-    log.info('Creating tag vocabulary {0} ...'.format(vocab_name))
-
-    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name'], 'ignore_auth': True}
-
-    print "Using site user '{0}'".format(user['name'])
-
-    try:
-        data = {'id': vocab_name}
-        toolkit.get_action('vocabulary_show')(context, data)
-
-        log.info("Vocabulary {0} already exists, skipping...".format(vocab_name))
-    except toolkit.ObjectNotFound:
-        log.info("Creating vocabulary '{0}'".format(vocab_name))
-
-        data = {'name': vocab_name}
-        vocab = toolkit.get_action('vocabulary_create')(context, data)
-
-        for tag in concepts:
-            log.info(u"Adding tag {0} to vocabulary '{1}'".format(tag, vocab_name))
-            print(u"Adding tag {0} to vocabulary '{1}'".format(tag, vocab_name))
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            toolkit.get_action('tag_create')(context, data)
+    print 'Parsed {0} concepts and {1} labels in {2:.1f}s'.format(len(concepts), len(pref_labels),
+                                                               time.time() - start)
 
     ##
-    # Persisting Multilag Tags or updating existing
+    # Storing tags and multilang labels in one transaction
     ##
-    log.info('Creating the corresponding multilang tags for vocab: {0} ...'.format(vocab_name))
-    print('Creating the corresponding multilang tags for vocab: {0} ...'.format(vocab_name))
-
+    start = time.time()
+    stats = bulk_load_vocabulary(vocab_name, concepts, pref_labels)
+
+    # let running instances reload labels
+    vocabularies_changed()
+    print ('Vocabulary successfully loaded ({0}) in {1:.1f}s: '
+           '{tags_created} tags created, {tags_skipped} skipped, '
+           '{labels_created} labels created, {labels_updated} updated, '
+           '{labels_unchanged} unchanged, {labels_skipped} skipped'
+           .format(vocab_name, time.time() - start, **stats))
+
+
+def bulk_load_vocabulary(vocab_name, concepts, pref_labels):
+    """
+    Stores tags of vocabulary and their localized labels.
+
+    Existing tags and labels are read once and compared in memory, and
+    only new tags and new or changed labels are written, with one
+    statement for each kind of change, in one transaction. Returns dict
+    with counts of changes.
+    """
+    stats = dict.fromkeys(('tags_created', 'tags_skipped', 'labels_created',
+                           'labels_updated', 'labels_unchanged', 'labels_skipped',), 0)
+    vocab = Vocabulary.get(vocab_name)
+    if vocab is None:
+        log.info("Creating vocabulary '{0}'".format(vocab_name))
+        vocab = Vocabulary(vocab_name)
+        Session.add(vocab)
+        Session.flush()
+
+    tags = dict(Session.query(Tag.name, Tag.id).filter(Tag.vocabulary_id == vocab.id))
+    new_tags = []
+    for name in concepts:
+        if name in tags:
+            continue
+        try:
+            tag_length_validator(name, {})
+            tag_name_validator(name, {})
+        except Invalid, err:
+            log.warning(u"Skipping tag {0} for vocabulary '{1}': {2}".format(name, vocab_name, err))
+            stats['tags_skipped'] += 1
+            continue
+        tags[name] = make_uuid()
+        new_tags.append({'id': tags[name], 'name': name, 'vocabulary_id': vocab.id})
+    stats['tags_created'] = len(new_tags)
+
+    # (tag id, lang) -> [label id, text]
+    existing = {}
+    q = Session.query(DCATAPITTagVocabulary.id, DCATAPITTagVocabulary.tag_id,
+                      DCATAPITTagVocabulary.lang, DCATAPITTagVocabulary.text)\
+               .join(Tag, Tag.id == DCATAPITTagVocabulary.tag_id)\
+               .filter(Tag.vocabulary_id == vocab.id)
+    for label_id, tag_id, lang, text in q:
+        existing[(tag_id, lang,)] = [label_id, text]
+
+    inserts = {}
+    updates = {}
+    unchanged = set()
     for pref_label in pref_labels:
-        if pref_label['lang'] in DCATAPITCommands._locales_ckan_mapping:
-            tag_name = pref_label['name']
-            tag_lang = DCATAPITCommands._locales_ckan_mapping[pref_label['lang']]
-            tag_localized_name = pref_label['localized_text']
-
-            try:
-               print(u"Storing tag: name[{}] lang[{}] label[{}]".format(tag_name, tag_lang, tag_localized_name))
-            except UnicodeEncodeError:
-               print(u"Storing tag: name[{}] lang[{}]".format(tag_name, tag_lang))
-
-            interfaces.persist_tag_multilang(tag_name, tag_lang, tag_localized_name, vocab_name)
-
-    print 'Vocabulary successfully loaded ({0})'.format(vocab_name)
-
-def do_migrate_data(limit=None, offset=None, skip_orgs=False):
+        if pref_label['lang'] not in DCATAPITCommands._locales_ckan_mapping:
+            continue
+        tag_name = pref_label['name']
+        tag_lang = DCATAPITCommands._locales_ckan_mapping[pref_label['lang']]
+        text = pref_label['localized_text']
+        tag_id = tags.get(tag_name)
+        if not tag_id or not text:
+            stats['labels_skipped'] += 1
+            continue
+        key = (tag_id, tag_lang,)
+        if key in existing:
+            label_id, current = existing[key]
+            if text != current:
+                updates[label_id] = {'_id': label_id, '_text': text}
+                existing[key][1] = text
+                unchanged.discard(key)
+            elif label_id not in updates:
+                unchanged.add(key)
+        else:
+            inserts[key] = {'tag_id': tag_id, 'tag_name': tag_name, 'lang': tag_lang, 'text': text}
+    stats['labels_created'] = len(inserts)
+    stats['labels_updated'] = len(updates)
+    stats['labels_unchanged'] = len(unchanged)
 
-    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name'],
-               'ignore_auth': True,
-               'use_cache': False}
-    pshow = toolkit.get_action('package_show')
-    pupdate = toolkit.get_action('package_update')
-    pcreate = toolkit.get_action('package_create')
+    try:
+        if new_tags:
+            Session.execute(tag_table.insert(), new_tags)
+        if inserts:
+            Session.execute(dcatapit_vocabulary_table.insert(), inserts.values())
+        if updates:
+            table = dcatapit_vocabulary_table
+            Session.execute(table.update()
+                                 .where(table.c.id == bindparam('_id'))
+                                 .values(text=bindparam('_text')),
+                            updates.values())
+        Session.commit()
+    except Exception:
+        Session.rollback()
+        raise
+    return stats
+
+
+def do_migrate_data(limit=None, offset=None, skip_orgs=False, workers=1, checkpoint=None):
+
+    context = get_migration_context()
     oshow = toolkit.get_action('organization_show')
     oupdate = toolkit.get_action('organization_patch')
-    pupdate_schema = DCATAPITPackagePlugin().update_package_schema()
-    pupdate_schema['tags']['name'].remove(tag_name_validator)
     org_list = get_organization_list()
     ocount = org_list.count()
     oidx = 0
@@ -408,7 +481,6 @@ def do_migrate_data(limit=None, offset=None, skip_orgs=False):
                 update_organization_identifier(odata['id'], tmp_identifier)
     else:
         print (u'Skipping organizations processing').encode('utf-8')
-    pcontext = context.copy()
     pkg_list = get_package_list()
     pcount = pkg_list.count()
     print (u'processing {} packages'.format(pcount)).encode('utf-8')
@@ -419,72 +491,170 @@ def do_migrate_data(limit=None, offset=None, skip_orgs=False):
     if limit:
         pkg_list = pkg_list.limit(limit)
 
-    # pidx may be not initialized for empty slice, need separate counter
-    # to count actually processed datasets
-    pidx_count = 0
-    for pidx, pname in enumerate(pkg_list):
-        pcontext['schema'] = pupdate_schema
-        pname = pname[0]
-        print (u'processing {}/{} package: {}'.format(pidx+1, pcount, pname)).encode('utf-8')
-        pdata = pshow(context, {'name_or_id': pname}) #, 'use_default_schema': True})
-
-
-        # remove empty conforms_to to avoid silly validation errors
-        if not pdata.get('conforms_to'):
-            pdata.pop('conforms_to', None)
-        # ... the same for alternate_identifier
-        if not pdata.get('alternate_identifier'):
-            pdata.pop('alternate_identifier', None)
-        
-        update_creator(pdata)
-        update_temporal_coverage(pdata)
-        update_theme(pdata)
-        update_identifier(pdata)
-        update_modified(pdata)
-        update_frequency(pdata)
-        update_conforms_to(pdata)
-        update_holder_info(pdata)
-        interfaces.populate_resource_license(pdata)
-        pdata['metadata_modified'] = None
-        print 'updating', pdata['id'], pdata['name']
-        try:
-           out = pupdate(pcontext, pdata)
-           pidx_count += 1
-        except ValidationError, err:
-            print (u'Cannot update due to validation error {}'.format(pdata['name'])).encode('utf-8')
-            print err
-            print (pdata)
-            print
-            errored.append((pidx, pdata['name'],err,))
-            continue
+    done = read_migration_checkpoint(checkpoint)
+    pkg_list = list(pkg_list)
+    pkgs = [(pid, pname,) for pid, pname in pkg_list if pid not in done]
+    if done:
+        print (u'skipping {} packages already migrated according to {}'
+               .format(len(pkg_list) - len(pkgs), checkpoint)).encode('utf-8')
+
+    chunks = [pkgs[idx:idx + MIGRATION_CHUNK_SIZE] for idx in range(0, len(pkgs), MIGRATION_CHUNK_SIZE)]
+    if workers > 1:
+        # each worker process opens own db connections
+        Session.remove()
+        meta.engine.dispose()
+        pool = multiprocessing.Pool(workers, initializer=init_migration_worker)
+        results = pool.imap_unordered(migrate_packages, chunks)
+    else:
+        init_migration_worker()
+        results = itertools.imap(migrate_packages, chunks)
 
-        except Exception, err:
-            print (u'Cannot update due to general error {}'.format(pdata['name'])).encode('utf-8')
-            print err
-            print (pdata)
-            print
-            errored.append((pidx, pdata['name'], err,))
-            continue
-        print '---' * 3
+    start = time.time()
+    pidx_count = 0
+    checkpoint_f = open(checkpoint, 'a') if checkpoint else None
+    try:
+        for chunk_results in results:
+            for pid, pname, err in chunk_results:
+                if err is None:
+                    pidx_count += 1
+                    if checkpoint_f:
+                        checkpoint_f.write('{}\n'.format(pid))
+                else:
+                    errored.append((pid, pname, err,))
+            if checkpoint_f:
+                checkpoint_f.flush()
+            processed = pidx_count + len(errored)
+            print (u'processed {}/{} packages'.format(processed, len(pkgs))).encode('utf-8')
+        if workers > 1:
+            pool.close()
+            pool.join()
+    finally:
+        if checkpoint_f:
+            checkpoint_f.close()
+        if workers > 1:
+            # no-op if workers finished already
+            pool.terminate()
+    elapsed = time.time() - start
 
     if not skip_orgs:
         print (u'processed {} out of {} organizations'.format(oidx, ocount)).encode('utf-8')
     print (u'processed {} out of {} packages in total'.format(pidx_count, pcount)).encode('utf-8')
+    print (u'{} packages migrated in {:.1f}s with {} workers, {:.2f} packages/s, {} errors'
+           .format(pidx_count + len(errored), elapsed, max(workers, 1),
+                   (pidx_count + len(errored)) / elapsed if elapsed else 0, len(errored))).encode('utf-8')
     if errored:
         print (u'Following {} datasets failed:'.format(len(errored))).encode('utf-8')
-        for position, ptitile, err in errored:
+        for pid, ptitile, err_summary in errored:
+            print (u' {} ({}): {}'.format(ptitile, pid, err_summary)).encode('utf-8')
+
+
+# number of packages sent to migration worker at once
+MIGRATION_CHUNK_SIZE = 20
+
+# migration context and schema of current process, see init_migration_worker()
+_migration = {}
+
+
+def get_migration_context():
+    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'user': user['name'],
+            'ignore_auth': True,
+            'use_cache': False}
+
+
+def init_migration_worker():
+    Session.remove()
+    pupdate_schema = DCATAPITPackagePlugin().update_package_schema()
+    pupdate_schema['tags']['name'].remove(tag_name_validator)
+    _migration['context'] = get_migration_context()
+    _migration['schema'] = pupdate_schema
+
+
+def read_migration_checkpoint(checkpoint):
+    """
+    Returns set of ids of packages already migrated, stored in checkpoint
+    file, one id per line.
+    """
+    if not checkpoint:
+        return set()
+    try:
+        with open(checkpoint) as f:
+            return set(line.strip() for line in f if line.strip())
+    except IOError:
+        return set()
+
+
+def migrate_packages(pkgs):
+    """
+    Migrates list of (package id, name) in current process, returns list
+    of (package id, name, error) with None error for migrated packages.
+    """
+    out = []
+    for pid, pname in pkgs:
+        try:
+            migrate_package(pname)
+            out.append((pid, pname, None,))
+        except Exception, err:
+            Session.rollback()
             err_summary = getattr(err, 'error', None) or err
 
             # this is a hack on dumb override in __str__() in some exception subclasses
             # stringified exception raises itself otherwise.
             try:
-                print (u' {} at position {}: {}{}'.format(ptitile, position, err.__class__, err_summary)).format('utf-8')
+                err_summary = u'{}{}'.format(err.__class__, err_summary)
             except Exception, perr:
-                err_summary = perr
-                print (u' {} at position {}: {}{}'.format(ptitile, position, err.__class__, err_summary)).format('utf-8')
+                err_summary = u'{}{}'.format(err.__class__, perr)
+            out.append((pid, pname, err_summary,))
+    return out
+
+
+def migrate_package(pname):
+    context = _migration['context']
+    pcontext = context.copy()
+    pcontext['schema'] = _migration['schema']
+    pshow = toolkit.get_action('package_show')
+    pupdate = toolkit.get_action('package_update')
+
+    print (u'processing package: {}'.format(pname)).encode('utf-8')
+    pdata = pshow(context.copy(), {'name_or_id': pname}) #, 'use_default_schema': True})
+
+
+    # remove empty conforms_to to avoid silly validation errors
+    if not pdata.get('conforms_to'):
+        pdata.pop('conforms_to', None)
+    # ... the same for alternate_identifier
+    if not pdata.get('alternate_identifier'):
+        pdata.pop('alternate_identifier', None)
+    
+    update_creator(pdata)
+    update_temporal_coverage(pdata)
+    update_theme(pdata)
+    update_identifier(pdata)
+    update_modified(pdata)
+    update_frequency(pdata)
+    update_conforms_to(pdata)
+    update_holder_info(pdata)
+    interfaces.populate_resource_license(pdata)
+    pdata['metadata_modified'] = None
+    print 'updating', pdata['id'], pdata['name']
+    try:
+        return pupdate(pcontext, pdata)
+    except ValidationError, err:
+        print (u'Cannot update due to validation error {}'.format(pdata['name'])).encode('utf-8')
+        print err
+        print (pdata)
+        print
+        raise
+    except Exception, err:
+        print (u'Cannot update due to general error {}'.format(pdata['name'])).encode('utf-8')
+        print err
+        print (pdata)
+        print
+        raise
+
 
 def get_package_list():
-    return Session.query(Package.name).filter(Package.state=='active',
+    return Session.query(Package.id, Package.name).filter(Package.state=='active',
                                               Package.type=='dataset')\
                                       .order_by(Package.title)
 
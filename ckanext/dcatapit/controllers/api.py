@@ -1,18 +1,27 @@
 
 import logging
+import hashlib
 
 import urllib
-import ckan.model as model
 import ckan.logic as logic
 
 from ckan.controllers.api import ApiController
-from ckan.common import c, request
+from ckan.common import request, response, _
+
+from ckanext.dcatapit.helpers import get_dcatapit_subthemes
+from ckanext.dcatapit.interfaces import get_language
+from ckanext.dcatapit.validators import DEFAULT_LANG
+from ckanext.dcatapit.model import get_vocabularies_version, DCATAPITTagVocabulary
+from ckanext.dcatapit.model.dcatapit_model import LABELS_CHECK_INTERVAL
 
 log = logging.getLogger(__file__)
 
 # shortcuts
 get_action = logic.get_action
 
+# max number of tags returned by vocabulary autocomplete
+AUTOCOMPLETE_MAX_LIMIT = 100
+
 class DCATAPITApiController(ApiController):
 
     def vocabulary_autocomplete(self):
@@ -20,23 +29,46 @@ class DCATAPITApiController(ApiController):
         q = unicode(urllib.unquote(q), 'utf-8')
 
         vocab = request.params.get('vocabulary_id', None)
-
-        vocab = str(vocab)
+        if not vocab:
+            return self._finish_bad_request(_('Missing vocabulary_id parameter'))
 
         log.debug('Looking for Vocab %r', vocab)
 
-        limit = request.params.get('limit', 10)
+        try:
+            limit = int(request.params.get('limit', 10))
+        except ValueError:
+            limit = 10
+        limit = min(limit, AUTOCOMPLETE_MAX_LIMIT)
+        lang = get_language() or DEFAULT_LANG
 
-        tag_names = []
-        if q:
-            context = {'model': model, 'session': model.Session, 'user': c.user, 'auth_user_obj': c.userobj}
-            data_dict = {'q': q, 'limit': limit, 'vocabulary_id': vocab}
-            tag_names = get_action('tag_autocomplete')(context, data_dict)
+        # tags are matched with in-memory index of names and labels
+        tag_names = DCATAPITTagVocabulary.autocomplete(vocab, q, limit) if q else []
 
         resultSet = {
             'ResultSet': {
-                'Result': [{'Name': tag} for tag in tag_names]
+                'Result': [{'Name': tag,
+                            'Label': DCATAPITTagVocabulary.get_label(tag, lang) or tag}
+                           for tag in tag_names]
             }
         }
 
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(LABELS_CHECK_INTERVAL)
         return super(DCATAPITApiController, self)._finish_ok(resultSet)
+
+    def subthemes(self):
+        '''
+        Returns subthemes tree for the dataset form, as in
+        `h.get_dcatapit_subthemes()`.
+
+        Response has ETag, which changes with loaded vocabularies, so
+        clients can revalidate cached tree.
+        '''
+        lang = request.params.get('lang') or get_language() or DEFAULT_LANG
+        etag = hashlib.sha1(u'{}:{}'.format(get_vocabularies_version(), lang)
+                            .encode('utf-8')).hexdigest()
+        response.headers['ETag'] = '"{}"'.format(etag)
+        response.headers['Cache-Control'] = 'public, no-cache'
+        if etag in request.if_none_match:
+            response.status_int = 304
+            return ''
+        return super(DCATAPITApiController, self)._finish_ok(get_dcatapit_subthemes(lang))
@@ -0,0 +1,78 @@
+import logging
+
+import pylons
+from paste.registry import Registry
+
+import ckan.model as model
+import ckan.logic as logic
+
+from ckan.lib.base import BaseController, c, request, response, abort
+from ckan.common import _
+
+from ckanext.dcatapit.dcat.logic import iter_catalog_datasets
+from ckanext.dcatapit.dcat.processors import DCATAPITRDFSerializer
+
+log = logging.getLogger(__file__)
+
+CONTENT_TYPES = {
+    'nt': 'application/n-triples; charset=utf-8',
+    'ttl': 'text/turtle; charset=utf-8',
+}
+
+# request parameters passed to catalog search
+SEARCH_PARAMS = ('q', 'fq', 'modified_since', 'page',)
+
+
+class DCATAPITCatalogController(BaseController):
+
+    def stream(self, _format):
+        '''
+        Returns the whole catalog (or its datasets from `page` on) in
+        N-Triples or Turtle, serialized one dataset at a time while the
+        response is sent.
+
+        Datasets are searched one page at a time, when the previous page
+        was serialized, so memory used doesn't grow with the catalog.
+        '''
+        context = {'model': model,
+                   'session': model.Session,
+                   'user': c.user}
+        data_dict = dict((k, request.params[k]) for k in SEARCH_PARAMS
+                         if request.params.get(k))
+        try:
+            logic.check_access('dcat_catalog_show', context, data_dict)
+            dataset_dicts = iter_catalog_datasets(context, data_dict)
+        except logic.NotAuthorized:
+            abort(403, _('Not authorized to see this page'))
+        except logic.ValidationError, e:
+            abort(409, str(e))
+
+        serializer = DCATAPITRDFSerializer()
+        response.headers['Content-Type'] = CONTENT_TYPES[_format]
+        return _streamed(serializer.serialize_catalog_iter({}, dataset_dicts,
+                                                           _format=_format))
+
+
+def _streamed(chunks):
+    '''
+    Returns generator of `chunks` for the response body.
+
+    Pylons globals are released and the db session is removed when the
+    controller returns, before the body is sent. The translator used to
+    get current language is registered again while chunks are serialized,
+    and the session opened for next pages is removed at the end.
+    '''
+    translator = pylons.translator._current_obj()
+
+    def body():
+        registry = Registry()
+        registry.prepare()
+        registry.register(pylons.translator, translator)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            registry.cleanup()
+            model.Session.remove()
+
+    return body()
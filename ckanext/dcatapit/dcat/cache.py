@@ -0,0 +1,115 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from ckan.lib.base import config
+from ckanext.dcatapit.model import get_vocabularies_version
+from ckanext.dcatapit.interfaces import get_language
+
+
+log = logging.getLogger(__name__)
+
+# directory for cached dataset RDF fragments, cache is disabled if not set
+DCATAPIT_RDF_CACHE_DIR = 'ckanext.dcatapit.rdf_cache.dir'
+RDF_CACHE_DIR = config.get(DCATAPIT_RDF_CACHE_DIR) or None
+
+DEFAULT_LANG = config.get('ckan.locale_default', 'en')
+
+
+def is_enabled():
+    return bool(RDF_CACHE_DIR)
+
+
+def _dataset_dir(dataset_id):
+    return os.path.join(RDF_CACHE_DIR, dataset_id)
+
+
+def _fragment_path(dataset_id, lang, variant):
+    if variant:
+        return os.path.join(_dataset_dir(dataset_id), '{}-{}.nt'.format(lang, variant))
+    return os.path.join(_dataset_dir(dataset_id), '{}.nt'.format(lang))
+
+
+def serializer_variant(profiles, compatibility_mode=False):
+    '''
+    Returns name of serializer setup, as fragments depend on profiles used
+    (in their order) and on compatibility mode too.
+
+    :param profiles: list of profile classes
+    '''
+    names = [u'{}.{}'.format(p.__module__, p.__name__) for p in profiles]
+    names.append(unicode(bool(compatibility_mode)))
+    return hashlib.sha1(u'|'.join(names).encode('utf-8')).hexdigest()[:12]
+
+
+def fragment_key(dataset_dict):
+    '''
+    Returns key of dataset's serialized fragment.
+
+    Serialized triples depend on dataset (`metadata_modified`), its
+    organization (`revision_id`) and loaded vocabularies and licenses.
+    They depend on language of current request and serializer's profiles
+    too, so fragments are stored in one file per language and
+    serializer variant, see `serializer_variant()`.
+    '''
+    org = dataset_dict.get('organization') or {}
+    parts = (dataset_dict['id'],
+             dataset_dict.get('metadata_modified'),
+             org.get('revision_id'),
+             get_vocabularies_version(),)
+    return hashlib.sha1(u'|'.join(unicode(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def _get_lang():
+    return (get_language() or DEFAULT_LANG).split('_')[0]
+
+
+def get_fragment(dataset_dict, variant=None):
+    '''
+    Returns tuple of (dataset uri, N-Triples data) for dataset from cache,
+    or None if there's no fragment for current dataset state.
+    '''
+    path = _fragment_path(dataset_dict['id'], _get_lang(), variant)
+    try:
+        with open(path, 'rb') as f:
+            header = f.readline().split()
+            if len(header) != 3 or header[1] != fragment_key(dataset_dict):
+                return
+            return header[2].decode('utf-8'), f.read()
+    except (IOError, OSError,):
+        return
+
+
+def store_fragment(dataset_dict, dataset_ref, data, variant=None):
+    '''
+    Stores N-Triples serialization of dataset.
+
+    File is written to temporary location first and then moved, so
+    concurrent readers never see partial fragment.
+    '''
+    dataset_dir = _dataset_dir(dataset_dict['id'])
+    header = '# {} {}\n'.format(fragment_key(dataset_dict), unicode(dataset_ref).encode('utf-8'))
+    try:
+        if not os.path.isdir(dataset_dir):
+            os.makedirs(dataset_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=dataset_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(data)
+        os.rename(tmp_path, _fragment_path(dataset_dict['id'], _get_lang(), variant))
+    except (IOError, OSError,), err:
+        log.warning("Cannot store RDF fragment for %s: %s", dataset_dict['id'], err)
+
+
+def invalidate_fragments(dataset_id):
+    '''
+    Removes cached fragments of dataset, in all languages.
+    '''
+    if not is_enabled() or not dataset_id:
+        return
+    try:
+        shutil.rmtree(_dataset_dir(dataset_id))
+    except (IOError, OSError,):
+        pass
@@ -1,19 +1,177 @@
+import os
 import logging
 import json
+import hashlib
+import tempfile
+import traceback
+
+import rdflib
+import requests
 
 import ckan.plugins as p
+from ckan.lib.base import config
 from ckan.lib.munge import munge_name
+from ckan.model import Session, Package
 
 from ckanext.dcat.interfaces import IDCATRDFHarvester
+from ckanext.dcat.harvesters.rdf import DCATRDFHarvester
+from ckanext.dcat.processors import RDFParserException
 from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
 from ckanext.dcatapit.dcat.profiles import (LOCALISED_DICT_NAME_BASE,
                                             LOCALISED_DICT_NAME_RESOURCES)
+from ckanext.dcatapit.dcat.processors import StreamingRDFParser
 import ckanext.dcatapit.interfaces as interfaces
+from ckanext.dcatapit.dcat.cache import invalidate_fragments
 from ckanext.dcatapit.mapping import map_nonconformant_groups
 from ckanext.dcatapit import helpers as dcatapit_helpers
 
 log = logging.getLogger(__name__)
 
+# skip update of harvested datasets, which didn't change since previous import
+DCATAPIT_HARVEST_SKIP_UNCHANGED = 'ckanext.dcatapit.harvest.skip_unchanged'
+HARVEST_SKIP_UNCHANGED = p.toolkit.asbool(config.get(DCATAPIT_HARVEST_SKIP_UNCHANGED, True))
+
+# number of harvested datasets reindexed in Solr with one commit
+DCATAPIT_HARVEST_INDEX_BATCH_SIZE = 'ckanext.dcatapit.harvest.index_batch_size'
+HARVEST_INDEX_BATCH_SIZE = int(config.get(DCATAPIT_HARVEST_INDEX_BATCH_SIZE, 100))
+
+# download of harvested catalogs by DCATAPITRDFHarvester, max size can
+# be changed with ckanext-dcat's ckanext.dcat.max_file_size (in MB)
+HARVEST_DOWNLOAD_CHUNK_SIZE = 1024 * 512
+HARVEST_MAX_FILE_SIZE_MB = 50
+
+# harvest object states of objects not imported yet
+PENDING_OBJECT_STATES = ('WAITING', 'FETCH',)
+
+# harvest object extra marking object, whose dataset wasn't reindexed yet
+INDEX_PENDING_KEY = 'dcatapit_index_pending'
+
+# harvest source type of DCATAPITRDFHarvester
+DCATAPIT_RDF_HARVESTER = 'dcatapit_rdf'
+
+# harvest object extra with hash of harvested content
+CONTENT_HASH_KEY = 'dcatapit_content_hash'
+
+# fields of harvested content, which are not taken from the source
+CONTENT_HASH_SKIP_FIELDS = ('id', 'name',)
+
+
+def _canonical(value):
+    '''
+    Returns value with lists sorted, so it doesn't depend on order of
+    triples in the source graph.
+    '''
+    if isinstance(value, dict):
+        return dict((k, _canonical(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple,)):
+        items = [_canonical(v) for v in value]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True))
+    return value
+
+
+def content_hash(harvest_object):
+    '''
+    Returns stable hash of harvested dataset.
+
+    Content of harvest object is the dataset parsed from its subgraph
+    (the dataset node with its distributions, agents, licenses, temporal
+    and spatial nodes), so it changes only if the subgraph changes.
+    Harvest source config is included, because it changes import too.
+    '''
+    try:
+        content = json.loads(harvest_object.content)
+    except (TypeError, ValueError,):
+        return
+    for field in CONTENT_HASH_SKIP_FIELDS:
+        content.pop(field, None)
+    source_config = harvest_object.source.config if harvest_object.source else None
+    data = json.dumps([_canonical(content), source_config], sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+def _is_job_finished(harvest_object):
+    '''
+    Returns True if there are no more objects to import in the job of
+    `harvest_object`, other than `harvest_object` itself.
+    '''
+    pending = Session.query(HarvestObject.id)\
+                     .filter(HarvestObject.harvest_job_id == harvest_object.harvest_job_id,
+                             HarvestObject.id != harvest_object.id,
+                             HarvestObject.state.in_(PENDING_OBJECT_STATES))\
+                     .first()
+    return not pending
+
+
+def _get_index_pending(harvest_source_id, limit):
+    '''
+    Returns (extra id, package id, owner org) of at most `limit` datasets
+    of the harvest source marked with `INDEX_PENDING_KEY` extra.
+    '''
+    source_objects = Session.query(HarvestObject.id)\
+                            .filter(HarvestObject.harvest_source_id == harvest_source_id)\
+                            .subquery()
+    return Session.query(HarvestObjectExtra.id, Package.id, Package.owner_org)\
+                  .join(HarvestObject, HarvestObjectExtra.harvest_object_id == HarvestObject.id)\
+                  .outerjoin(Package, Package.id == HarvestObject.package_id)\
+                  .filter(HarvestObjectExtra.harvest_object_id.in_(source_objects),
+                          HarvestObjectExtra.key == INDEX_PENDING_KEY)\
+                  .limit(limit)\
+                  .all()
+
+
+# harvest job id -> number of objects imported by this process since
+# datasets pending reindex were looked up
+_imported_since_reindex = {}
+
+
+def reindex_pending_datasets(harvest_object):
+    '''
+    Reindexes in Solr datasets harvested from the source of
+    `harvest_object`, which are marked with `INDEX_PENDING_KEY` extra.
+
+    Marks are looked up once every `HARVEST_INDEX_BATCH_SIZE` objects
+    imported by the process, when a batch of them is reindexed, and when
+    the job has no more objects to import, when all of them are.
+
+    Marks are stored in the db, so datasets are reindexed by any process
+    importing the source, even if the process which harvested them failed
+    or was killed. Errors are logged, and marks are left for next call.
+    '''
+    job_id = harvest_object.harvest_job_id
+    try:
+        imported = _imported_since_reindex.get(job_id, 0) + 1
+        finished = _is_job_finished(harvest_object)
+        if imported < HARVEST_INDEX_BATCH_SIZE and not finished:
+            _imported_since_reindex[job_id] = imported
+            return
+        _imported_since_reindex.pop(job_id, None)
+
+        while True:
+            pending = _get_index_pending(harvest_object.harvest_source_id,
+                                         HARVEST_INDEX_BATCH_SIZE)
+            if not pending:
+                break
+
+            index_buffer = interfaces.SolrIndexBuffer(HARVEST_INDEX_BATCH_SIZE)
+            for extra_id, package_id, owner_org in pending:
+                # dataset may have been deleted meanwhile
+                if package_id:
+                    index_buffer.add({'id': package_id, 'owner_org': owner_org})
+            index_buffer.flush()
+
+            Session.query(HarvestObjectExtra)\
+                   .filter(HarvestObjectExtra.id.in_([extra_id for extra_id, _, _ in pending]))\
+                   .delete(synchronize_session=False)
+            # changes were flushed by the query above
+            if harvest_object in Session:
+                Session.expire(harvest_object, ['extras'])
+            if not finished or len(pending) < HARVEST_INDEX_BATCH_SIZE:
+                break
+    except Exception, err:
+        log.error("Cannot update Solr index for harvest source %s: %s",
+                  harvest_object.harvest_source_id, err, exc_info=err)
+
 
 class DCATAPITHarvesterPlugin(p.SingletonPlugin):
 
@@ -29,17 +187,58 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
         return content, []
 
     def before_update(self, harvest_object, dataset_dict, temp_dict):
+        chash = self._store_content_hash(harvest_object)
+        if HARVEST_SKIP_UNCHANGED and self._is_unchanged(harvest_object, dataset_dict['id'], chash):
+            log.info('Dataset %s not changed since previous import, skipping update',
+                     dataset_dict['name'])
+            harvest_object.package_id = dataset_dict['id']
+            harvest_object.add()
+            # emptied dict tells dcat harvester to ignore dataset
+            dataset_dict.clear()
+            self._reindex_pending(harvest_object)
+            return
         self._before(dataset_dict, temp_dict, harvest_object)
 
     def after_update(self, harvest_object, dataset_dict, temp_dict):
-        return self._after(dataset_dict, temp_dict)
+        return self._after(harvest_object, dataset_dict, temp_dict)
 
     def before_create(self, harvest_object, dataset_dict, temp_dict):
+        self._store_content_hash(harvest_object)
         self._before_create(harvest_object, dataset_dict)
         self._before(dataset_dict, temp_dict, harvest_object)
 
     def after_create(self, harvest_object, dataset_dict, temp_dict):
-        return self._after(dataset_dict, temp_dict)
+        return self._after(harvest_object, dataset_dict, temp_dict)
+
+    def _store_content_hash(self, harvest_object):
+        chash = content_hash(harvest_object)
+        if chash:
+            harvest_object.extras.append(HarvestObjectExtra(key=CONTENT_HASH_KEY,
+                                                            value=chash))
+        return chash
+
+    def _is_unchanged(self, harvest_object, package_id, chash):
+        '''
+        Checks if content has the same hash as in the last successful
+        import of the dataset, and dataset wasn't modified since.
+        '''
+        if not chash:
+            return False
+        previous = Session.query(HarvestObjectExtra.value, HarvestObject.import_finished)\
+                          .join(HarvestObject, HarvestObjectExtra.harvest_object_id == HarvestObject.id)\
+                          .filter(HarvestObject.guid == harvest_object.guid,
+                                  HarvestObject.id != harvest_object.id,
+                                  HarvestObject.package_id == package_id,
+                                  HarvestObject.state == 'COMPLETE',
+                                  HarvestObject.import_finished != None,
+                                  HarvestObjectExtra.key == CONTENT_HASH_KEY)\
+                          .order_by(HarvestObject.import_finished.desc())\
+                          .first()
+        if not previous or previous.value != chash:
+            return False
+        modified = Session.query(Package.metadata_modified)\
+                          .filter(Package.id == package_id).scalar()
+        return bool(modified) and modified <= previous.import_finished
 
     def _before_create(self, harvest_object, dataset_dict):
         title = dataset_dict['title']
@@ -95,7 +294,16 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
                 dataset_dict.pop('holder_name', None)
                 dataset_dict.pop('holder_identifier', None)
 
-    def _after(self, dataset_dict, temp_dict):
+    def _after(self, harvest_object, dataset_dict, temp_dict):
+        try:
+            return self._save_multilang(harvest_object, dataset_dict, temp_dict)
+        finally:
+            # localized fields are saved after the dataset, without changing
+            # its metadata_modified, so fragments cached meanwhile are stale
+            invalidate_fragments(dataset_dict.get('id'))
+            self._reindex_pending(harvest_object)
+
+    def _save_multilang(self, harvest_object, dataset_dict, temp_dict):
         dcatapit_dict = temp_dict.get('dcatapit')
         if not dcatapit_dict:
             return None
@@ -116,20 +324,21 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
         ##
         # Managing Solr indexes for harvested package dict
         ##
-        interfaces.update_solr_package_indexes(dataset_dict)
+        harvest_object.extras.append(HarvestObjectExtra(key=INDEX_PENDING_KEY,
+                                                        value='true'))
 
         return None
 
+    def _reindex_pending(self, harvest_object):
+        # DCATAPITRDFHarvester reindexes after import of each object,
+        # including failed ones
+        if harvest_object.source and harvest_object.source.type == DCATAPIT_RDF_HARVESTER:
+            return
+        reindex_pending_datasets(harvest_object)
+
     def _save_package_multilang(self, pkg_id, base_dict):
         try:
-            for field, lang_dict in base_dict.iteritems():
-                for lang, text in lang_dict.iteritems():
-                    interfaces.upsert_package_multilang(pkg_id,
-                                                        field,
-                                                        'package',
-                                                        lang,
-                                                        text)
-
+            interfaces.upsert_package_multilang_bulk(pkg_id, base_dict, 'package')
         except Exception, e:
             return str(e)
 
@@ -139,17 +348,14 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
         try:
             uri_id_mapping = self._get_resource_uri_id_mapping(pkg_id)
 
+            by_id = {}
             for res_uri, res_dict in resources_dict.iteritems():
                 res_id = uri_id_mapping.get(res_uri, None)
                 if not res_id:
                     log.warn("Could not find resource id for URI %s", res_uri)
                     continue
-                for field, lang_dict in res_dict.iteritems():
-                    for lang, text in lang_dict.iteritems():
-                        interfaces.upsert_resource_multilang(res_id,
-                                                             field,
-                                                             lang,
-                                                             text)
+                by_id[res_id] = res_dict
+            interfaces.upsert_resources_multilang_bulk(by_id)
 
         except Exception, e:
             return str(e)
@@ -184,3 +390,183 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
             {})
         self._user_name = user['name']
         return self._user_name
+
+
+class DCATAPITRDFHarvester(DCATRDFHarvester):
+    '''
+    DCAT RDF harvester, which doesn't keep harvested catalog in memory.
+
+    Each page of the catalog is downloaded into a temporary file, hashed
+    while downloaded, and RDF/XML is parsed from the file with
+    `StreamingRDFParser`. Other formats are parsed in memory, as with
+    `dcat_rdf` harvester.
+
+    Content of pages is never loaded, so `after_download()` hooks of
+    `IDCATRDFHarvester` plugins are not called, other hooks are.
+    '''
+
+    def info(self):
+        return {
+            'name': DCATAPIT_RDF_HARVESTER,
+            'title': 'DCAT-AP_IT RDF Harvester',
+            'description': 'Harvester for DCAT-AP_IT datasets from an RDF graph, '
+                           'parsing RDF/XML incrementally'
+        }
+
+    def gather_stage(self, harvest_job):
+        log.debug('In DCATAPITRDFHarvester gather_stage')
+
+        rdf_format = None
+        if harvest_job.source.config:
+            rdf_format = json.loads(harvest_job.source.config).get('rdf_format')
+
+        url = harvest_job.source.url
+        guids_in_source = []
+        object_ids = []
+        last_digest = None
+        self._names_taken = []
+
+        while url:
+            for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                url, errors = harvester.before_download(url, harvest_job)
+                for error_msg in errors:
+                    self._save_gather_error(error_msg, harvest_job)
+                if not url:
+                    return []
+
+            parser = StreamingRDFParser()
+            try:
+                with tempfile.TemporaryFile(prefix='dcatapit-harvest-') as content:
+                    downloaded = self._download(url, harvest_job, content, rdf_format)
+                    if not downloaded:
+                        return []
+                    digest, page_format = downloaded
+                    if digest == last_digest:
+                        log.warning('Remote content was the same even when using a paginated URL, skipping')
+                        break
+                    last_digest = digest
+
+                    content.seek(0)
+                    try:
+                        parser.parse(content, _format=page_format)
+                    except RDFParserException, e:
+                        self._save_gather_error('Error parsing the RDF file: {0}'.format(e), harvest_job)
+                        return []
+
+                page_parser = parser
+                for harvester in p.PluginImplementations(IDCATRDFHarvester):
+                    page_parser, errors = harvester.after_parsing(page_parser, harvest_job)
+                    for error_msg in errors:
+                        self._save_gather_error(error_msg, harvest_job)
+                if not page_parser:
+                    return []
+
+                try:
+                    guids_in_source.extend(self._gather_datasets(page_parser, harvest_job, object_ids))
+                except Exception, e:
+                    self._save_gather_error('Error when processsing dataset: %r / %s' % (e, traceback.format_exc()),
+                                            harvest_job)
+                    return []
+                url = page_parser.next_page()
+            finally:
+                parser.close()
+
+        object_ids.extend(self._mark_datasets_for_deletion(guids_in_source, harvest_job))
+        return object_ids
+
+    def _download(self, url, harvest_job, out, content_type=None):
+        '''
+        Writes content of `url` (web url or local path) to `out` file.
+
+        Returns tuple of content's md5 digest and type, or None if content
+        couldn't be downloaded (error is saved for the job).
+        '''
+        digest = hashlib.md5()
+        max_size = 1024 * 1024 * p.toolkit.asint(config.get('ckanext.dcat.max_file_size',
+                                                            HARVEST_MAX_FILE_SIZE_MB))
+
+        if not url.lower().startswith('http'):
+            if not os.path.exists(url):
+                self._save_gather_error('Could not get content for this url', harvest_job)
+                return
+            with open(url, 'rb') as f:
+                for chunk in iter(lambda: f.read(HARVEST_DOWNLOAD_CHUNK_SIZE), ''):
+                    digest.update(chunk)
+                    out.write(chunk)
+            return digest.digest(), content_type or rdflib.util.guess_format(url)
+
+        log.debug('Getting file %s', url)
+        session = requests.Session()
+        for harvester in p.PluginImplementations(IDCATRDFHarvester):
+            session = harvester.update_session(session)
+        try:
+            r = session.get(url, stream=True)
+            r.raise_for_status()
+
+            length = r.headers.get('content-length')
+            if length and int(length) > max_size:
+                self._save_gather_error('Remote file is too big. Allowed file size: {}, Content-Length: {}.'
+                                        .format(max_size, length), harvest_job)
+                return
+            length = 0
+            for chunk in r.iter_content(chunk_size=HARVEST_DOWNLOAD_CHUNK_SIZE):
+                length += len(chunk)
+                if length > max_size:
+                    self._save_gather_error('Remote file is too big.', harvest_job)
+                    return
+                digest.update(chunk)
+                out.write(chunk)
+        except requests.exceptions.HTTPError, error:
+            self._save_gather_error('Could not get content from %s. Server responded with %s %s'
+                                    % (url, error.response.status_code, error.response.reason),
+                                    harvest_job)
+            return
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,), error:
+            self._save_gather_error('Could not get content from %s: %s' % (url, error),
+                                    harvest_job)
+            return
+
+        if content_type is None and r.headers.get('content-type'):
+            content_type = r.headers.get('content-type').split(';', 1)[0]
+        return digest.digest(), content_type
+
+    def import_stage(self, harvest_object):
+        try:
+            return super(DCATAPITRDFHarvester, self).import_stage(harvest_object)
+        finally:
+            reindex_pending_datasets(harvest_object)
+
+    def _gather_datasets(self, parser, harvest_job, object_ids):
+        '''
+        Creates harvest objects for datasets parsed from one page of the
+        catalog, and returns their guids.
+        '''
+        guids = []
+        source_dataset = Package.get(harvest_job.source.id)
+
+        for dataset in parser.datasets():
+            if not dataset.get('name'):
+                dataset['name'] = self._gen_new_name(dataset['title'])
+            if dataset['name'] in self._names_taken:
+                suffix = len([i for i in self._names_taken if i.startswith(dataset['name'] + '-')]) + 1
+                dataset['name'] = '{}-{}'.format(dataset['name'], suffix)
+            self._names_taken.append(dataset['name'])
+
+            if not dataset.get('owner_org') and source_dataset.owner_org:
+                dataset['owner_org'] = source_dataset.owner_org
+
+            guid = self._get_guid(dataset, source_url=source_dataset.url)
+            if not guid:
+                self._save_gather_error('Could not get a unique identifier for dataset: {0}'.format(dataset),
+                                        harvest_job)
+                continue
+
+            dataset['extras'].append({'key': 'guid', 'value': guid})
+            guids.append(guid)
+
+            obj = HarvestObject(guid=guid, job=harvest_job,
+                                content=json.dumps(dataset))
+            obj.save()
+            object_ids.append(obj.id)
+        return guids
+
@@ -0,0 +1,201 @@
+import logging
+import itertools
+import math
+
+from dateutil.parser import parse as dateutil_parse
+
+from ckan.lib.base import config
+from ckan.plugins import toolkit
+
+from ckanext.dcat.utils import catalog_uri
+
+from ckanext.dcatapit.dcat.processors import DCATAPITRDFSerializer
+
+
+log = logging.getLogger(__name__)
+
+DATASETS_PER_PAGE = 100
+
+# request parameters kept in pagination urls
+PAGINATION_PARAMS = ('modified_since', 'profiles', 'q', 'fq',)
+
+
+def dcat_dataset_show(context, data_dict):
+    '''
+    Same as ckanext-dcat's `dcat_dataset_show`, but serializes the dataset
+    with `DCATAPITRDFSerializer`, so cached fragments are used.
+    '''
+    toolkit.check_access('dcat_dataset_show', context, data_dict)
+
+    dataset_dict = toolkit.get_action('package_show')(context, data_dict)
+
+    serializer = DCATAPITRDFSerializer(profiles=data_dict.get('profiles'))
+
+    return serializer.serialize_dataset(dataset_dict,
+                                        _format=data_dict.get('format'))
+
+
+@toolkit.side_effect_free
+def dcat_catalog_show(context, data_dict):
+    '''
+    Same as ckanext-dcat's `dcat_catalog_show`, but serializes the catalog
+    with `DCATAPITRDFSerializer`, which loads localized fields of the page
+    of datasets at once and uses cached fragments.
+    '''
+    toolkit.check_access('dcat_catalog_show', context, data_dict)
+
+    query = _search_datasets(context, data_dict)
+    dataset_dicts = query['results']
+    pagination_info = _pagination_info(query, data_dict)
+
+    serializer = DCATAPITRDFSerializer(profiles=data_dict.get('profiles'))
+
+    return serializer.serialize_catalog({}, dataset_dicts,
+                                        _format=data_dict.get('format'),
+                                        pagination_info=pagination_info)
+
+
+def iter_catalog_datasets(context, data_dict):
+    '''
+    Returns iterator over datasets listed by `dcat_catalog_show`, from
+    `page` (the first one by default) to the last one.
+
+    Datasets are sorted by id, and each next page is searched for ids
+    greater than the last one returned, so datasets modified while the
+    catalog is read are neither skipped nor repeated.
+
+    The first page is searched immediately, so invalid parameters raise
+    `ValidationError` here. Each next page is searched only when datasets
+    of the previous one were consumed.
+    '''
+    results = _search_datasets(context, data_dict, sort='id asc')['results']
+    rows = _datasets_per_page()
+
+    def next_pages(results):
+        while len(results) >= rows:
+            last_id = results[-1]['id'].replace('"', '\\"')
+            results = _search_datasets(context, dict(data_dict, page=1),
+                                       sort='id asc',
+                                       fq_list=['id:{"%s" TO *]' % last_id]
+                                       )['results']
+            for dataset_dict in results:
+                yield dataset_dict
+
+    return itertools.chain(results, next_pages(results))
+
+
+def _datasets_per_page():
+    return int(config.get('ckanext.dcat.datasets_per_page', DATASETS_PER_PAGE))
+
+
+def _get_page(data_dict):
+    try:
+        page = int(data_dict.get('page') or 1)
+    except (TypeError, ValueError):
+        page = 0
+    if page < 1:
+        raise toolkit.ValidationError(
+            'Page param must be a positive integer starting in 1')
+    return page
+
+
+def _search_datasets(context, data_dict, sort='metadata_modified desc',
+                     fq_list=None):
+    '''
+    Searches the `page` of datasets listed in the catalog, with the same
+    parameters as ckanext-dcat's DCAT actions (`q`, `fq`, `modified_since`).
+
+    `fq_list` are additional filter queries.
+    '''
+    rows = _datasets_per_page()
+    page = _get_page(data_dict)
+
+    search_data_dict = {
+        'q': data_dict.get('q') or '*:*',
+        'fq': data_dict.get('fq'),
+        'fq_list': ['-dataset_type:harvest', '-dataset_type:showcase'],
+        'rows': rows,
+        'start': rows * (page - 1),
+        'sort': sort,
+    }
+    search_data_dict['fq_list'].extend(fq_list or [])
+
+    modified_since = data_dict.get('modified_since')
+    if modified_since:
+        try:
+            modified_since = dateutil_parse(modified_since).isoformat() + 'Z'
+        except (ValueError, AttributeError):
+            raise toolkit.ValidationError(
+                'Wrong modified date format. Use ISO-8601 format')
+        search_data_dict['fq_list'].append(
+            'metadata_modified:[{0} TO NOW]'.format(modified_since))
+
+    return toolkit.get_action('package_search')(dict(context),
+                                                search_data_dict)
+
+
+def _pagination_info(query, data_dict):
+    '''
+    Returns pagination info passed to the serializer for `query`, the
+    result of `_search_datasets`: `count`, `items_per_page` and urls of
+    `current`, `first`, `last`, `next` and `previous` pages.
+    '''
+    if query['count'] == 0:
+        return {}
+
+    def _page_url(page):
+        params = [(k, toolkit.request.params[k]) for k in PAGINATION_PARAMS
+                  if toolkit.request.params.get(k)]
+        params.append(('page', page))
+        return '{0}{1}?{2}'.format(catalog_uri(), toolkit.request.path,
+                                   '&'.join('{0}={1}'.format(k, v)
+                                            for k, v in params))
+
+    page = _get_page(data_dict)
+    items_per_page = _datasets_per_page()
+    last_page = int(math.ceil(float(query['count']) / items_per_page)) or 1
+
+    pagination_info = {
+        'count': query['count'],
+        'items_per_page': items_per_page,
+        'current': _page_url(page),
+        'first': _page_url(1),
+        'last': _page_url(last_page),
+    }
+    if page > 1:
+        if (page - 1) * items_per_page + len(query['results']) <= query['count']:
+            pagination_info['previous'] = _page_url(page - 1)
+        else:
+            pagination_info['previous'] = _page_url(last_page)
+    if page * items_per_page < query['count']:
+        pagination_info['next'] = _page_url(page + 1)
+
+    return pagination_info
+
+
+def get_actions():
+    '''
+    Returns actions overriding ckanext-dcat's ones.
+
+    ckanext-dcat registers the same action names, so they can be replaced
+    only as chained actions, available since CKAN 2.7. On older versions
+    ckanext-dcat's actions are used.
+    '''
+    if not hasattr(toolkit, 'chained_action'):
+        log.warning('CKAN < 2.7: DCAT-AP_IT serializer not used by DCAT actions')
+        return {}
+    actions = {}
+    for action in (dcat_dataset_show, dcat_catalog_show,):
+        chained = toolkit.chained_action(_ignore_original(action))
+        actions[action.__name__] = chained
+    return actions
+
+
+def _ignore_original(action):
+    def wrapper(original_action, context, data_dict):
+        return action(context, data_dict)
+    wrapper.__name__ = action.__name__
+    wrapper.__doc__ = action.__doc__
+    if getattr(action, 'side_effect_free', False):
+        wrapper.side_effect_free = True
+    return wrapper
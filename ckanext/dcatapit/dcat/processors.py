@@ -0,0 +1,442 @@
+import logging
+import tempfile
+import hashlib
+import itertools
+import urlparse
+import xml.sax
+
+from cStringIO import StringIO
+import xml.etree.cElementTree as etree
+
+import rdflib
+from rdflib import URIRef, BNode
+from rdflib.plugins.serializers.turtle import TurtleSerializer
+
+from ckanext.dcat.processors import RDFParser, RDFParserException, RDFSerializer
+from ckanext.dcat.profiles import DCAT
+from ckanext.dcat.utils import url_to_rdflib_format
+
+from ckanext.dcatapit.interfaces import MULTILANG_BATCH_SIZE
+from ckanext.dcatapit.dcat.profiles import prefetch_multilang
+from ckanext.dcatapit.dcat import cache
+
+
+log = logging.getLogger(__name__)
+
+RDF_NS = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+DCAT_NS = 'http://www.w3.org/ns/dcat#'
+HYDRA_NS = 'http://www.w3.org/ns/hydra/core#'
+
+RDF_ROOT = '{%s}RDF' % RDF_NS
+RDF_DESCRIPTION = '{%s}Description' % RDF_NS
+RDF_TYPE = '{%s}type' % RDF_NS
+RDF_ABOUT = '{%s}about' % RDF_NS
+RDF_ID = '{%s}ID' % RDF_NS
+RDF_NODEID = '{%s}nodeID' % RDF_NS
+RDF_RESOURCE = '{%s}resource' % RDF_NS
+RDF_PARSETYPE = '{%s}parseType' % RDF_NS
+XML_LANG = '{%s}lang' % XML_NS
+XML_BASE = '{%s}base' % XML_NS
+DCAT_DATASET = '{%s}Dataset' % DCAT_NS
+DCAT_DATASET_URI = DCAT_NS + 'Dataset'
+
+# rdflib/ckanext-dcat format names handled by streaming parser,
+# other formats are parsed in memory
+STREAMING_FORMATS = (None, '', 'xml', 'pretty-xml', 'rdf', 'application/rdf+xml',)
+
+FRAGMENT_DOC = '<rdf:RDF xmlns:rdf="%s">%%s</rdf:RDF>' % RDF_NS
+
+# node ids assigned to anonymous datasets
+GENERATED_NODEID = 'dcatapitstream{}'
+
+# rdflib format names written dataset by dataset by
+# DCATAPITRDFSerializer.serialize_catalog_iter()
+STREAMING_SERIALIZE_FORMATS = ('nt', 'turtle',)
+
+
+class _Element(object):
+    __slots__ = ('elem', 'kind', 'lang', 'base',)
+
+    def __init__(self, elem, kind, lang, base):
+        self.elem = elem
+        self.kind = kind
+        self.lang = lang
+        self.base = base
+
+
+def _element_kind(elem, parent):
+    '''
+    Returns RDF/XML role of the element, based on its parent:
+    'rdf' (document element), 'node', 'property' or 'literal'
+    '''
+    if parent is None:
+        return 'rdf' if elem.tag == RDF_ROOT else 'node'
+    if parent.kind == 'rdf':
+        return 'node'
+    if parent.kind == 'node':
+        return 'property'
+    if parent.kind == 'property':
+        parse_type = parent.elem.get(RDF_PARSETYPE)
+        if parse_type == 'Resource':
+            return 'property'
+        if parse_type == 'Literal':
+            return 'literal'
+        return 'node'
+    return 'literal'
+
+
+def _has_type(elem, uri=None, ns=None):
+    for child in elem:
+        if child.tag != RDF_TYPE:
+            continue
+        value = child.get(RDF_RESOURCE)
+        if value and (value == uri or (ns and value.startswith(ns))):
+            return True
+    return False
+
+
+def _term_key(term):
+    if isinstance(term, BNode):
+        return u'_:{}'.format(term)
+    return unicode(term)
+
+
+def _key_term(key):
+    if key.startswith('_:'):
+        return BNode(key[2:])
+    return URIRef(key)
+
+
+class StreamingRDFParser(RDFParser):
+    '''
+    RDF parser, which doesn't keep the whole catalog in memory.
+
+    RDF/XML documents are read incrementally, and each identified node
+    (one with `rdf:about`, `rdf:ID` or `rdf:nodeID`) is cut out into
+    a fragment stored in a temporary file, leaving only a reference in
+    its parent. `datasets()` then builds a small graph for each
+    `dcat:Dataset`, with the dataset fragments and, recursively, fragments
+    of all nodes it references (distributions, agents, licenses, concepts
+    etc.), but not other datasets, and hands it to profiles'
+    `parse_dataset()`.
+
+    Memory used is proportional to the biggest dataset and to the number
+    of identified nodes in the catalog (fragments' offsets), not to the
+    catalog size. Datasets are yielded in document order. Other formats
+    are parsed in memory, as with `RDFParser`.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(StreamingRDFParser, self).__init__(*args, **kwargs)
+        self._fragments = None
+        self._index = None
+        self._dataset_keys = None
+        self._datasets_order = None
+
+    def parse(self, data, _format=None):
+        '''
+        Reads RDF/XML document into fragments file.
+
+        `data` can be a string or a file-like object.
+        '''
+        self.close()
+        if _format not in STREAMING_FORMATS:
+            if hasattr(data, 'read'):
+                data = data.read()
+            return super(StreamingRDFParser, self).parse(data, _format)
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if isinstance(data, str):
+            data = StringIO(data)
+        self._fragments = tempfile.TemporaryFile(prefix='dcatapit-rdf-')
+        # node key -> list of (offset, length) of fragments describing it
+        self._index = {}
+        self._dataset_keys = set()
+        self._datasets_order = []
+        try:
+            self._split(data)
+        except (SyntaxError, xml.sax.SAXParseException, rdflib.plugin.PluginException,), e:
+            self.close()
+            raise RDFParserException(e)
+        log.debug('Catalog split into %s datasets and %s nodes',
+                  len(self._datasets_order), len(self._index))
+
+    def close(self):
+        if self._fragments is not None:
+            self._fragments.close()
+        self._fragments = None
+        self._index = self._dataset_keys = self._datasets_order = None
+
+    def _node_key(self, elem, base):
+        about = elem.get(RDF_ABOUT)
+        if about is not None:
+            return unicode(urlparse.urljoin(base, about) if base else about)
+        rdf_id = elem.get(RDF_ID)
+        if rdf_id is not None:
+            return unicode(urlparse.urljoin(base or '', '#' + rdf_id))
+        nodeid = elem.get(RDF_NODEID)
+        if nodeid is not None:
+            return u'_:{}'.format(nodeid)
+
+    def _split(self, source):
+        stack = []
+        generated_ids = itertools.count()
+        # catalogs often repeat the same description of agent, license
+        # etc. in each dataset, it's stored once
+        stored = set()
+
+        for event, elem in etree.iterparse(source, events=('start', 'end',)):
+            if event == 'start':
+                parent = stack[-1] if stack else None
+                lang = elem.get(XML_LANG, parent.lang if parent else None)
+                base = parent.base if parent else None
+                if elem.get(XML_BASE):
+                    base = urlparse.urljoin(base or '', elem.get(XML_BASE))
+                stack.append(_Element(elem, _element_kind(elem, parent), lang, base))
+                continue
+
+            current = stack.pop()
+            if current.kind != 'node':
+                continue
+            parent = stack[-1] if stack else None
+
+            is_dataset = elem.tag == DCAT_DATASET or _has_type(elem, uri=DCAT_DATASET_URI)
+            key = self._node_key(elem, current.base)
+            if key is None:
+                if is_dataset:
+                    nodeid = GENERATED_NODEID.format(generated_ids.next())
+                    elem.set(RDF_NODEID, nodeid)
+                    key = u'_:{}'.format(nodeid)
+                elif parent is not None and parent.kind != 'rdf':
+                    # anonymous nodes stay with their parent
+                    continue
+
+            # keep inherited xml:lang and xml:base in fragment
+            if current.lang and elem.get(XML_LANG) is None:
+                elem.set(XML_LANG, current.lang)
+            if current.base:
+                elem.set(XML_BASE, current.base)
+            elem.tail = None
+            # escape characters, which XML parser would normalize
+            fragment = etree.tostring(elem).replace('\r', '&#13;').replace('\t', '&#9;')
+
+            digest = (key, hashlib.md5(fragment).digest(),)
+            if key is not None and digest not in stored:
+                stored.add(digest)
+                self._fragments.seek(0, 2)
+                offset = self._fragments.tell()
+                self._fragments.write(fragment)
+                self._index.setdefault(key, []).append((offset, len(fragment),))
+                if is_dataset and key not in self._dataset_keys:
+                    self._dataset_keys.add(key)
+                    self._datasets_order.append(key)
+
+            # paging info is read by next_page() from self.g
+            if elem.tag.startswith('{%s}' % HYDRA_NS) or _has_type(elem, ns=HYDRA_NS):
+                self.g.parse(data=FRAGMENT_DOC % fragment, format='xml',
+                             preserve_bnode_ids=True)
+
+            if parent is None or parent.kind == 'rdf':
+                if parent is not None:
+                    parent.elem.remove(elem)
+                else:
+                    elem.clear()
+            else:
+                # leave reference to the node in parent
+                ident = [(k, elem.get(k),) for k in (RDF_ABOUT, RDF_ID, RDF_NODEID,)
+                         if elem.get(k) is not None]
+                elem.clear()
+                elem.tag = RDF_DESCRIPTION
+                for k, v in ident:
+                    elem.set(k, v)
+                if current.base:
+                    elem.set(XML_BASE, current.base)
+
+
+    def _read_fragments(self, positions):
+        out = []
+        for offset, length in positions:
+            self._fragments.seek(offset)
+            out.append(self._fragments.read(length))
+        return FRAGMENT_DOC % ''.join(out)
+
+    def dataset_graph(self, key):
+        '''
+        Returns graph with dataset identified by `key` and all non-dataset
+        nodes it references, directly or not.
+        '''
+        graph = rdflib.Graph()
+        seen = set([key])
+        pending = [key]
+        while pending:
+            positions = []
+            for k in pending:
+                if k != key and k in self._dataset_keys:
+                    continue
+                positions.extend(self._index.get(k, ()))
+            if not positions:
+                break
+            graph.parse(data=self._read_fragments(positions), format='xml',
+                        preserve_bnode_ids=True)
+            pending = []
+            for o in graph.objects():
+                if isinstance(o, (URIRef, BNode,)):
+                    k = _term_key(o)
+                    if k not in seen:
+                        seen.add(k)
+                        pending.append(k)
+        return graph
+
+    def datasets(self):
+        '''
+        Generator that returns CKAN datasets parsed from one small graph
+        per dataset.
+        '''
+        if self._fragments is None:
+            for dataset_dict in super(StreamingRDFParser, self).datasets():
+                yield dataset_dict
+            return
+
+        for key in self._datasets_order:
+            graph = self.dataset_graph(key)
+            dataset_ref = _key_term(key)
+            dataset_dict = {}
+            for profile_class in self._profiles:
+                profile = profile_class(graph, self.compatibility_mode)
+                profile.parse_dataset(dataset_dict, dataset_ref)
+            yield dataset_dict
+
+
+class _TurtleChunkSerializer(TurtleSerializer):
+    '''
+    Turtle serializer for a part of a document, which declares only
+    prefixes not declared by previous parts.
+    '''
+
+    def __init__(self, store, declared):
+        super(_TurtleChunkSerializer, self).__init__(store)
+        self.declared = declared
+
+    def startDocument(self):
+        self._started = True
+        for prefix, uri in sorted(self.namespaces.items()):
+            if self.declared.get(prefix) == uri:
+                continue
+            self.declared[prefix] = uri
+            self.write(self.indent() + '@prefix %s: <%s> .\n' % (prefix, uri))
+
+
+def _serialize_chunk(graph, _format, declared):
+    if _format == 'nt':
+        return graph.serialize(format='nt')
+    out = StringIO()
+    _TurtleChunkSerializer(graph, declared).serialize(out, encoding='utf-8')
+    return out.getvalue()
+
+
+class DCATAPITRDFSerializer(RDFSerializer):
+    '''
+    RDF serializer, which loads localized fields of all serialized
+    datasets and their resources before serializing the catalog, instead
+    of querying them for each dataset and resource.
+
+    If `ckanext.dcatapit.rdf_cache.dir` is set, triples of each dataset
+    are cached there, see `ckanext.dcatapit.dcat.cache`, and profiles are
+    run only for datasets without up to date fragment.
+    '''
+
+    def serialize_catalog(self, catalog_dict=None, dataset_dicts=None, *args, **kwargs):
+        if dataset_dicts:
+            dataset_dicts = list(dataset_dicts)
+            prefetch_multilang(self.g, dataset_dicts)
+        return super(DCATAPITRDFSerializer, self).serialize_catalog(catalog_dict,
+                                                                    dataset_dicts,
+                                                                    *args, **kwargs)
+
+    def _fragment_graph(self):
+        graph = rdflib.Graph()
+        # profiles use caches of the catalog graph
+        graph.cache_scope = self.g
+        for prefix, namespace in self.g.namespaces():
+            graph.bind(prefix, namespace)
+        return graph
+
+    def dataset_fragment(self, dataset_dict):
+        '''
+        Returns tuple of dataset reference and a new graph with
+        dataset's triples only.
+        '''
+        graph = self._fragment_graph()
+        variant = cache.serializer_variant(self._profiles,
+                                           getattr(self, 'compatibility_mode', False))
+        cached = cache.get_fragment(dataset_dict, variant) if cache.is_enabled() else None
+        if cached:
+            dataset_uri, data = cached
+            graph.parse(data=data, format='nt')
+            return URIRef(dataset_uri), graph
+
+        main_graph = self.g
+        self.g = graph
+        try:
+            dataset_ref = super(DCATAPITRDFSerializer, self).graph_from_dataset(dataset_dict)
+        finally:
+            self.g = main_graph
+        if cache.is_enabled():
+            cache.store_fragment(dataset_dict, dataset_ref, graph.serialize(format='nt'),
+                                 variant)
+        return dataset_ref, graph
+
+    def graph_from_dataset(self, dataset_dict, *args, **kwargs):
+        if not cache.is_enabled():
+            return super(DCATAPITRDFSerializer, self).graph_from_dataset(dataset_dict,
+                                                                         *args, **kwargs)
+        dataset_ref, fragment = self.dataset_fragment(dataset_dict)
+        for prefix, namespace in fragment.namespaces():
+            self.g.bind(prefix, namespace, override=False)
+        for triple in fragment:
+            self.g.add(triple)
+        return dataset_ref
+
+    def serialize_catalog_iter(self, catalog_dict=None, dataset_dicts=None,
+                               _format='nt', pagination_info=None):
+        '''
+        Generator, which returns serialized catalog in chunks: the catalog
+        description first, and then one chunk for each dataset.
+
+        Each dataset is serialized into its own graph, which is discarded
+        once written, so memory used doesn't depend on the number of
+        datasets. Localized fields are loaded for `MULTILANG_BATCH_SIZE`
+        datasets at once, and `dataset_dicts` can be a generator.
+
+        Only N-Triples and Turtle can be written this way, other formats
+        are serialized with `serialize_catalog()` and returned in one
+        chunk.
+        '''
+        _format = url_to_rdflib_format(_format)
+        if _format not in STREAMING_SERIALIZE_FORMATS:
+            yield self.serialize_catalog(catalog_dict, dataset_dicts, _format=_format,
+                                         pagination_info=pagination_info)
+            return
+
+        # prefixes written so far in Turtle output
+        declared = {}
+        catalog_ref = self.graph_from_catalog(catalog_dict)
+        if pagination_info:
+            self._add_pagination_triples(pagination_info)
+        yield _serialize_chunk(self.g, _format, declared)
+
+        dataset_dicts = iter(dataset_dicts or ())
+        while True:
+            batch = list(itertools.islice(dataset_dicts, MULTILANG_BATCH_SIZE))
+            if not batch:
+                break
+            prefetch_multilang(self.g, batch)
+            for dataset_dict in batch:
+                dataset_ref, fragment = self.dataset_fragment(dataset_dict)
+                fragment.add((catalog_ref, DCAT.dataset, dataset_ref))
+                yield _serialize_chunk(fragment, _format, declared)
+                # keep prefixes generated for this dataset in next ones
+                for prefix, namespace in fragment.namespaces():
+                    self.g.bind(prefix, namespace, override=False)
@@ -3,6 +3,7 @@ import json
 import ast
 import logging
 import datetime
+import weakref
 
 from ckan.lib.base import config
 
@@ -10,6 +11,7 @@ from rdflib.namespace import Namespace, RDF, SKOS
 from rdflib import URIRef, BNode, Literal
 
 import ckan.logic as logic
+from ckan.plugins import toolkit
 
 from ckan.lib.i18n import get_locales, get_lang
 from ckanext.dcat.profiles import RDFProfile, DCAT, LOCN, VCARD, DCT, FOAF, ADMS, OWL, SCHEMA, TIME
@@ -84,8 +86,141 @@ format_mapping = {
 }
 
 
+# use in-memory subject/predicate index when parsing datasets
+DCATAPIT_PARSE_GRAPH_INDEX = 'ckanext.dcatapit.parse.graph_index'
+PARSE_GRAPH_INDEX_ENABLED = toolkit.asbool(config.get(DCATAPIT_PARSE_GRAPH_INDEX, True))
+
 log = logging.getLogger(__name__)
 
+# id(graph) -> (weakref to graph, caches), see get_graph_cache()
+_graph_caches = {}
+
+
+def get_graph_cache(graph, name):
+    '''
+    Returns dict named `name`, shared by all profiles working on given
+    graph.
+
+    Profile instances are created for each dataset, but datasets parsed
+    from one catalog, or serialized into one catalog, share the graph, so
+    it's used as a scope for caches. Caches are kept until the graph is
+    garbage collected.
+    '''
+    if isinstance(graph, IndexedGraph):
+        graph = graph.graph
+    # graphs with a single dataset share caches with the catalog graph
+    graph = getattr(graph, 'cache_scope', None) or graph
+    key = id(graph)
+    try:
+        ref, caches = _graph_caches[key]
+        if ref() is not graph:
+            raise KeyError(key)
+    except KeyError:
+        def _drop(ref, key=key):
+            item = _graph_caches.get(key)
+            if item and item[0] is ref:
+                del _graph_caches[key]
+
+        caches = {}
+        _graph_caches[key] = (weakref.ref(graph, _drop), caches)
+    return caches.setdefault(name, {})
+
+
+def get_graph_index(graph):
+    '''
+    Returns subject -> predicate -> objects index shared by all
+    `IndexedGraph` views of given graph.
+
+    Index is filled by `IndexedGraph` on first access to each subject,
+    so datasets parsed from the same catalog graph share agents, licenses
+    etc. It's not updated when the graph changes, so it should be used
+    only for graphs which are read-only after parsing.
+    '''
+    return get_graph_cache(graph, 'index')
+
+
+def prefetch_multilang(graph, dataset_dicts):
+    '''
+    Loads localized fields of datasets and their resources with
+    `interfaces.get_for_packages()` and `interfaces.get_for_resources()`,
+    and stores them for `ItalianDCATAPProfile.graph_from_dataset()`
+    calls on the same graph.
+    '''
+    pkg_ids = []
+    res_ids = []
+    for dataset_dict in dataset_dicts:
+        pkg_ids.append(dataset_dict.get('id'))
+        res_ids.extend(r.get('id') for r in dataset_dict.get('resources') or [])
+
+    for name, loaded in (('package_multilang', interfaces.get_for_packages(pkg_ids),),
+                         ('resource_multilang', interfaces.get_for_resources(res_ids),),):
+        if loaded is not None:
+            get_graph_cache(graph, name).update(loaded)
+
+
+class IndexedGraph(object):
+    '''
+    Read-only view of a Graph, which answers `objects()`, `value()`
+    and triple membership tests with bound subject and predicate
+    from the index returned by `get_graph_index()`.
+
+    All predicates of a subject are read from the store with one call.
+    Terms are indexed by their text, which is cheaper to hash than rdflib
+    terms. Everything else is delegated to the wrapped graph.
+    '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.index = get_graph_index(graph)
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+    def __iter__(self):
+        return iter(self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def _objects(self, subject, predicate):
+        skey = unicode(subject)
+        preds = self.index.get(skey)
+        if preds is None:
+            preds = self.index[skey] = {}
+            for p, o in self.graph.predicate_objects(subject):
+                try:
+                    preds[unicode(p)].append(o)
+                except KeyError:
+                    preds[unicode(p)] = [o]
+        pkey = unicode(predicate)
+        objs = preds.get(pkey, ())
+        # subject scan may list objects in other order than (subject,
+        # predicate) query. Parsing depends on that order (first or last
+        # value wins), so multi-valued entries are read once more from
+        # the store, and kept in the store's order.
+        if len(objs) > 1 and isinstance(objs, list):
+            objs = preds[pkey] = tuple(self.graph.objects(subject, predicate))
+        return objs
+
+    def objects(self, subject=None, predicate=None):
+        if subject is None or predicate is None:
+            return self.graph.objects(subject, predicate)
+        return iter(self._objects(subject, predicate))
+
+    def value(self, subject=None, predicate=RDF.value, object=None, default=None, any=True):
+        if subject is None or predicate is None or object is not None or not any:
+            return self.graph.value(subject, predicate, object, default, any)
+        for o in self._objects(subject, predicate):
+            return o
+        return default
+
+    def __contains__(self, triple):
+        s, p, o = triple
+        if s is None or p is None or o is None:
+            return triple in self.graph
+        return o in self._objects(s, p)
+
+
 class ItalianDCATAPProfile(RDFProfile):
     '''
     An RDF profile for the Italian DCAT-AP recommendation for data portals
@@ -94,6 +229,10 @@ class ItalianDCATAPProfile(RDFProfile):
 
     def parse_dataset(self, dataset_dict, dataset_ref):
 
+        # read parsed graph through shared subject/predicate index
+        if PARSE_GRAPH_INDEX_ENABLED and not isinstance(self.g, IndexedGraph):
+            self.g = IndexedGraph(self.g)
+
         # check the dataset type
         if (dataset_ref, RDF.type, DCATAPIT.Dataset) not in self.g:
             # not a DCATAPIT dataset
@@ -610,13 +749,17 @@ class ItalianDCATAPProfile(RDFProfile):
         title = dataset_dict.get('title')
 
         # extract fields from extras, just in case
-        schema_fields = schema.get_custom_package_schema() 
-        for fdef in schema_fields:
-            for eidx, ex in enumerate(dataset_dict.get('extras') or []):
-                if ex['key'] == fdef['name']:
-                    dataset_dict['extras'].pop(eidx)
-                    dataset_dict[fdef['name']] = ex['value']
-                    break
+        promotable = schema.get_compiled_package_schema().promotable
+        if dataset_dict.get('extras'):
+            promoted = set()
+            extras = []
+            for ex in dataset_dict['extras']:
+                if ex['key'] in promotable and ex['key'] not in promoted:
+                    promoted.add(ex['key'])
+                    dataset_dict[ex['key']] = ex['value']
+                else:
+                    extras.append(ex)
+            dataset_dict['extras'][:] = extras
         
         g = self.g
 
@@ -802,22 +945,7 @@ class ItalianDCATAPProfile(RDFProfile):
         org_id = dataset_dict.get('owner_org')
 
         # get orga info
-        org_show = logic.get_action('organization_show')
-
-        org_dict = {}
-        if org_id:
-            try:
-                org_dict = org_show({'ignore_auth': True},
-                                    {'id': org_id,
-                                     'include_datasets': False,
-                                     'include_tags': False,
-                                     'include_users': False,
-                                     'include_groups': False,
-                                     'include_extras': True,
-                                     'include_followers': False}
-                                    )
-            except Exception, err:
-                log.warning("Cannot get org for %s: %s", org_id, err, exc_info=err)
+        org_dict = self._get_org_dict(org_id)
 
         org_uri = organization_uri(org_dict)
 
@@ -846,7 +974,7 @@ class ItalianDCATAPProfile(RDFProfile):
         # Add localized entries in dataset
         # TODO: should we remove the non-localized nodes?
 
-        loc_dict = interfaces.get_for_package(dataset_dict['id'])
+        loc_dict = self._get_localized('package', dataset_dict['id'])
         #  The multilang fields
         loc_package_mapping = {
             'title': (dataset_ref, DCT.title),
@@ -856,7 +984,7 @@ class ItalianDCATAPProfile(RDFProfile):
 
         dataset_is_local = dataset_dict.get('dataset_is_local')
         if dataset_is_local:
-            _org_name = interfaces.get_for_group_or_organization(dataset_dict['owner_org'])
+            _org_name = self._get_org_localized(dataset_dict['owner_org'])
             if _org_name.get('title'):
                 loc_dict['holder_name'] = _org_name['title']
             
@@ -866,7 +994,7 @@ class ItalianDCATAPProfile(RDFProfile):
 
         self._add_multilang_values(loc_dict, loc_package_mapping)
         if not holder_use_dataset and holder_ref:
-            loc_dict = interfaces.get_for_group_or_organization(org_dict['id'])
+            loc_dict = self._get_org_localized(org_dict['id'])
             loc_package_mapping = {'name': (holder_ref, FOAF.name)}
             self._add_multilang_values(loc_dict, loc_package_mapping)
 
@@ -923,7 +1051,7 @@ class ItalianDCATAPProfile(RDFProfile):
             # Add localized entries in resource
             # TODO: should we remove the not-localized nodes?
 
-            loc_dict = interfaces.get_for_resource(resource_dict['id'])
+            loc_dict = self._get_localized('resource', resource_dict['id'])
 
             #  The multilang fields
             loc_resource_mapping = {
@@ -950,6 +1078,62 @@ class ItalianDCATAPProfile(RDFProfile):
         else:
             log.warn("No mulitlang source data")
 
+    def _get_localized(self, _type, _id):
+        '''
+        Returns localized fields of package or resource, prefetched with
+        `prefetch_multilang()` if available.
+        '''
+        prefetched = get_graph_cache(self.g, _type + '_multilang')
+        try:
+            return prefetched.pop(_id)
+        except KeyError:
+            if _type == 'package':
+                return interfaces.get_for_package(_id)
+            return interfaces.get_for_resource(_id)
+
+    def _get_org_dict(self, org_id):
+        '''
+        Returns organization dict for given id, or empty dict.
+
+        Organizations are cached for the graph, so each is fetched once
+        when serializing whole catalog.
+        '''
+        if not org_id:
+            return {}
+        cache = get_graph_cache(self.g, 'organizations')
+        try:
+            return cache[org_id]
+        except KeyError:
+            pass
+        org_show = logic.get_action('organization_show')
+        org_dict = {}
+        try:
+            org_dict = org_show({'ignore_auth': True},
+                                {'id': org_id,
+                                 'include_datasets': False,
+                                 'include_tags': False,
+                                 'include_users': False,
+                                 'include_groups': False,
+                                 'include_extras': True,
+                                 'include_followers': False}
+                                )
+        except Exception, err:
+            log.warning("Cannot get org for %s: %s", org_id, err, exc_info=err)
+        cache[org_id] = org_dict
+        return org_dict
+
+    def _get_org_localized(self, org_id):
+        '''
+        Returns localized fields of organization, cached for the graph
+        like :py:meth:`_get_org_dict`.
+        '''
+        cache = get_graph_cache(self.g, 'organizations_localized')
+        try:
+            return cache[org_id]
+        except KeyError:
+            loc_dict = cache[org_id] = interfaces.get_for_group_or_organization(org_id)
+            return loc_dict
+
     def _add_right_holder(self, dataset_dict, org_dict, ref):
         basekey = 'holder'
         agent_name = self._get_dict_value(dataset_dict, basekey + '_name', None)
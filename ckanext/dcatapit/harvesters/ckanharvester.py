@@ -19,7 +19,10 @@ class CKANMappingHarvester(CKANHarvester):
 
     
     def import_stage(self, harvest_object):
-        map_nonconformant_groups(harvest_object)
-        data = map_ckan_license(harvest_object=harvest_object)
-        harvest_object.content = json.dumps(data)
+        if harvest_object and harvest_object.content is not None:
+            # decode content once for all mappings
+            data = json.loads(harvest_object.content)
+            map_nonconformant_groups(pkg_dict=data)
+            map_ckan_license(pkg_dict=data)
+            harvest_object.content = json.dumps(data)
         return super(CKANMappingHarvester, self).import_stage(harvest_object)
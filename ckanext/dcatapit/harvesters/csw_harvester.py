@@ -1,3 +1,4 @@
+import re
 import json
 import logging
 import ckanext.dcatapit.harvesters.utils as utils
@@ -58,6 +59,90 @@ ISOKeyword.elements.append(
     ))
 
 
+AGENT_ROLES = ('publisher', 'owner', 'author',)
+
+
+class DCATAPITCSWConfig(object):
+    '''
+    DCATAPITCSWHarvester source configuration with defaults merged,
+    validated and regular expressions compiled.
+
+    It's created once per harvest job, and holds per-job state, like
+    vocabulary label maps.
+    '''
+
+    def __init__(self, source_config, defaults):
+        source_config = source_config or {}
+
+        self.frequency_map = self._get_mapping(source_config, 'mapping_frequencies_to_mdr_vocabulary',
+                                               utils._mapping_frequencies_to_mdr_vocabulary)
+        self.language_map = self._get_mapping(source_config, 'mapping_languages_to_mdr_vocabulary',
+                                              utils._mapping_languages_to_mdr_vocabulary)
+        self.ckan_locales_mapping = self._get_mapping(source_config, 'ckan_locales_mapping',
+                                                      None) or utils._ckan_locales_mapping
+        self.default_values = self._get_mapping(source_config, 'default_values', None) or {}
+        self.default_license = source_config.get('default_license')
+
+        dcatapit_config = self._get_mapping(source_config, 'dcatapit_config', None) or defaults
+
+        controlled_vocabularies = self._get_mapping(dcatapit_config, 'controlled_vocabularies',
+                                                    None) or defaults['controlled_vocabularies']
+        default_vocab_id = defaults['controlled_vocabularies']['dcatapit_skos_theme_id']
+        self.theme_vocab_id = controlled_vocabularies.get('dcatapit_skos_theme_id', default_vocab_id)
+        self.places_vocab_id = controlled_vocabularies.get('dcatapit_skos_places_id', default_vocab_id)
+
+        self.frequency = dcatapit_config.get('frequency', defaults['frequency'])
+        self.dataset_places = dcatapit_config.get('dataset_places', defaults['dataset_places'])
+        self.dataset_languages = dcatapit_config.get('dataset_languages', defaults['dataset_languages'])
+        self.dataset_language = dcatapit_config.get('dataset_language')
+
+        agents = self._get_mapping(dcatapit_config, 'agents', None) or defaults['agents']
+        self.agents = {}
+        for role in AGENT_ROLES:
+            agent = agents.get(role, defaults['agents'][role])
+            if not isinstance(agent, dict):
+                raise ValueError('Agent configuration for {} should be an object'.format(role))
+            agent = dict(agent)
+            for key in ('code_regex', 'name_regex',):
+                agent[key] = self._compile_regex(role, key, agent.get(key))
+            self.agents[role] = agent
+
+        # vocabulary name -> label map, see get_vocabulary_label_map()
+        self._label_maps = {}
+
+    def _get_mapping(self, config, key, default):
+        value = config.get(key, default)
+        if value is not None and not isinstance(value, dict):
+            raise ValueError('{} configuration should be an object'.format(key))
+        return value
+
+    def _compile_regex(self, role, key, regex_config):
+        if not regex_config:
+            return regex_config
+        if not isinstance(regex_config, dict):
+            raise ValueError('{} for {} agent should be an object'.format(key, role))
+        regex_config = dict(regex_config)
+        if regex_config.get('regex'):
+            try:
+                regex_config['regex'] = re.compile(regex_config['regex'])
+            except (re.error, TypeError,), err:
+                raise ValueError('Invalid {} for {} agent: {}'.format(key, role, err))
+        groups = regex_config.get('groups')
+        if groups is not None and not isinstance(groups, (int, long, basestring, list,)):
+            raise ValueError('{} groups for {} agent should be a number, a group name '
+                             'or a list'.format(key, role))
+        return regex_config
+
+    def get_vocabulary_label_map(self, vocabulary_id):
+        '''
+        Returns normalized label -> tag name map of vocabulary,
+        loaded once per harvest job.
+        '''
+        if vocabulary_id not in self._label_maps:
+            self._label_maps[vocabulary_id] = utils.get_vocabulary_label_map(vocabulary_id)
+        return self._label_maps[vocabulary_id]
+
+
 class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
 
     _dcatapit_config = {
@@ -110,6 +195,26 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
     }
 
 
+    # (harvest job id, DCATAPITCSWConfig), see _get_job_config()
+    _job_config = (None, None,)
+
+    def _get_job_config(self, harvest_object):
+        '''
+        Returns DCATAPITCSWConfig of current source config,
+        created once per harvest job.
+        '''
+        job_id, job_config = self._job_config
+        if job_config is None or job_id != harvest_object.harvest_job_id:
+            job_config = DCATAPITCSWConfig(self.source_config, self._dcatapit_config)
+            self._job_config = (harvest_object.harvest_job_id, job_config,)
+        return job_config
+
+    def validate_config(self, source_config):
+        source_config = super(DCATAPITCSWHarvester, self).validate_config(source_config)
+        if source_config:
+            DCATAPITCSWConfig(json.loads(source_config), self._dcatapit_config)
+        return source_config
+
     def info(self):
         return {
             'name': 'DCAT_AP-IT CSW Harvester',
@@ -121,28 +226,8 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
     def get_package_dict(self, iso_values, harvest_object):
         package_dict = super(DCATAPITCSWHarvester, self).get_package_dict(iso_values, harvest_object)
 
-        mapping_frequencies_to_mdr_vocabulary = self.source_config.get('mapping_frequencies_to_mdr_vocabulary', \
-            utils._mapping_frequencies_to_mdr_vocabulary)
-        mapping_languages_to_mdr_vocabulary = self.source_config.get('mapping_languages_to_mdr_vocabulary', \
-            utils._mapping_languages_to_mdr_vocabulary)
-
-        self._ckan_locales_mapping = self.source_config.get('ckan_locales_mapping') or utils._ckan_locales_mapping
-
-        default_values = self.source_config.get('default_values') or {}
-
-        dcatapit_config = self.source_config.get('dcatapit_config', self._dcatapit_config)
-
-        #if dcatapit_config and not all(name in dcatapit_config for name in self._dcatapit_config):
-        #    dcatapit_config = self._dcatapit_config
-        #    log.warning('Some keys are missing in dcatapit_config configuration property, \
-        #        keyes to use are: dataset_theme, dataset_language, agent_code, frequency, \
-        #        agent_code_regex, org_name_regex and dcatapit_skos_theme_id. Using defaults')
-        #elif not dcatapit_config:
-        #    dcatapit_config = self._dcatapit_config
-
-        controlled_vocabularies = dcatapit_config.get('controlled_vocabularies', \
-            self._dcatapit_config.get('controlled_vocabularies'))
-        agents = dcatapit_config.get('agents', self._dcatapit_config.get('agents'))
+        job_config = self._get_job_config(harvest_object)
+        agents = job_config.agents
 
         # ------------------------------#
         #    MANDATORY FOR DCAT-AP_IT   #
@@ -157,16 +242,16 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         #  -- theme -- #
         dataset_themes = []
         if iso_values["keywords"]:
-            default_vocab_id = self._dcatapit_config.get('controlled_vocabularies').get('dcatapit_skos_theme_id')
             dataset_themes = utils.get_controlled_vocabulary_values('eu_themes', \
-                controlled_vocabularies.get('dcatapit_skos_theme_id', default_vocab_id), iso_values["keywords"])
+                job_config.theme_vocab_id, iso_values["keywords"],
+                job_config.get_vocabulary_label_map('eu_themes'))
 
         if dataset_themes:
             dataset_themes = list(set(dataset_themes))
             dataset_themes = [{'theme': str(l), 'subthemes': []} for l in dataset_themes]
 
         else:
-            dataset_themes = default_values.get('dataset_theme')
+            dataset_themes = job_config.default_values.get('dataset_theme')
 
         if isinstance(dataset_themes, (str, unicode,)):
             dataset_themes = [{'theme': dt} for dt in dataset_themes.strip('{}').split(',')]
@@ -176,8 +261,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
 
         #  -- publisher -- #
         citedResponsiblePartys = iso_values["cited-responsible-party"]
-        agent_name, agent_code = utils.get_responsible_party(citedResponsiblePartys, agents.get('publisher', \
-            self._dcatapit_config.get('agents').get('publisher')))
+        agent_name, agent_code = utils.get_responsible_party(citedResponsiblePartys, agents['publisher'])
         package_dict['extras'].append({'key': 'publisher_name', 'value': agent_name})
         package_dict['extras'].append({'key': 'publisher_identifier', 'value': agent_code or default_agent_code})
 
@@ -188,13 +272,11 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         #  -- frequency -- #
         updateFrequency = iso_values["frequency-of-update"]
         package_dict['extras'].append({'key': 'frequency', 'value': \
-            mapping_frequencies_to_mdr_vocabulary.get(updateFrequency, \
-            dcatapit_config.get('frequency', self._dcatapit_config.get('frequency')))})
+            job_config.frequency_map.get(updateFrequency, job_config.frequency)})
 
         #  -- rights_holder -- #
         citedResponsiblePartys = iso_values["cited-responsible-party"]
-        agent_name, agent_code = utils.get_responsible_party(citedResponsiblePartys, \
-            agents.get('owner', self._dcatapit_config.get('agents').get('owner')))
+        agent_name, agent_code = utils.get_responsible_party(citedResponsiblePartys, agents['owner'])
         package_dict['extras'].append({'key': 'holder_name', 'value': agent_name})
         package_dict['extras'].append({'key': 'holder_identifier', 'value': agent_code or default_agent_code})
 
@@ -211,16 +293,15 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         #  -- geographical_name  -- #
         dataset_places = []
         if iso_values["keywords"]:
-            default_vocab_id = self._dcatapit_config.get('controlled_vocabularies').get('dcatapit_skos_theme_id')
             dataset_places = utils.get_controlled_vocabulary_values('places', \
-                controlled_vocabularies.get('dcatapit_skos_places_id', default_vocab_id), iso_values["keywords"])
+                job_config.places_vocab_id, iso_values["keywords"],
+                job_config.get_vocabulary_label_map('places'))
 
         if dataset_places and len(dataset_places) > 1:
             dataset_places = list(set(dataset_places))
             dataset_places = '{' + ','.join(str(l) for l in dataset_places) + '}'
         else:
-            dataset_places = dataset_places[0] if dataset_places and len(dataset_places) > 0 else dcatapit_config.get('dataset_places', \
-                self._dcatapit_config.get('dataset_places'))
+            dataset_places = dataset_places[0] if dataset_places and len(dataset_places) > 0 else job_config.dataset_places
 
         if dataset_places:
             log.info("Medatata harvested dataset places: %r", dataset_places)
@@ -234,19 +315,18 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         if dataset_languages and len(dataset_languages) > 0:
             languages = []
             for language in dataset_languages:
-                lang = mapping_languages_to_mdr_vocabulary.get(language, None)
+                lang = job_config.language_map.get(language, None)
                 if lang:
                     languages.append(lang)
 
             if len(languages) > 1:
                 language = '{' + ','.join(str(l) for l in languages) + '}'
             else:
-                language = languages[0] if len(languages) > 0 else dcatapit_config.get('dataset_languages', \
-                    self._dcatapit_config.get('dataset_languages'))
+                language = languages[0] if len(languages) > 0 else job_config.dataset_languages
 
             log.info("Medatata harvested dataset languages: %r", language)
         else:
-            language = dcatapit_config.get('dataset_language')
+            language = job_config.dataset_language
 
         package_dict['extras'].append({'key': 'language', 'value': language})
 
@@ -272,7 +352,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         # conforms_to
         # ##################
         conforms_to_identifier = iso_values["conformity-specification-title"]
-        conforms_to_locale = self._ckan_locales_mapping.get(iso_values["metadata-language"], 'it').lower()
+        conforms_to_locale = job_config.ckan_locales_mapping.get(iso_values["metadata-language"], 'it').lower()
 
         conforms_to = {'identifier': conforms_to_identifier,
                        'title': {conforms_to_locale: conforms_to_identifier}}
@@ -284,14 +364,13 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         # ###############
         #  -- creator -- #
         citedResponsiblePartys = iso_values["cited-responsible-party"]
-        agent_name, agent_code = utils.get_responsible_party(citedResponsiblePartys, \
-            agents.get('author', self._dcatapit_config.get('agents').get('author')))
+        agent_name, agent_code = utils.get_responsible_party(citedResponsiblePartys, agents['author'])
 
         agent_code = agent_code or default_agent_code
         if (agent_name and agent_code):
             
             creator = {}
-            creator_lang = self._ckan_locales_mapping.get(iso_values["metadata-language"], 'it').lower()
+            creator_lang = job_config.ckan_locales_mapping.get(iso_values["metadata-language"], 'it').lower()
             creator['creator_name'] = {creator_lang: agent_name}
             creator['creator_identifier'] = agent_code 
             package_dict['extras'].append({'key': 'creator', 'value': json.dumps([creator])})
@@ -312,7 +391,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         if ckan_license:
             package_dict['license_id'] = ckan_license.get('id')
         else:
-            default_license = self.source_config.get('default_license')
+            default_license = job_config.default_license
             if default_license:
                 package_dict['license_id'] = default_license
 
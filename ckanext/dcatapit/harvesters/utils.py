@@ -2,8 +2,10 @@ import json
 import logging
 import re
 
+from sqlalchemy import or_
+
 from ckan.model import Session
-from ckan.model import Tag
+from ckan.model import Tag, Vocabulary
 
 from ckanext.dcatapit.model import DCATAPITTagVocabulary
 from ckanext.dcatapit.model.license import License
@@ -56,27 +58,56 @@ def get_responsible_party(citedResponsiblePartys, agent_config):
             return [name, code]
     return [None, None]
 
-def get_controlled_vocabulary_values(vocabulary_id, thesaurus_id, keywords):
+def normalize_label(label):
+    """
+    Returns label with case and whitespace normalized, to match keywords
+    with vocabulary labels.
+    """
+    return u' '.join(label.split()).lower() if label else label
+
+def get_vocabulary_label_map(vocab_id_or_name):
+    """
+    Returns dict of normalized label -> tag name, with labels in all
+    languages of tags in vocabulary, loaded with one query.
+    """
+    q = Session.query(DCATAPITTagVocabulary.text, DCATAPITTagVocabulary.tag_name)\
+               .join(Tag, Tag.id == DCATAPITTagVocabulary.tag_id)\
+               .join(Vocabulary, Vocabulary.id == Tag.vocabulary_id)\
+               .filter(or_(Vocabulary.id == vocab_id_or_name,
+                           Vocabulary.name == vocab_id_or_name))\
+               .order_by(DCATAPITTagVocabulary.tag_name)
+
+    label_map = {}
+    for text, tag_name in q:
+        label_map.setdefault(normalize_label(text), tag_name)
+    log.debug("Loaded %s labels for vocabulary %s", len(label_map), vocab_id_or_name)
+    return label_map
+
+def get_controlled_vocabulary_values(vocabulary_id, thesaurus_id, keywords, label_map=None):
+    """
+    Returns tag names of vocabulary matching keywords of given thesaurus.
+
+    :param label_map: normalized label -> tag name dict, as returned by
+                      get_vocabulary_label_map(). Pass it to avoid loading
+                      vocabulary labels in each call.
+    """
     log.debug('::::: Collecting thesaurus data for dcatapit skos {0} from the metadata keywords :::::'.format(vocabulary_id))
 
     values = []
 
-    #
-    # Get all the places tag names by the vocabulary id
-    #
-    tag_names_list = get_vocabulary_tag_names(vocabulary_id)
+    if not thesaurus_id:
+        return values
 
-    if len(tag_names_list) > 0:
+    if label_map is None:
+        label_map = get_vocabulary_label_map(vocabulary_id)
+
+    if label_map:
         for key in keywords:
-            if thesaurus_id and (thesaurus_id in key['thesaurus-identifier'] or thesaurus_id in key['thesaurus-title']):
+            if thesaurus_id in key['thesaurus-identifier'] or thesaurus_id in key['thesaurus-title']:
                 for k in key['keyword']:
-                    query = Session.query(DCATAPITTagVocabulary) \
-                        .filter(DCATAPITTagVocabulary.text==k, DCATAPITTagVocabulary.tag_name.in_(tag_names_list))
-                    query = query.autoflush(True)
-                    theme = query.first()
-
-                    if theme and theme.tag_name:
-                        values.append(theme.tag_name)
+                    tag_name = label_map.get(normalize_label(k))
+                    if tag_name:
+                        values.append(tag_name)
     return values
 
 def get_vocabulary_tag_names(vocab_id_or_name):
@@ -251,19 +251,29 @@ def get_localized_subtheme(subtheme_id, lang):
     return interfaces.get_localized_subtheme(subtheme_id, lang) or subtheme_id
 
 
+# lang -> (theme tree, rendered options), see get_dcatapit_subthemes()
+_subthemes_options = {}
+
 def get_dcatapit_subthemes(lang):
     """
     Dump subthemes tree with localized lables for all themes 
+
+    Options are rendered once for each :py:meth:`Subtheme.get_theme_tree`
+    result, and shared by all calls, so they should not be modified.
     """
+    tree = Subtheme.get_theme_tree(lang)
+    cached = _subthemes_options.get(lang)
+    if cached and cached[0] is tree:
+        return cached[1]
+
     out = {}
     def _get_name(opt_val, depth):
         return u'{} {}'.format('-'*depth, opt_val)
       
-    for theme in Subtheme.get_theme_names():
-        out[theme] = theme_l = []
-        for opt, label in Subtheme.for_theme(theme, lang):
-            theme_l.append({'name': _get_name(label, opt.depth),
-                            'value': opt.uri})
+    for theme, subthemes in tree.iteritems():
+        out[theme] = [{'name': _get_name(label, depth),
+                       'value': uri} for uri, depth, label in subthemes]
+    _subthemes_options[lang] = (tree, out,)
     return out
 
 
@@ -287,14 +297,14 @@ def load_dcatapit_subthemes(value, lang):
     """
     data = dump_dcatapit_subthemes(value)
     out = []
+    tree = Subtheme.get_theme_tree(lang)
     
     for item in data:
         localized_theme = interfaces.get_localized_tag_name(item['theme'], lang=lang)
         outitem = {'theme': localized_theme,
                    'subthemes': []}
-        from_model = Subtheme.for_theme(item['theme'], lang)
-        for st, label in from_model:
-            if st.uri in item['subthemes']:
+        for uri, depth, label in tree.get(item['theme'], ()):
+            if uri in item['subthemes']:
                 outitem['subthemes'].append(label)
         out.append(outitem)
     return out
@@ -346,3 +356,14 @@ def dataset_is_local(pkg_id):
     q = Session.query(HarvestObject).filter(HarvestObject.package_id == pkg_id).exists()
     is_remote = Session.query(q).scalar()
     return not is_remote
+
+def harvested_datasets(pkg_ids):
+    '''
+    Returns set of ids from `pkg_ids` of datasets, which were harvested.
+    '''
+    if not pkg_ids:
+        return set()
+    q = Session.query(HarvestObject.package_id)\
+               .filter(HarvestObject.package_id.in_(pkg_ids))\
+               .distinct()
+    return set(row[0] for row in q)
@@ -5,6 +5,8 @@ import ckan.lib.search as search
 from pylons import config
 from ckan.lib.base import model
 from ckan.model import Session
+from sqlalchemy import bindparam
+from sqlalchemy.orm import class_mapper
 from ckan.lib.i18n import get_lang
 
 from ckan.plugins.interfaces import Interface
@@ -29,6 +31,43 @@ def get_language():
     return lang
 
 
+# update the solr index in batches
+SOLR_INDEX_BATCH_SIZE = 50
+
+
+def _reindex_solr_packages(psi, packages):
+    """
+    Reindexes packages from their data_dict stored in Solr, without commit.
+
+    :param packages: dict of package id -> owner_org
+    """
+    def process_solr(q):
+        # update the solr index for the query
+        query = search.PackageSearchQuery()
+        q = {
+            'q': q,
+            'fl': 'data_dict',
+            'wt': 'json',
+            'fq': 'site_id:"%s"' % config.get('ckan.site_id'),
+            'rows': SOLR_INDEX_BATCH_SIZE
+        }
+
+        for result in query.run(q)['results']:
+            data_dict = json.loads(result['data_dict'])
+            if data_dict['id'] in packages and data_dict['owner_org'] == packages[data_dict['id']]:
+                psi.index_package(data_dict, defer_commit=True)
+
+    q = []
+    for package_id in packages:
+        q.append('id:"%s"' % package_id)
+        if len(q) % SOLR_INDEX_BATCH_SIZE == 0:
+            process_solr(' OR '.join(q))
+            q = []
+
+    if len(q):
+        process_solr(' OR '.join(q))
+
+
 def update_solr_package_indexes(package_dict):
     # Updating Solr Index
     if package_dict:
@@ -36,42 +75,47 @@ def update_solr_package_indexes(package_dict):
 
         # solr update here
         psi = search.PackageSearchIndex()
-
-        # update the solr index in batches
-        BATCH_SIZE = 50
-
-        def process_solr(q):
-            # update the solr index for the query
-            query = search.PackageSearchQuery()
-            q = {
-                'q': q,
-                'fl': 'data_dict',
-                'wt': 'json',
-                'fq': 'site_id:"%s"' % config.get('ckan.site_id'),
-                'rows': BATCH_SIZE
-            }
-
-            for result in query.run(q)['results']:
-                data_dict = json.loads(result['data_dict'])
-                if data_dict['owner_org'] == package_dict.get('owner_org'):
-                    psi.index_package(data_dict, defer_commit=True)
-
-        count = 0
-        q = []
-
-        q.append('id:"%s"' % (package_dict.get('id')))
-        count += 1
-        if count % BATCH_SIZE == 0:
-            process_solr(' OR '.join(q))
-            q = []
-
-        if len(q):
-            process_solr(' OR '.join(q))
+        _reindex_solr_packages(psi, {package_dict.get('id'): package_dict.get('owner_org')})
         # finally commit the changes
         psi.commit()
     else:
         log.warning("::: package_dict is None: SOLR INDEX CANNOT BE UPDATED! :::")
 
+
+class SolrIndexBuffer(object):
+    """
+    Collects packages to be reindexed in Solr, and reindexes them in
+    batches of `size` packages, with one commit per batch.
+    """
+
+    def __init__(self, size=SOLR_INDEX_BATCH_SIZE):
+        self.size = size
+        # package id -> owner_org
+        self.packages = {}
+
+    def __len__(self):
+        return len(self.packages)
+
+    def add(self, package_dict):
+        if not package_dict:
+            log.warning("::: package_dict is None: SOLR INDEX CANNOT BE UPDATED! :::")
+            return
+        self.packages[package_dict['id']] = package_dict.get('owner_org')
+        if len(self.packages) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.packages:
+            return
+        packages, self.packages = self.packages, {}
+        log.debug("::: UPDATING SOLR INDEX FOR %s PACKAGES :::", len(packages))
+        psi = search.PackageSearchIndex()
+        try:
+            _reindex_solr_packages(psi, packages)
+        finally:
+            # commit packages indexed so far even if reindexing failed
+            psi.commit()
+
 def save_extra_package_multilang(pkg, lang, field_type):
     try:
         from ckanext.multilang.model import PackageMultilang
@@ -115,6 +159,101 @@ def upsert_resource_multilang(res_id, field_name, lang, text):
         ml.text = text
         ml.save()
 
+def upsert_package_multilang_bulk(pkg_id, fields_dict, field_type='package'):
+    """
+    Sets localized fields of a dataset from a dict of dicts, i.e.:
+        {FIELDNAME:{LANG:text,...},...}
+
+    Works like upsert_package_multilang() called for each field and
+    language: empty text removes localized value, and fields or languages
+    not in fields_dict are not changed. Existing values are loaded with one
+    query, and changes are applied with one statement for each of deletes,
+    updates and inserts.
+    """
+    try:
+        from ckanext.multilang.model import PackageMultilang
+    except ImportError:
+        log.warn('DCAT-AP_IT: multilang extension not available.')
+        return
+
+    values = {}
+    for field, lang_dict in fields_dict.iteritems():
+        for lang, text in lang_dict.iteritems():
+            values[(pkg_id, field, lang,)] = text
+    _upsert_multilang_bulk(PackageMultilang, 'package_id', values, field_type=field_type)
+
+def upsert_resources_multilang_bulk(resources_dict):
+    """
+    Sets localized fields of several resources from a dict of dicts by
+    resource id, i.e.:
+        {RES_ID:{FIELDNAME:{LANG:text,...},...},...}
+
+    See upsert_package_multilang_bulk().
+    """
+    try:
+        from ckanext.multilang.model import ResourceMultilang
+    except ImportError:
+        log.warn('DCAT-AP_IT: multilang extension not available.')
+        return
+
+    values = {}
+    for res_id, fields_dict in resources_dict.iteritems():
+        for field, lang_dict in fields_dict.iteritems():
+            for lang, text in lang_dict.iteritems():
+                values[(res_id, field, lang,)] = text
+    _upsert_multilang_bulk(ResourceMultilang, 'resource_id', values)
+
+def _upsert_multilang_bulk(model_class, id_field, values, **filters):
+    """
+    Applies {(id, field, lang): text} to multilang table of model_class.
+    Additional filters (field_type) are used in query and in inserted rows.
+    """
+    if not values:
+        return
+    table = class_mapper(model_class).mapped_table
+    id_column = getattr(model_class, id_field)
+    ids = list(set(key[0] for key in values))
+
+    existing = {}
+    for idx in range(0, len(ids), MULTILANG_BATCH_SIZE):
+        q = Session.query(model_class.id, id_column, model_class.field,
+                          model_class.lang, model_class.text)\
+                   .autoflush(False)\
+                   .filter(id_column.in_(ids[idx:idx + MULTILANG_BATCH_SIZE]))
+        for name, value in filters.iteritems():
+            q = q.filter(getattr(model_class, name) == value)
+        for row_id, _id, field, lang, text in q:
+            existing[(_id, field, lang,)] = (row_id, text,)
+
+    to_delete = []
+    to_update = []
+    to_insert = []
+    for (_id, field, lang,), text in values.iteritems():
+        current = existing.get((_id, field, lang,))
+        if current is None:
+            if text:
+                row = {id_field: _id, 'field': field, 'lang': lang, 'text': text}
+                row.update(filters)
+                to_insert.append(row)
+        elif not text:
+            to_delete.append(current[0])
+        elif current[1] != text:
+            to_update.append({'_id': current[0], '_text': text})
+
+    for idx in range(0, len(to_delete), MULTILANG_BATCH_SIZE):
+        Session.execute(table.delete()
+                             .where(table.c.id.in_(to_delete[idx:idx + MULTILANG_BATCH_SIZE])))
+    if to_update:
+        Session.execute(table.update()
+                             .where(table.c.id == bindparam('_id'))
+                             .values(text=bindparam('_text')),
+                        to_update)
+    if to_insert:
+        Session.execute(table.insert(), to_insert)
+    Session.commit()
+    log.debug('Localized fields of %s: %s deleted, %s updated, %s created',
+              model_class.__name__, len(to_delete), len(to_update), len(to_insert))
+
 def update_extra_package_multilang(extra, pkg_id, field, lang, field_type='extra'):
     try:
         from ckanext.multilang.model import PackageMultilang
@@ -216,6 +355,64 @@ def get_for_resource(res_id):
     records = ResourceMultilang.get_for_resource_id(res_id)
     return _multilang_to_dict(records)
 
+def get_for_packages(pkg_ids):
+    '''
+    Returns all the localized fields of several datasets, in a dict of
+    dicts by dataset id, i.e.:
+        {PKG_ID:{FIELDNAME:{LANG:label,...},...},...}
+
+    Records are loaded with one query for each MULTILANG_BATCH_SIZE ids.
+
+    Returns None if multilang extension not loaded.
+    '''
+
+    try:
+        from ckanext.multilang.model import PackageMultilang
+    except ImportError:
+        log.warn('DCAT-AP_IT: multilang extension not available.')
+        return None
+
+    return _multilang_to_dicts(PackageMultilang, 'package_id', pkg_ids)
+
+def get_for_resources(res_ids):
+    '''
+    Returns all the localized fields of several resources, in a dict of
+    dicts by resource id, i.e.:
+        {RES_ID:{FIELDNAME:{LANG:label,...},...},...}
+
+    Records are loaded with one query for each MULTILANG_BATCH_SIZE ids.
+
+    Returns None if multilang extension not loaded.
+    '''
+
+    try:
+        from ckanext.multilang.model import ResourceMultilang
+    except ImportError:
+        log.warn('DCAT-AP_IT: multilang extension not available.')
+        return None
+
+    return _multilang_to_dicts(ResourceMultilang, 'resource_id', res_ids)
+
+# max number of ids in one IN () clause of multilang queries
+MULTILANG_BATCH_SIZE = 500
+
+def _multilang_to_dicts(model_class, id_field, ids):
+    out = dict((_id, {}) for _id in ids if _id)
+    ids = out.keys()
+    id_column = getattr(model_class, id_field)
+
+    for idx in range(0, len(ids), MULTILANG_BATCH_SIZE):
+        batch = ids[idx:idx + MULTILANG_BATCH_SIZE]
+        by_id = {}
+        q = Session.query(model_class).autoflush(False)\
+                   .filter(id_column.in_(batch))
+        for r in q:
+            by_id.setdefault(getattr(r, id_field), []).append(r)
+        for _id, records in by_id.iteritems():
+            out[_id] = _multilang_to_dict(records)
+
+    return out
+
 def _multilang_to_dict(records):
     fields_dict = {}
 
@@ -244,6 +441,7 @@ def persist_tag_multilang(name, lang, localized_text, vocab_name):
 
             try:
                 tag.save()
+                DCATAPITTagVocabulary.reset_labels()
                 log.info('::::::::: OBJECT TAG UPDATED SUCCESSFULLY :::::::::')
                 pass
             except Exception, e:
@@ -267,16 +465,15 @@ def get_localized_tag_name(tag_name=None, fallback_lang=None, lang=None):
         if lang is None:
             lang = get_language()
 
-        localized_tag_name = DCATAPITTagVocabulary.by_name(tag_name, lang)
+        localized_tag_name = DCATAPITTagVocabulary.get_label(tag_name, lang)
 
         if localized_tag_name:
-            return localized_tag_name.text
+            return localized_tag_name
         else:
             if fallback_lang:
-                fallback_name = DCATAPITTagVocabulary.by_name(tag_name, fallback_lang)
+                fallback_name = DCATAPITTagVocabulary.get_label(tag_name, fallback_lang)
 
                 if fallback_name:
-                    fallback_name = fallback_name.text
                     return fallback_name
                 else:
                     return tag_name
@@ -286,7 +483,7 @@ def get_localized_tag_name(tag_name=None, fallback_lang=None, lang=None):
         return None
 
 def get_all_localized_tag_labels(tag_name):
-    return DCATAPITTagVocabulary.all_by_name(tag_name)
+    return DCATAPITTagVocabulary.get_all_labels(tag_name)
 
 def get_resource_licenses_tree(value, lang):
     options = License.for_select(lang)
@@ -8,6 +8,7 @@ from ckan.lib.base import config
 from ckan.plugins import toolkit
 from ckan.model import Session, repo
 from ckan.model.group import Group, Member
+from sqlalchemy import or_
 
 log = logging.getLogger(__name__)
 
@@ -71,6 +72,10 @@ def _load_mapping_data():
     if not os.path.exists(fpath):
         log.warning("Mapping themes in %s doesn't exist", fpath)
         return
+    return _get_cached_file(fpath, _read_mapping_data)
+
+
+def _read_mapping_data(fpath):
     base, ext = os.path.splitext(fpath)
     if ext == '.json':
         handler = _map_themes_json
@@ -83,6 +88,37 @@ def _load_mapping_data():
         return map_data
 
 
+# (loader, path) -> ((mtime, size), data), see _get_cached_file()
+_file_cache = {}
+
+
+def _get_cached_file(fpath, loader):
+    """
+    Returns data parsed from file with loader(fpath). Data is cached
+    in process, and parsed again only if file's mtime or size changes.
+
+    Cached data is shared, so it should not be modified by callers.
+    """
+    key = (loader, os.path.abspath(fpath),)
+    try:
+        stat = os.stat(fpath)
+    except OSError, err:
+        log.warning("Cannot read mapping file %s: %s", fpath, err)
+        _file_cache.pop(key, None)
+        return
+    file_version = (stat.st_mtime, stat.st_size,)
+    cached = _file_cache.get(key)
+    if cached and cached[0] == file_version:
+        return cached[1]
+    data = loader(fpath)
+    _file_cache[key] = (file_version, data,)
+    return data
+
+
+def clear_mapping_cache():
+    _file_cache.clear()
+
+
 def _get_new_themes(from_groups, map_data, add_existing=True):
     if not from_groups:
         return
@@ -102,25 +138,64 @@ def _get_new_themes(from_groups, map_data, add_existing=True):
         return
     return list(set(new_themes))
 
-def map_nonconformant_groups(harvest_object):
+def map_nonconformant_groups(harvest_object=None, pkg_dict=None):
     """
     Adds themes to fetched data
+
+    Works either on harvest_object, which content is decoded and
+    updated, or on already decoded pkg_dict, which is updated in place,
+    so callers can decode and encode content once for all mappings.
+
+    :param harvest_object:
+    :param pkg_dict:
+    :type harvest_object: HarvestObject model
+    :type pkg_dict: dict dictized dataset
+
+    :return: dataset's dict with mapped themes
+    :rtype: dict with dictized dataset
+    """
+    if (harvest_object is None) == (pkg_dict is None):
+        raise ValueError("You should provide either harvest_object or pkg_dict")
+
+    if harvest_object is not None:
+        data = json.loads(harvest_object.content)
+    else:
+        data = pkg_dict
+
+    if not _map_groups_to_themes(data) or harvest_object is None:
+        return data
+
+    harvest_object.content = json.dumps(data)
+    Session.add(harvest_object)
+    try:
+        rev = Session.revision
+    except AttributeError:
+        rev = None
+    Session.flush()
+    Session.revision = rev
+    return data
+
+
+def _map_groups_to_themes(data):
+    """
+    Sets themes mapped from groups in dataset dict.
+
+    :returns: True if dataset dict was changed
     """
     themes_data = _load_mapping_data()
     if not themes_data:
-        return
+        return False
 
-    data = json.loads(harvest_object.content)
     _groups = data.get('groups')
     if not _groups:
-        return
+        return False
     
     groups = [g['name'] for g in _groups]
     groups.extend([g['display_name'] for g in _groups if 'display_name' in g])
 
     new_themes = _get_new_themes(groups, themes_data, add_existing=False)
     if not new_themes:
-        return
+        return False
 
     # ensure themes are upper-case, otherwise will be discarded
     # by validators
@@ -137,15 +212,7 @@ def map_nonconformant_groups(harvest_object):
         extra.append(tdata)
     data['extras'] = extra
     data['theme'] = tdata['value']
-
-    harvest_object.content = json.dumps(data)
-    Session.add(harvest_object)
-    try:
-        rev = Session.revision
-    except AttributeError:
-        rev = None
-    Session.flush()
-    Session.revision = rev
+    return True
     
 
 """
@@ -198,7 +265,8 @@ DCATAPIT_THEME_TO_MAPPING_ADD_NEW_GROUPS = 'ckanext.dcatapit.theme_group_mapping
 
 def get_theme_to_groups():
     """
-    Returns dictionary with groups for themes
+    Returns dictionary with groups for themes. Mapping file is parsed
+    again only if it changes.
     """
     fname = config.get(DCATAPIT_THEME_TO_MAPPING_SOURCE)
     if not fname:
@@ -206,59 +274,95 @@ def get_theme_to_groups():
     if not os.path.exists(fname):
         log.warning("Cannot parse theme mapping, no such file: %s", fname)
         return
-    return import_theme_to_group(fname)
+    return _get_cached_file(fname, _read_theme_to_groups)
 
 
-def _clean_groups(package):
+def _read_theme_to_groups(fname):
     """
-    Clears package's groups
+    Returns theme to groups mapping with group names cleaned up,
+    as dict of theme -> tuple of unique group names
     """
-    if isinstance(package, dict):
-        package_id = package['id']
-    else:
-        package_id = package.id
-    Session.query(Member).filter(Member.table_name == 'package',
-                                 Member.table_id == package_id,
-                                 Member.capacity != 'admin')\
-                         .update({'state':'deleted'})
+    theme_map = import_theme_to_group(fname)
+    if theme_map is None:
+        return
+    out = {}
+    for theme, groups in theme_map.iteritems():
+        names = []
+        for gname in groups:
+            gname = gname.strip()
+            if gname and gname not in names:
+                names.append(gname)
+        out[theme] = tuple(names)
+    return out
 
 
-def _add_groups(package_id, groups):
+def _get_groups(names, add_new=False):
     """
-    Adds groups to package
+    Returns list of groups with given names, loaded with one query.
+
+    Groups created within current session are used too, because new,
+    unflushed objects are not accessible by Session.query. If add_new
+    is True, missing groups are created.
     """
-    for g in groups:
-        if g.id is None:
-            raise ValueError("No id in group %s" % g)
-
-        q = Session.query(Member).filter_by(state='active',
-                                           table_id=package_id,
-                                           group_id=g.id,
-                                           table_name='package')
-        # this group is already added to package, skipping
-        # note: this will work with groups flushed to db
-        if Session.query(q.exists()).scalar():
-            continue
-        
-        member = Member(state='active',
-                        table_id=package_id,
-                        group_id=g.id,
-                        table_name='package')
-        Session.add(member)
+    names = set(names)
+    found = {}
+    for obj in Session.new:
+        if isinstance(obj, Group) and obj.name in names:
+            found[obj.name] = obj
+
+    missing = names - set(found.keys())
+    if missing:
+        q = Session.query(Group).filter(or_(Group.name.in_(missing),
+                                            Group.id.in_(missing)))
+        for group in q:
+            found[group.name if group.name in missing else group.id] = group
+
+    if add_new:
+        for gname in names - set(found.keys()):
+            group = Group(name=gname)
+            Session.add(group)
+            found[gname] = group
+    return found.values()
 
 
-def _get_group_from_session(gname):
+def _update_groups(package_id, groups, clean_existing=False):
     """
-    If Group was created within current session, get
-    it from cache instead of db.
+    Sets package's membership in groups.
 
-    This exists because new, uncommited/unflushed objects are 
-    not accessible by Session.query.
+    Existing memberships are loaded with one query, and only the
+    difference is applied: missing memberships are added (deleted ones
+    are reactivated), and if clean_existing is True, memberships in other
+    groups (except admin capacity) are deleted. Changes are made on ORM
+    objects, so member revisions are kept, and flushed by the caller.
     """
-    for obj in Session.new:
-        if isinstance(obj, Group):
-            if obj.name == gname:
-                return obj
+    members = Session.query(Member).filter(Member.table_name == 'package',
+                                           Member.table_id == package_id)\
+                                   .all()
+    active = set(m.group_id for m in members if m.state == 'active')
+    target = set(g.id for g in groups if g.id is not None)
+
+    reactivate = {}
+    for m in members:
+        if m.state == 'active':
+            if clean_existing and m.capacity != 'admin' and m.group_id not in target:
+                m.state = 'deleted'
+        elif m.group_id in target and m.group_id not in active:
+            reactivate.setdefault(m.group_id, m)
+
+    added = 0
+    for g in groups:
+        if g.id is not None and g.id in active:
+            continue
+        member = reactivate.get(g.id) if g.id is not None else None
+        if member is not None:
+            member.state = 'active'
+        else:
+            Session.add(Member(state='active',
+                               table_id=package_id,
+                               group=g,
+                               table_name='package'))
+        added += 1
+    return added
 
 
 def populate_theme_groups(instance, clean_existing=False):
@@ -301,32 +405,18 @@ def populate_theme_groups(instance, clean_existing=False):
         if not _groups:
             continue
         all_groups = all_groups.union(set(_groups))
-    if clean_existing:
-        _clean_groups(instance)
-    groups = []
-    for gname in all_groups:
-        gname = gname.strip()
-        if not gname:
-            continue
-        group = Group.get(gname) or _get_group_from_session(gname)
-        if add_new and group is None:
-            group = Group(name=gname)
-            Session.add(group)
-        if group:
-            groups.append(group)
-    
-    if Session.new:
-        # flush to db, refresh with ids
+    names = set(gname.strip() for gname in all_groups)
+    names.discard('')
+    if not names and not clean_existing:
+        return instance
+    groups = _get_groups(names, add_new=add_new)
+    _update_groups(instance['id'], groups, clean_existing=clean_existing)
+
+    if Session.new or Session.dirty:
+        # preserve revision, since it's not a commit yet
         rev = Session.revision
         Session.flush()
         Session.revision = rev
-        groups = [(Group.get(g.name) if g.id is None else g) for g in groups]
-    _add_groups(instance['id'], set(groups))
-    
-    # preserve revision, since it's not a commit yet
-    rev = Session.revision
-    Session.flush()
-    Session.revision = rev
 
     return instance
 
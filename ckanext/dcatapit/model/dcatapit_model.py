@@ -1,15 +1,33 @@
+import re
+import time
+import uuid
+import bisect
 import logging
 
 from sqlalchemy import types, Column, Table, ForeignKey
 
-from ckan.model import Session
+from ckan.lib.base import config
+from ckan.model import Session, Tag, Vocabulary
 from ckan.model import meta
 from ckan.model.domain_object import DomainObject
+from ckan.model.system_info import get_system_info, set_system_info
 
 
 log = logging.getLogger(__name__)
 
-__all__ = ['DCATAPITTagVocabulary', 'dcatapit_vocabulary_table', 'setup']
+# system_info key with version of loaded vocabularies (labels, licenses,
+# subthemes), see vocabularies_changed()
+VOCABULARIES_VERSION_KEY = 'ckanext.dcatapit.vocabularies_version'
+
+# how often (seconds) labels version is checked
+DCATAPIT_LABELS_CHECK_INTERVAL = 'ckanext.dcatapit.vocabulary_labels.check_interval'
+LABELS_CHECK_INTERVAL = int(config.get(DCATAPIT_LABELS_CHECK_INTERVAL, 60))
+
+# separates words of labels in autocomplete index
+AUTOCOMPLETE_WORD_SEP = re.compile(r"[\s,;:.()/'-]+", re.UNICODE)
+
+__all__ = ['DCATAPITTagVocabulary', 'dcatapit_vocabulary_table', 'setup',
+           'get_vocabularies_version', 'vocabularies_changed']
 
 dcatapit_vocabulary_table = Table('dcatapit_vocabulary', meta.metadata,
     Column('id', types.Integer, primary_key=True),
@@ -40,6 +58,14 @@ def setup():
 
 
 class DCATAPITTagVocabulary(DomainObject):
+
+    # process-wide tag_name -> lang -> label table, see get_labels()
+    _labels = None
+    _labels_version = None
+    _labels_checked = 0
+    # vocabulary name -> (labels table, keys, tag names), see autocomplete()
+    _autocomplete_indexes = {}
+
     def __init__(self, tag_id=None, tag_name=None, lang=None, text=None):
         self.tag_id = tag_id
         self.tag_name = tag_name
@@ -72,6 +98,99 @@ class DCATAPITTagVocabulary(DomainObject):
         tag = query.first()
         return tag
 
+    @classmethod
+    def get_labels(cls):
+        """
+        Returns tag_name -> lang -> label mapping of all localized tags,
+        shared by whole process.
+
+        Table is loaded on first use. It's reloaded when labels are
+        changed in this process, or when vocabularies version stamp,
+        checked every LABELS_CHECK_INTERVAL seconds, was changed by
+        another process, see :py:func:`vocabularies_changed`.
+        """
+        now = time.time()
+        if cls._labels is not None and now - cls._labels_checked < LABELS_CHECK_INTERVAL:
+            return cls._labels
+
+        version = get_system_info(VOCABULARIES_VERSION_KEY)
+        cls._labels_checked = now
+        if cls._labels is None or version != cls._labels_version:
+            labels = {}
+            query = meta.Session.query(cls.tag_name, cls.lang, cls.text).autoflush(False)
+            for tag_name, lang, text in query:
+                labels.setdefault(tag_name, {})[lang] = text
+            cls._labels = labels
+            cls._labels_version = version
+        return cls._labels
+
+    @classmethod
+    def reset_labels(cls):
+        cls._labels = None
+
+    @classmethod
+    def get_label(cls, tag_name, tag_lang):
+        return cls.get_labels().get(tag_name, {}).get(tag_lang)
+
+    @classmethod
+    def get_all_labels(cls, tag_name):
+        return dict(cls.get_labels().get(tag_name) or {})
+
+    @classmethod
+    def get_autocomplete_index(cls, vocab_name):
+        """
+        Returns sorted list of lowercased tag names, labels and their
+        words, and list of tag names for each of them, for tags in
+        vocabulary.
+
+        Index is rebuilt when labels table is reloaded. Indexes are kept
+        only for existing vocabularies, an empty index is returned for
+        other names.
+        """
+        labels = cls.get_labels()
+        cached = cls._autocomplete_indexes.get(vocab_name)
+        if cached and cached[0] is labels:
+            return cached[1], cached[2]
+
+        if not vocab_name or not Vocabulary.get(vocab_name):
+            return [], []
+
+        entries = set()
+        query = meta.Session.query(Tag.name)\
+                            .join(Vocabulary, Vocabulary.id == Tag.vocabulary_id)\
+                            .filter(Vocabulary.name == vocab_name)
+        for tag_name, in query:
+            texts = [tag_name] + (labels.get(tag_name) or {}).values()
+            for text in texts:
+                text = text.lower()
+                entries.add((text, tag_name,))
+                for word in AUTOCOMPLETE_WORD_SEP.split(text):
+                    if word:
+                        entries.add((word, tag_name,))
+        entries = sorted(entries)
+        keys = [e[0] for e in entries]
+        names = [e[1] for e in entries]
+        cls._autocomplete_indexes[vocab_name] = (labels, keys, names,)
+        return keys, names
+
+    @classmethod
+    def autocomplete(cls, vocab_name, q, limit=10):
+        """
+        Returns up to `limit` names of tags from vocabulary, which name,
+        label in any language, or any word of label starts with `q`.
+        """
+        q = q.strip().lower()
+        if not q:
+            return []
+        keys, names = cls.get_autocomplete_index(vocab_name)
+        out = []
+        idx = bisect.bisect_left(keys, q)
+        while idx < len(keys) and len(out) < limit and keys[idx].startswith(q):
+            if names[idx] not in out:
+                out.append(names[idx])
+            idx += 1
+        return out
+
     @classmethod
     def persist(self, tag, lang):
         session = meta.Session
@@ -81,6 +200,7 @@ class DCATAPITTagVocabulary(DomainObject):
             ])
 
             session.commit()
+            self.reset_labels()
         except Exception, e:
             # on rollback, the same closure of state
             # as that of commit proceeds. 
@@ -91,3 +211,21 @@ class DCATAPITTagVocabulary(DomainObject):
 
 
 meta.mapper(DCATAPITTagVocabulary, dcatapit_vocabulary_table)
+
+
+def get_vocabularies_version():
+    """
+    Returns version stamp of loaded vocabularies, as seen by labels table
+    (checked every LABELS_CHECK_INTERVAL seconds).
+    """
+    DCATAPITTagVocabulary.get_labels()
+    return DCATAPITTagVocabulary._labels_version
+
+
+def vocabularies_changed():
+    """
+    Stores new vocabularies version stamp, so other processes will reload
+    labels table and drop data depending on vocabularies.
+    """
+    set_system_info(VOCABULARIES_VERSION_KEY, uuid.uuid4().hex)
+    DCATAPITTagVocabulary.reset_labels()
@@ -78,6 +78,9 @@ class License(_Base, DeclarativeBase):
     
     DEFAULT_LICENSE = "https://w3id.org/italia/controlled-vocabulary/licences/C1_Unknown"
 
+    # process-wide token -> license id mapping, see get_tokens_index()
+    _tokens_index = None
+
     @classmethod
     def get(cls, id_or_uri):
         """
@@ -194,6 +197,7 @@ class License(_Base, DeclarativeBase):
     def clear(cls):
         Session.query(LocalizedLicenseName).delete()
         Session.query(cls).delete()
+        cls.reset_tokens_index()
         
         try:
             rev = Session.revision
@@ -229,6 +233,28 @@ class License(_Base, DeclarativeBase):
                     out[t] = [l]
         return out
 
+    @classmethod
+    def get_tokens_index(cls):
+        """
+        Returns token -> license id mapping, shared by whole process.
+
+        Index is built from :py:meth:`License.get_as_tokens` on first use.
+        If several licenses match one token, id of the license with
+        the newest version is stored. Index is dropped when licenses
+        are reloaded, see :py:meth:`License.reset_tokens_index`.
+        """
+        if cls._tokens_index is None:
+            index = {}
+            for token, licenses in cls.get_as_tokens().iteritems():
+                licenses.sort(key=lambda t: t.version)
+                index[token] = licenses[-1].id
+            cls._tokens_index = index
+        return cls._tokens_index
+
+    @classmethod
+    def reset_tokens_index(cls):
+        cls._tokens_index = None
+
     @classmethod
     def find_by_token(cls, *search_for):
         """
@@ -247,20 +273,28 @@ class License(_Base, DeclarativeBase):
 
         :rtype: (License, bool,)
         """
-        # get list of token-> license mapping
-        tokenized = cls.get_as_tokens()
-
         # generate tokens from input
-        normalized_tokens = cls.generate_tokens_from_str(*search_for)
-        for token in normalized_tokens:
-            try:
-                from_tokenized = tokenized[token]
-                from_tokenized.sort(key=lambda t: t.version)
-                # return latest version
-                license = from_tokenized[-1]
-                return license, False
-            except KeyError, err:
-                pass
+        normalized_tokens = list(cls.generate_tokens_from_str(*search_for))
+
+        # index may point to licenses removed in another process/transaction,
+        # in such case it's rebuilt and lookup is repeated once
+        for attempt in range(2):
+            # get token -> license mapping (newest version per token)
+            tokenized = cls.get_tokens_index()
+            stale = False
+            for token in normalized_tokens:
+                license_id = tokenized.get(token)
+                if license_id is None:
+                    continue
+                license = cls.q().get(license_id)
+                if license is not None:
+                    return license, False
+                stale = True
+                break
+            if not stale:
+                break
+            cls.reset_tokens_index()
+
         # return default if nothing was found
         license = cls.get(cls.DEFAULT_LICENSE)
         assert license is not None
@@ -437,8 +471,10 @@ def load_from_graph(path=None, url=None):
         if parents:
             parent = parents[0]
             License.get(license).set_parent(parent)
+    License.reset_tokens_index()
 
 
 def clear_licenses():
     LocalizedLicenseName.q().delete()
     License.q().delete()
+    License.reset_tokens_index()
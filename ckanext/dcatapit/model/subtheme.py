@@ -17,6 +17,7 @@ from ckan.model import Session, Tag, Vocabulary
 from ckan.model import meta, repo
 
 from ckanext.dcatapit.model.license import _Base
+from ckanext.dcatapit.model.dcatapit_model import get_vocabularies_version
 
 
 log = logging.getLogger(__name__)
@@ -88,6 +89,12 @@ class Subtheme(_Base, DeclarativeBase):
     themes = orm.relationship(Tag, secondary=ThemeToSubtheme.__table__)
     parent = orm.relationship('Subtheme', lazy=True, uselist=False, remote_side=[id])
 
+    # (vocabularies version, theme name -> subtheme uris mapping),
+    # see get_theme_map()
+    _theme_map = None
+    # lang -> (vocabularies version, theme tree), see get_theme_tree()
+    _theme_trees = {}
+
     @classmethod
     def q(cls):
         return Session.query(cls)
@@ -232,9 +239,81 @@ class Subtheme(_Base, DeclarativeBase):
 
     @classmethod
     def for_theme_values(cls, theme, lang=None):
+        if not lang:
+            try:
+                return list(cls.get_theme_map()[theme])
+            except KeyError:
+                raise ValueError("No tag for {}".format(theme))
         q = cls.for_theme(theme, lang)
         return [i.uri for i in q]
 
+    @classmethod
+    def get_theme_map(cls):
+        """
+        Returns theme name -> tuple of subtheme uris mapping, shared by
+        whole process.
+
+        Mapping is loaded on first use, with all themes from theme
+        vocabulary, and subtheme uris in :py:meth:`Subtheme.for_theme`
+        order. It's dropped when subthemes are reloaded in this process,
+        see :py:meth:`Subtheme.reset_theme_map`, and reloaded when
+        vocabularies version changes (see :py:func:`vocabularies_changed`).
+        """
+        version = get_vocabularies_version()
+        if cls._theme_map is None or cls._theme_map[0] != version:
+            vocab = ThemeToSubtheme.get_vocabulary()
+            out = {}
+            for name, in Session.query(Tag.name).filter_by(vocabulary_id=vocab.id):
+                out[name] = []
+            q = Session.query(Tag.name, cls.uri)\
+                       .join(ThemeToSubtheme, ThemeToSubtheme.tag_id == Tag.id)\
+                       .join(cls, ThemeToSubtheme.subtheme_id == cls.id)\
+                       .filter(Tag.vocabulary_id == vocab.id)\
+                       .order_by(cls.parent_id, cls.path)
+            for name, uri in q:
+                out[name].append(uri)
+            cls._theme_map = (version, dict((k, tuple(v)) for k, v in out.iteritems()),)
+        return cls._theme_map[1]
+
+    @classmethod
+    def reset_theme_map(cls):
+        cls._theme_map = None
+
+    @classmethod
+    def get_theme_tree(cls, lang):
+        """
+        Returns theme name -> tuple of (uri, depth, label) of subthemes
+        localized in `lang`, in :py:meth:`Subtheme.for_theme` order.
+
+        Tree is loaded with one query and kept for the process, until
+        subthemes are reloaded in this process, or vocabularies version
+        changes (see :py:func:`vocabularies_changed`).
+        """
+        version = get_vocabularies_version()
+        cached = cls._theme_trees.get(lang)
+        if cached and cached[0] == version:
+            return cached[1]
+        q = Session.query(Tag.name, cls.uri, cls.depth, SubthemeLabel.label)\
+                   .join(ThemeToSubtheme, ThemeToSubtheme.tag_id == Tag.id)\
+                   .join(cls, ThemeToSubtheme.subtheme_id == cls.id)\
+                   .outerjoin(SubthemeLabel,
+                              and_(SubthemeLabel.subtheme_id == cls.id,
+                                   SubthemeLabel.lang == lang))\
+                   .order_by(Tag.name, cls.parent_id, cls.path)
+        out = {}
+        for name, uri, depth, label in q:
+            subthemes = out.setdefault(name, [])
+            # themes without labels in lang are listed, with no subthemes
+            if label is not None:
+                subthemes.append((uri, depth, label,))
+        tree = dict((k, tuple(v)) for k, v in out.iteritems())
+        cls._theme_trees[lang] = (version, tree,)
+        return tree
+
+    @classmethod
+    def reset_theme_trees(cls):
+        cls._theme_trees = {}
+
     @classmethod
     def get_theme_names(cls):
         q = Session.query(Tag.name)\
@@ -270,6 +349,8 @@ def clear_subthemes():
     SubthemeLabel.q().delete()
     ThemeToSubtheme.q().delete()
     Subtheme.q().delete()
+    Subtheme.reset_theme_map()
+    Subtheme.reset_theme_trees()
 
 
 def load_subthemes(themes, eurovoc):
@@ -277,9 +358,12 @@ def load_subthemes(themes, eurovoc):
     eurovoc_g = Graph()
     # reset vocabulary attached to mapping
     ThemeToSubtheme.vocab = None
+    Subtheme.reset_theme_map()
+    Subtheme.reset_theme_trees()
     themes_g.parse(themes)
     eurovoc_g.parse(eurovoc)
     Subtheme.map_themes(themes_g, eurovoc_g)
+    Subtheme.reset_theme_map()
 
 
 def setup_subtheme_models():
@@ -14,12 +14,15 @@ import ckanext.dcatapit.schema as dcatapit_schema
 import ckanext.dcatapit.helpers as helpers
 import ckanext.dcatapit.interfaces as interfaces
 from   ckanext.dcatapit.dcat.harvester import map_nonconformant_groups
+from   ckanext.dcatapit.dcat.cache import invalidate_fragments
+from   ckanext.dcatapit.dcat import logic as dcat_logic
 from   ckanext.dcatapit.mapping import populate_theme_groups
 from   ckanext.dcatapit.helpers import get_org_context
 from   ckanext.dcatapit.model.license import License
+from   ckanext.dcatapit.model import get_vocabularies_version
 
 from ckan.model.package import Package
-from ckan.model import Session, repo
+from ckan.model import Session, Group, repo
 
 from routes.mapper import SubMapper, Mapper as _Mapper
 
@@ -42,6 +45,9 @@ if LOCALIZED_RESOURCES_ENABLED:
 
 class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm, DefaultTranslation):
 
+    # org id -> ((revision id, vocabularies version), org values for index)
+    _org_index_cache = {}
+
     # IDatasetForm
     plugins.implements(plugins.IDatasetForm)
     
@@ -61,6 +67,9 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
     plugins.implements(plugins.IPackageController, inherit=True)
 
     plugins.implements(plugins.IFacets, inherit=True)
+
+    # IActions
+    plugins.implements(plugins.IActions)
     
     # ITranslation
     if toolkit.check_ckan_version(min_version='2.5.0'):
@@ -85,6 +94,13 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
                        ver='/1') as m:
             m.connect('/util/vocabulary/autocomplete', action='vocabulary_autocomplete',
                       conditions=GET)
+            m.connect('/util/dcatapit/subthemes', action='subthemes',
+                      conditions=GET)
+
+        map.connect('dcatapit_catalog_stream', '/catalog/stream.{_format}',
+                    controller='ckanext.dcatapit.controllers.catalog:DCATAPITCatalogController',
+                    action='stream', requirements={'_format': 'nt|ttl'},
+                    conditions=GET)
         return map
     
     # ------------- IConfigurer ---------------#
@@ -113,15 +129,8 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         # Getting custom package schema
         ##
 
-        for field in dcatapit_schema.get_custom_package_schema():
-            if 'ignore' in field and field['ignore'] == True:
-                continue
-
-            if 'couples' in field:
-                for couple in field['couples']:
-                    self.update_schema_field(schema, couple)
-            else:
-                self.update_schema_field(schema, field)
+        for field in dcatapit_schema.get_compiled_package_schema().validated_fields:
+            self.update_schema_field(schema, field)
 
         schema.update({
             'notes': [
@@ -180,15 +189,8 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         # Getting custom package schema
         ##
 
-        for field in dcatapit_schema.get_custom_package_schema():
-            if 'ignore' in field and field['ignore'] == True:
-                continue
-
-            if 'couples' in field:
-                for couple in field['couples']:
-                    self.update_show_schema_field(schema, couple)
-            else:
-                self.update_show_schema_field(schema, field)
+        for field in dcatapit_schema.get_compiled_package_schema().validated_fields:
+            self.update_show_schema_field(schema, field)
 
         schema.update({
             'notes': [
@@ -286,44 +288,42 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
             dcatapit_helpers.update(MLR.get_helpers())
         return dcatapit_helpers
 
+    # ------------- IActions ---------------#
+
+    def get_actions(self):
+        return dcat_logic.get_actions()
+
     # ------------- IPackageController ---------------#
 
     def after_create(self, context, pkg_dict):
+        invalidate_fragments(pkg_dict.get('id'))
         # During the harvest the get_lang() is not defined
         lang = interfaces.get_language()
         otype = pkg_dict.get('type')
         if lang and otype == 'dataset':
+            localized = dcatapit_schema.get_compiled_package_schema(lang).localized
             for extra in pkg_dict.get('extras') or []:
-                for field in dcatapit_schema.get_custom_package_schema():
-
-                    couples = field.get('couples', [])
-                    if couples and len(couples) > 0:
-                        for couple in couples:
-                            if extra.get('key') == couple.get('name', None) and couple.get('localized', False) == True:
-                                log.debug(':::::::::::::::Localizing custom schema field: %r', couple['name'])
-                                # Create the localized field recorcd
-                                self.create_loc_field(extra, lang, pkg_dict.get('id'))
-                    else:
-                        if extra.get('key') == field.get('name', None) and field.get('localized', False) == True:
-                            log.debug(':::::::::::::::Localizing custom schema field: %r', field['name'])
-                            # Create the localized field record
-                            self.create_loc_field(extra, lang, pkg_dict.get('id'))
+                if extra.get('key') in localized:
+                    log.debug(':::::::::::::::Localizing custom schema field: %r', extra['key'])
+                    # Create the localized field record
+                    self.create_loc_field(extra, lang, pkg_dict.get('id'))
             
 
     def after_update(self, context, pkg_dict):
+        invalidate_fragments(pkg_dict.get('id'))
         # During the harvest the get_lang() is not defined
         lang = interfaces.get_language()
         otype = pkg_dict.get('type')
 
         if lang and otype == 'dataset':             
+            localized = dcatapit_schema.get_compiled_package_schema(lang).localized
             for extra in pkg_dict.get('extras') or []:
-                for field in dcatapit_schema.get_custom_package_schema():
-                    couples = field.get('couples', [])
-                    if couples and len(couples) > 0:
-                        for couple in couples:
-                            self.update_loc_field(extra, pkg_dict.get('id'), couple, lang)
-                    else:
-                        self.update_loc_field(extra, pkg_dict.get('id'), field, lang)
+                field = localized.get(extra.get('key'))
+                if field:
+                    self.update_loc_field(extra, pkg_dict.get('id'), field, lang)
+
+    def after_delete(self, context, pkg_dict):
+        invalidate_fragments(pkg_dict.get('id'))
 
     def before_index(self, dataset_dict):
         '''
@@ -365,26 +365,51 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         dataset_dict['resource_license'] = _licenses
 
         org_id = dataset_dict['owner_org']
+        org_summary = ddict.get('organization') or {}
+        org = self._get_org_for_index(org_id, org_summary.get('revision_id')) if org_id else {}
+        for lang, region in org.get('regions', {}).items():
+            dataset_dict['organization_region_{}'.format(lang)] = region
+
+        self._update_pkg_rights_holder(dataset_dict, org=org)
+        return dataset_dict
+
+    @classmethod
+    def _get_org_for_index(cls, org_id, revision_id=None):
+        '''
+        Returns organization's title, identifier and localized region labels
+        used in indexed datasets.
+
+        Values are kept for all consecutive `before_index()` calls, until
+        organization's revision or vocabularies change, so reindexing
+        dictizes each organization once.
+        '''
+        if revision_id is None:
+            revision_id = Session.query(Group.revision_id).filter(Group.id == org_id).scalar()
+        key = (revision_id, get_vocabularies_version(),)
+        cached = cls._org_index_cache.get(org_id)
+        if cached and revision_id and cached[0] == key:
+            return cached[1]
+
         organization_show = plugins.toolkit.get_action('organization_show')
-        if org_id:
-            org = organization_show(get_org_context(), {'id': org_id,
-                                                        'include_tags': False,
-                                                        'include_users': False,
-                                                        'include_groups': False,
-                                                        'include_extras': True,
-                                                        'include_followers': False,
-                                                        'include_datasets': False,
-                                                        })
-        else:
-            org = {}
-        if org.get('region'):
+        org_dict = organization_show(get_org_context(), {'id': org_id,
+                                                         'include_tags': False,
+                                                         'include_users': False,
+                                                         'include_groups': False,
+                                                         'include_extras': True,
+                                                         'include_followers': False,
+                                                         'include_datasets': False,
+                                                         })
+        org = {'title': org_dict['title'],
+               'identifier': org_dict.get('identifier'),
+               'regions': {}}
+        if org_dict.get('region'):
 
             # multilang values
             # note region can be in {val1,val2} notation for multiple values
-            region_base = org['region']
+            region_base = org_dict['region']
             if not isinstance(region_base, (list,tuple,)):
                 region_base = region_base.strip('{}').split(',')
-            tags = {}
+            tags = org['regions']
 
             for region_name in region_base:
                 ltags = interfaces.get_all_localized_tag_labels(region_name)
@@ -393,12 +418,13 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
                         tags[tlang].append(tvalue)
                     except KeyError:
                         tags[tlang] = [tvalue]
-            
-            for lang, region in tags.items():
-                dataset_dict['organization_region_{}'.format(lang)] = region
-            
-        self._update_pkg_rights_holder(dataset_dict, org=org)
-        return dataset_dict
+
+        cls._org_index_cache[org_id] = (key, org,)
+        return org
+
+    @classmethod
+    def reset_org_index_cache(cls):
+        cls._org_index_cache = {}
 
     def before_search(self, search_params):
         '''
@@ -426,7 +452,10 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         ## ##################################################################### 
         search_dicts = search_results.get('results', [])
 
-        dcatapit_schema_fields = dcatapit_schema.get_custom_package_schema()
+        dcatapit_schema_fields = dcatapit_schema.get_compiled_package_schema().leaf_fields
+        harvested = helpers.harvested_datasets([_dict['id'] for _dict in search_dicts])
+        # owner org id -> org used for rights holder, fetched once per page
+        holder_orgs = {}
 
         for _dict in search_dicts:
             _dict_extras = _dict.get('extras', None)
@@ -436,20 +465,18 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
                 _dict['extras'] = _dict_extras
 
             for field in dcatapit_schema_fields:
-                field_couple = field.get('couples', [])
-                if len(field_couple) > 0:
-                    for couple in field_couple:
-                        self.manage_extras_for_search(couple, _dict, _dict_extras)
-                else:
-                    self.manage_extras_for_search(field, _dict, _dict_extras)
+                self.manage_extras_for_search(field, _dict, _dict_extras)
         
             # remove holder info if pkg is local, use org as a source
             # see https://github.com/geosolutions-it/ckanext-dcatapit/pull/213#issuecomment-410668740
-            _dict['dataset_is_local'] = helpers.dataset_is_local(_dict['id'])
+            _dict['dataset_is_local'] = _dict['id'] not in harvested
             if _dict['dataset_is_local']:
                 _dict.pop('holder_identifier', None)
                 _dict.pop('holder_name', None)
-            self._update_pkg_rights_holder(_dict)
+            org_id = _dict.get('owner_org')
+            if org_id and org_id not in holder_orgs and self._needs_rights_holder(_dict):
+                holder_orgs[org_id] = self._get_holder_org(org_id)
+            self._update_pkg_rights_holder(_dict, org=holder_orgs.get(org_id))
 
         return search_results
 
@@ -471,18 +498,15 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         return self._update_pkg_rights_holder(pkg_dict)
     
     def after_show(self, context, pkg_dict):
-        schema = dcatapit_schema.get_custom_package_schema()
+        date_formats = dcatapit_schema.get_compiled_package_schema().date_formats
         # quick hack on date fields that are in wrong format
-        for fdef in schema:
-            if fdef.get('type') != 'date':
-                continue
-            fname = fdef['name']
+        for fname, fformat in date_formats.iteritems():
             df_value = pkg_dict.get(fname)
             if df_value:
                 tmp_value = validators.parse_date(df_value, df_value)
                 if isinstance(tmp_value, datetime.date):
                     try:
-                        tmp_value = tmp_value.strftime(fdef.get('format') or '%d-%m-%Y')
+                        tmp_value = tmp_value.strftime(fformat or '%d-%m-%Y')
                     except ValueError, err:
                         log.warning("dataset %s, field %s: cannot reformat date for %s (from input %s): %s", 
                                     pkg_dict['name'], fname, tmp_value, df_value, err, exc_info=err)
@@ -517,6 +541,24 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
             pkg_dict.pop('holder_name', None)
         return self._update_pkg_rights_holder(pkg_dict)
 
+    def _needs_rights_holder(self, pkg_dict):
+        return pkg_dict.get('type') == 'dataset' and \
+            not (pkg_dict.get('holder_identifier') and pkg_dict.get('holder_name'))
+
+    def _get_holder_org(self, org_id):
+        get_org = toolkit.get_action('organization_show')
+        ctx = get_org_context()
+        # force multilang use
+        ctx['for_view'] = True
+        return get_org(ctx, {'id': org_id,
+                             'include_tags': False,
+                             'include_users': False,
+                             'include_groups': False,
+                             'include_extras': True,
+                             'include_followers': False,
+                             'include_datasets': False,
+                             })
+
     def _update_pkg_rights_holder(self, pkg_dict, org=None):
         if pkg_dict.get('type') != 'dataset':
             return pkg_dict
@@ -524,18 +566,7 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
             if not pkg_dict.get('owner_org'):
                 return pkg_dict
             if org is None:
-                get_org = toolkit.get_action('organization_show')
-                ctx = get_org_context()
-                # force multilang use
-                ctx['for_view'] = True
-                org = get_org(ctx, {'id': pkg_dict['owner_org'],
-                                    'include_tags': False,
-                                    'include_users': False,
-                                    'include_groups': False,
-                                    'include_extras': True,
-                                    'include_followers': False,
-                                    'include_datasets': False,
-                                    })
+                org = self._get_holder_org(pkg_dict['owner_org'])
             pkg_dict['holder_name'] = org['title']
             pkg_dict['holder_identifier'] = org.get('identifier') or None
         return pkg_dict
@@ -350,6 +350,63 @@ def get_custom_package_schema():
     package_schema.extend(get_icustomschema_fields()) 
     return package_schema
 
+
+class CompiledPackageSchema(object):
+    """
+    Package schema with lookups used by plugin hooks and profiles, so
+    they don't need to walk fields and couples for each value.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        # fields and couples, which are stored as separate values
+        self.leaf_fields = []
+        # leaf fields of fields, which are not ignored by validation
+        self.validated_fields = []
+        # localized leaf field name -> field
+        self.localized = {}
+        # date field name -> format
+        self.date_formats = {}
+        # couple name -> parent field name
+        self.couple_parent = {}
+        # names of fields, which can be moved from extras to the dataset
+        self.promotable = set()
+
+        for field in fields:
+            self.promotable.add(field['name'])
+            if field.get('type') == 'date':
+                self.date_formats[field['name']] = field.get('format')
+            couples = field.get('couples') or []
+            for couple in couples:
+                self.couple_parent[couple['name']] = field['name']
+            for leaf in couples or [field]:
+                self.leaf_fields.append(leaf)
+                if not field.get('ignore'):
+                    self.validated_fields.append(leaf)
+                if leaf.get('localized'):
+                    self.localized[leaf['name']] = leaf
+
+
+# language -> CompiledPackageSchema
+_compiled_package_schemas = {}
+
+
+def get_compiled_package_schema(lang=None):
+    """
+    Returns CompiledPackageSchema for the language, built once per process.
+    """
+    lang = lang or interfaces.get_language()
+    try:
+        return _compiled_package_schemas[lang]
+    except KeyError:
+        compiled = CompiledPackageSchema(get_custom_package_schema())
+        _compiled_package_schemas[lang] = compiled
+        return compiled
+
+
+def reset_compiled_package_schemas():
+    _compiled_package_schemas.clear()
+
 def get_custom_resource_schema():
     return [
          {
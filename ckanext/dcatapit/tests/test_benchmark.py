@@ -0,0 +1,212 @@
+"""
+Benchmarks of DCAT-AP_IT profiles' parse and serialize paths.
+
+Benchmarks are skipped unless DCATAPIT_BENCHMARK is set:
+
+    DCATAPIT_BENCHMARK=1 nosetests --ckan --with-pylons=test.ini \\
+        ckanext/dcatapit/tests/test_benchmark.py
+
+Size of the synthetic catalog can be set with DCATAPIT_BENCHMARK_DATASETS,
+DCATAPIT_BENCHMARK_DISTRIBUTIONS (per dataset), DCATAPIT_BENCHMARK_LANGUAGES,
+DCATAPIT_BENCHMARK_SUBTHEMES and DCATAPIT_BENCHMARK_CREATORS (per dataset).
+
+Each run appends one JSON line to DCATAPIT_BENCHMARK_OUTPUT (default:
+dcatapit-benchmark.json), with parameters, current commit, and for each
+step: time, throughput, number of SQL queries and max RSS of the process.
+"""
+import os
+import json
+import time
+import uuid
+import resource
+import datetime
+import subprocess
+
+import nose
+from nose.plugins.skip import SkipTest
+
+from sqlalchemy import event
+
+try:
+    from ckan.tests import helpers
+except ImportError:
+    from ckan.new_tests import helpers
+
+from ckan.model import meta
+from ckan.plugins import toolkit
+
+from ckanext.dcat.processors import RDFParser, RDFSerializer
+from ckanext.dcatapit import interfaces
+from ckanext.dcatapit.dcat.processors import DCATAPITRDFSerializer
+from ckanext.dcatapit.model.subtheme import Subtheme
+from ckanext.dcatapit.tests.utils import load_themes
+
+eq_ = nose.tools.eq_
+
+BENCHMARK_OUTPUT = os.environ.get('DCATAPIT_BENCHMARK_OUTPUT', 'dcatapit-benchmark.json')
+
+# (language code used in dataset, language used in localized fields)
+LANGUAGES = (('ITA', 'it',), ('DEU', 'de',), ('ENG', 'en',), ('FRA', 'fr',),)
+THEME = 'AGRI'
+
+
+def _param(name, default):
+    return int(os.environ.get('DCATAPIT_BENCHMARK_{}'.format(name), default))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(__file__)).strip()
+    except (OSError, subprocess.CalledProcessError,):
+        return None
+
+
+def _max_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Measure(object):
+    '''
+    Context manager, which measures time, SQL queries and memory
+    of a benchmark step.
+    '''
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+        self.queries = 0
+        self.result = None
+
+    def _count_query(self, *args, **kwargs):
+        self.queries += 1
+
+    def __enter__(self):
+        event.listen(meta.engine, 'before_cursor_execute', self._count_query)
+        self.rss = _max_rss()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        elapsed = time.time() - self.start
+        event.remove(meta.engine, 'before_cursor_execute', self._count_query)
+        self.result = {'step': self.name,
+                       'items': self.items,
+                       'seconds': elapsed,
+                       'items_per_second': self.items / elapsed if elapsed else None,
+                       'queries': self.queries,
+                       'max_rss_kb': _max_rss(),
+                       'max_rss_growth_kb': _max_rss() - self.rss,
+                       }
+
+
+def make_dataset(idx, org_id, distributions, languages, subthemes, creators):
+    '''
+    Returns synthetic DCAT-AP_IT dataset dict.
+    '''
+    suffix = uuid.uuid4().hex[:8]
+    langs = LANGUAGES[:languages]
+    return {'name': 'benchmark-{}-{}'.format(idx, suffix),
+            'title': 'Dataset benchmark {}'.format(idx),
+            'notes': 'Dataset sintetico per benchmark {}'.format(idx),
+            'identifier': 'benchmark:{}:{}'.format(idx, suffix),
+            'frequency': 'UPDATE_CONT',
+            'issued': '2016-11-29',
+            'modified': '2016-11-29',
+            'publisher_name': 'bolzano',
+            'publisher_identifier': '234234234',
+            'holder_name': 'bolzano',
+            'holder_identifier': '234234234',
+            'owner_org': org_id,
+            'language': '{%s}' % ','.join(code for code, lang in langs),
+            'theme': json.dumps([{'theme': THEME, 'subthemes': subthemes}]),
+            'creator': json.dumps([{'creator_identifier': 'creator{}'.format(c),
+                                    'creator_name': dict((lang, 'Creatore {} {}'.format(c, lang))
+                                                         for code, lang in langs)}
+                                   for c in range(creators)]),
+            'resources': [{'url': 'http://example.com/{}/file{}.csv'.format(idx, r),
+                           'name': 'Distribuzione {}'.format(r),
+                           'description': 'Distribuzione {} del dataset {}'.format(r, idx),
+                           'format': 'CSV'} for r in range(distributions)],
+            }
+
+
+def add_localized_fields(pkg_dict, languages):
+    for code, lang in LANGUAGES[:languages]:
+        for field in ('title', 'notes',):
+            interfaces.upsert_package_multilang(pkg_dict['id'], field, 'package', lang,
+                                                u'{} {}'.format(pkg_dict[field], lang))
+        for res in pkg_dict['resources']:
+            for field in ('name', 'description',):
+                interfaces.upsert_resource_multilang(res['id'], field, lang,
+                                                     u'{} {}'.format(res[field], lang))
+
+
+class TestBenchmark(object):
+
+    def setup(self):
+        if not os.environ.get('DCATAPIT_BENCHMARK'):
+            raise SkipTest('Set DCATAPIT_BENCHMARK to run benchmarks')
+
+    def test_benchmark(self):
+        params = {'datasets': _param('DATASETS', 50),
+                  'distributions': _param('DISTRIBUTIONS', 3),
+                  'languages': min(_param('LANGUAGES', 3), len(LANGUAGES)),
+                  'subthemes': _param('SUBTHEMES', 2),
+                  'creators': _param('CREATORS', 2),
+                  }
+        load_themes()
+        subthemes = list(Subtheme.for_theme_values(THEME))[:params['subthemes']]
+
+        user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+        ctx = {'ignore_auth': True, 'user': user['name']}
+        org = helpers.call_action('organization_create', context=dict(ctx),
+                                  name='benchmark-{}'.format(uuid.uuid4().hex[:8]),
+                                  title='Benchmark organization',
+                                  identifier='benchmark')
+
+        results = []
+        packages = []
+        with Measure('package_create', params['datasets']) as m:
+            for idx in range(params['datasets']):
+                pkg = make_dataset(idx, org['id'], params['distributions'], params['languages'],
+                                   subthemes, params['creators'])
+                pkg_dict = helpers.call_action('package_create', context=dict(ctx), **pkg)
+                add_localized_fields(pkg_dict, params['languages'])
+                packages.append(pkg_dict)
+        results.append(m.result)
+
+        with Measure('graph_from_catalog', 1) as m:
+            RDFSerializer().graph_from_catalog({})
+        results.append(m.result)
+
+        with Measure('graph_from_dataset', len(packages)) as m:
+            s = RDFSerializer()
+            for pkg_dict in packages:
+                s.graph_from_dataset(pkg_dict)
+        results.append(m.result)
+
+        with Measure('serialize_catalog', len(packages)) as m:
+            catalog = DCATAPITRDFSerializer().serialize_catalog({}, packages, _format='xml')
+        results.append(m.result)
+
+        p = RDFParser()
+        with Measure('parse', len(packages)) as m:
+            p.parse(catalog, _format='xml')
+        results.append(m.result)
+
+        with Measure('parse_dataset', len(packages)) as m:
+            parsed = list(p.datasets())
+        results.append(m.result)
+        eq_(len(parsed), len(packages))
+
+        report = {'date': datetime.datetime.now().isoformat(),
+                  'commit': _commit(),
+                  'params': params,
+                  'catalog_bytes': len(catalog),
+                  'results': results,
+                  }
+        with open(BENCHMARK_OUTPUT, 'a') as f:
+            f.write(json.dumps(report, sort_keys=True))
+            f.write('\n')
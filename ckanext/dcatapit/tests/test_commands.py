@@ -1,10 +1,20 @@
 
 import os
 import nose
+import shutil
+import tempfile
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ckan.model import Package, Session
 import ckanext.dcatapit.interfaces as interfaces
+from ckanext.dcatapit.model import DCATAPITTagVocabulary
 
-from ckanext.dcatapit.commands.dcatapit import DCATAPITCommands
+from ckanext.dcatapit.commands import dcatapit as dcatapit_commands
+from ckanext.dcatapit.commands.dcatapit import DCATAPITCommands, bulk_load_vocabulary
 from ckanext.dcatapit.tests.utils import load_themes, themes_loader
 
 eq_ = nose.tools.eq_
@@ -47,3 +57,112 @@ class TestDCATAPITCommand(BaseCommandTest):
 
         tag_localized = interfaces.get_localized_tag_name('ECON')
         ok_(tag_localized)
+
+    def test_vocabulary_labels(self):
+        load_themes()
+
+        labels = DCATAPITTagVocabulary.get_labels()
+        ok_(labels is DCATAPITTagVocabulary.get_labels())
+        version = DCATAPITTagVocabulary._labels_version
+        ok_(version)
+
+        eq_(interfaces.get_all_localized_tag_labels('ECON'),
+            DCATAPITTagVocabulary.all_by_name('ECON'))
+        eq_(interfaces.get_localized_tag_name('ECON', lang='it'),
+            DCATAPITTagVocabulary.by_name('ECON', 'it').text)
+        eq_(interfaces.get_localized_tag_name('not-a-tag', lang='it'), 'not-a-tag')
+
+        # another load should change version stamp and drop the table
+        load_themes()
+        ok_(DCATAPITTagVocabulary._labels is None)
+        DCATAPITTagVocabulary.get_labels()
+        ok_(DCATAPITTagVocabulary._labels_version != version)
+
+    def test_bulk_load_vocabulary(self):
+        load_themes()
+
+        labels = [{'name': 'ECON', 'lang': 'it', 'localized_text': u'Economia (nuova)'},
+                  {'name': 'ECON', 'lang': 'de', 'localized_text': interfaces.get_localized_tag_name('ECON', lang='de')},
+                  {'name': 'NEWTHEME', 'lang': 'it', 'localized_text': u'Nuovo tema'},
+                  {'name': 'NEWTHEME', 'lang': 'en', 'localized_text': u'New theme'},
+                  {'name': 'NEWTHEME', 'lang': 'xx', 'localized_text': u'Not offered'},
+                  {'name': 'not a tag!', 'lang': 'it', 'localized_text': u'Invalid tag'},
+                  ]
+        stats = bulk_load_vocabulary('eu_themes', ['ECON', 'NEWTHEME', 'not a tag!'], labels)
+        eq_(stats['tags_created'], 1)
+        eq_(stats['tags_skipped'], 1)
+        eq_(stats['labels_created'], 2)
+        eq_(stats['labels_updated'], 1)
+        eq_(stats['labels_unchanged'], 1)
+        eq_(stats['labels_skipped'], 1)
+
+        DCATAPITTagVocabulary.reset_labels()
+        eq_(interfaces.get_localized_tag_name('ECON', lang='it'), u'Economia (nuova)')
+        eq_(interfaces.get_localized_tag_name('NEWTHEME', lang='en_GB'), u'New theme')
+
+        # nothing changes on the same load
+        stats = bulk_load_vocabulary('eu_themes', ['ECON', 'NEWTHEME'], labels[:4])
+        eq_(stats['tags_created'], 0)
+        eq_(stats['labels_created'], 0)
+        eq_(stats['labels_updated'], 0)
+        # stored labels missing in the load are not counted
+        eq_(stats['labels_unchanged'], 4)
+
+    def test_vocabulary_autocomplete(self):
+        load_themes()
+
+        # tag name, label and words of label
+        ok_('AGRI' in DCATAPITTagVocabulary.autocomplete('eu_themes', 'agr'))
+        ok_('AGRI' in DCATAPITTagVocabulary.autocomplete('eu_themes', 'Agricoltura'))
+        ok_('AGRI' in DCATAPITTagVocabulary.autocomplete('eu_themes', 'pesca'))
+        ok_('ENVI' in DCATAPITTagVocabulary.autocomplete('eu_themes', 'ambi'))
+        eq_(DCATAPITTagVocabulary.autocomplete('eu_themes', 'a', limit=2),
+            DCATAPITTagVocabulary.autocomplete('eu_themes', 'a')[:2])
+        eq_(DCATAPITTagVocabulary.autocomplete('eu_themes', 'not-a-label'), [])
+        eq_(DCATAPITTagVocabulary.autocomplete('not-a-vocabulary', 'agr'), [])
+        eq_(DCATAPITTagVocabulary.autocomplete('None', 'agr'), [])
+        # indexes are not kept for unknown vocabularies
+        ok_('not-a-vocabulary' not in DCATAPITTagVocabulary._autocomplete_indexes)
+        ok_('None' not in DCATAPITTagVocabulary._autocomplete_indexes)
+        ok_('eu_themes' in DCATAPITTagVocabulary._autocomplete_indexes)
+
+        keys, names = DCATAPITTagVocabulary.get_autocomplete_index('eu_themes')
+        eq_(keys, sorted(keys))
+        load_themes()
+        ok_(DCATAPITTagVocabulary.get_autocomplete_index('eu_themes')[0] is not keys)
+
+    def test_migrate_data_checkpoint(self):
+        pkgs = [Package(name='migrate-checkpoint-{}'.format(idx),
+                        title='Migrate checkpoint {}'.format(idx),
+                        type='dataset', state='active') for idx in range(3)]
+        for pkg in pkgs:
+            Session.add(pkg)
+        Session.commit()
+        # migration removes current session, so keep plain values
+        pkgs = [(pkg.id, pkg.name,) for pkg in pkgs]
+        ids = set(pid for pid, pname in pkgs)
+
+        tmp_dir = tempfile.mkdtemp()
+        checkpoint = os.path.join(tmp_dir, 'checkpoint')
+        try:
+            eq_(dcatapit_commands.read_migration_checkpoint(checkpoint), set())
+
+            def fail_first(pname):
+                if pname == pkgs[0][1]:
+                    raise ValueError('migration failed')
+
+            with mock.patch.object(dcatapit_commands, 'migrate_package', side_effect=fail_first):
+                dcatapit_commands.do_migrate_data(skip_orgs=True, checkpoint=checkpoint)
+            done = dcatapit_commands.read_migration_checkpoint(checkpoint)
+            eq_(done & ids, ids - set([pkgs[0][0]]))
+
+            # resumed migration processes only packages not in checkpoint
+            with mock.patch.object(dcatapit_commands, 'migrate_package') as migrate_package:
+                dcatapit_commands.do_migrate_data(skip_orgs=True, checkpoint=checkpoint)
+            migrated = set(call[0][0] for call in migrate_package.call_args_list)
+            ok_(pkgs[0][1] in migrated)
+            ok_(pkgs[1][1] not in migrated)
+            ok_(pkgs[2][1] not in migrated)
+            ok_(ids <= dcatapit_commands.read_migration_checkpoint(checkpoint))
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -1,6 +1,8 @@
 import os
 import uuid
 import json
+import shutil
+import tempfile
 from datetime import datetime
 import uuid
 
@@ -23,7 +25,7 @@ from ckan.logic import schema
 from ckan.tests.helpers import call_action, change_config
 from ckan.model import meta, repo
 from ckan.model.user import User
-from ckan.model.group import Group
+from ckan.model.group import Group, Member
 from ckan.model.package import Package
 
 
@@ -34,11 +36,13 @@ except ImportError:
 
 from ckanext.dcat.processors import RDFParser, RDFSerializer
 from ckanext.dcatapit.dcat.profiles import (DCATAPIT)
+from ckanext.dcatapit.dcat.processors import StreamingRDFParser
 from ckanext.dcatapit import  validators
 
 from ckanext.dcat.profiles import (DCAT, DCT, FOAF, OWL)
 
-from ckanext.dcatapit.mapping import DCATAPIT_THEMES_MAP, map_nonconformant_groups
+from ckanext.dcatapit.mapping import (DCATAPIT_THEMES_MAP, map_nonconformant_groups, get_theme_to_groups,
+                                      populate_theme_groups)
 from ckanext.dcatapit.mapping import DCATAPIT_THEME_TO_MAPPING_SOURCE, DCATAPIT_THEME_TO_MAPPING_ADD_NEW_GROUPS
 from ckanext.dcatapit.harvesters.ckanharvester import CKANMappingHarvester
 from ckanext.harvest.model import HarvestObject
@@ -55,6 +59,19 @@ ok_ = nose.tools.ok_
 assert_true = nose.tools.assert_true
 
 
+def _unordered(value):
+    if isinstance(value, basestring) and value.startswith('['):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    if isinstance(value, dict):
+        return dict((k, _unordered(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple,)):
+        return sorted(json.dumps(_unordered(v), sort_keys=True) for v in value)
+    return value
+
+
 class BaseParseTest(object):
 
     def _extras(self, dataset):
@@ -209,6 +226,12 @@ class TestDCATAPITProfileParsing(BaseParseTest):
         hdata = json.loads(harvest_obj.content)
         eq_([t for t in hdata.get('extras', []) if t['key'] == 'theme'], groups_mappable[1])
 
+        # mapping of decoded dict
+        pkg_dict = {'groups': groups_mappable[0], 'extras': []}
+        ok_(map_nonconformant_groups(pkg_dict=pkg_dict) is pkg_dict)
+        eq_(pkg_dict['extras'], groups_mappable[1])
+        eq_(pkg_dict['theme'], 'AGRI')
+
 
 
     def _make_harvest_object(self, mock_url, groups):
@@ -405,8 +428,47 @@ class TestDCATAPITProfileParsing(BaseParseTest):
         assert len(expected_groups_multi) == len(groups), (expected_groups_multi, 'vs', groups,)
         assert set(expected_groups_multi) == set(groups), (expected_groups_multi, 'vs', groups,)
 
+        # memberships in groups not mapped from themes are removed
+        populate_theme_groups({'id': package_data['id'],
+                               'extras': [{'key': 'theme', 'value': ['thememap1']}]},
+                              clean_existing=True)
+        p = Package.get(package_data['id'])
+        groups = [g.name for g in p.get_groups(group_type='group')]
+        assert set(expected_groups_new) == set(groups), (expected_groups_new, 'vs', groups,)
+
+        # removed membership is reactivated, not duplicated
+        populate_theme_groups({'id': package_data['id'],
+                               'extras': [{'key': 'theme', 'value': ['thememap-multi']}]})
+        other = Group.get('othergroup')
+        members = meta.Session.query(Member).filter(Member.table_id == package_data['id'],
+                                                    Member.group_id == other.id).all()
+        eq_([m.state for m in members], ['active'])
+
         meta.Session.rollback()
 
+    def test_mapping_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        map_file = os.path.join(tmp_dir, 'theme_map.ini')
+        try:
+            with open(map_file, 'w') as f:
+                f.write('[dcatapit:theme_group_mapping]\nthememap1 = somegroup1,\n    somegroup2 , somegroup1\n')
+            config[DCATAPIT_THEME_TO_MAPPING_SOURCE] = map_file
+
+            theme_map = get_theme_to_groups()
+            eq_(theme_map, {'thememap1': ('somegroup1', 'somegroup2',)})
+            # file not changed, parsed mapping is reused
+            ok_(get_theme_to_groups() is theme_map)
+
+            with open(map_file, 'w') as f:
+                f.write('[dcatapit:theme_group_mapping]\nthememap1 = othergroup\n')
+            eq_(get_theme_to_groups(), {'thememap1': ('othergroup',)})
+
+            os.remove(map_file)
+            eq_(get_theme_to_groups(), None)
+        finally:
+            config[DCATAPIT_THEME_TO_MAPPING_SOURCE] = ''
+            shutil.rmtree(tmp_dir)
+
     def test_license(self):
         
         def get_path(fname):
@@ -784,3 +846,44 @@ class TestDCATAPITProfileParsing(BaseParseTest):
                         if not lang_hit:
                             lang_hit = pname == lname.value
                 assert lang_hit, "There should be lang hit"
+
+    def test_parse_graph_index(self):
+
+        contents = self._get_file_contents('catalog_dati_unibo.rdf')
+
+        def _parse():
+            p = RDFParser(profiles=['euro_dcat_ap', 'it_dcat_ap'])
+            p.parse(contents)
+            return [d for d in p.datasets()]
+
+        with mock.patch('ckanext.dcatapit.dcat.profiles.PARSE_GRAPH_INDEX_ENABLED', False):
+            without_index = _parse()
+        with mock.patch('ckanext.dcatapit.dcat.profiles.PARSE_GRAPH_INDEX_ENABLED', True):
+            with_index = _parse()
+
+        assert len(with_index) > 1
+        eq_(with_index, without_index)
+
+    def test_parse_streaming(self):
+
+        contents = self._get_file_contents('catalog_dati_unibo.rdf')
+
+        p = RDFParser(profiles=['euro_dcat_ap', 'it_dcat_ap'])
+        p.parse(contents)
+        in_memory = sorted(p.datasets(), key=lambda d: d['identifier'])
+
+        p = StreamingRDFParser(profiles=['euro_dcat_ap', 'it_dcat_ap'])
+        p.parse(contents)
+        # only paging info is kept in parser's graph
+        eq_(len(p.g), 0)
+        streamed = sorted(p.datasets(), key=lambda d: d['identifier'])
+
+        assert len(streamed) > 1
+        # rdflib memory store doesn't keep order of multi-valued
+        # properties, so lists are compared as sets
+        eq_([_unordered(d) for d in streamed], [_unordered(d) for d in in_memory])
+
+        # each dataset graph contains its own dataset only
+        for key in p._datasets_order:
+            g = p.dataset_graph(key)
+            eq_(list(g.subjects(RDF.type, DCAT.Dataset)), [URIRef(key)])
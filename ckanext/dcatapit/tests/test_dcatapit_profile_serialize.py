@@ -1,11 +1,19 @@
+import os
 import json
+import shutil
+import tempfile
 
 import nose
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from pylons import config
 
 from dateutil.parser import parse as parse_date
-from rdflib import URIRef, BNode, Literal
+from rdflib import Graph, URIRef, BNode, Literal
+from rdflib.compare import isomorphic
 from rdflib.namespace import RDF
 
 from geomet import wkt
@@ -21,7 +29,10 @@ from ckanext.dcat import utils
 from ckanext.dcat.processors import RDFSerializer
 from ckanext.dcat.profiles import (DCAT, DCT, ADMS, XSD, VCARD, FOAF, SCHEMA,
                                    SKOS, LOCN, GSP, OWL, SPDX, GEOJSON_IMT)
-from ckanext.dcatapit.dcat.profiles import (DCATAPIT)
+from ckanext.dcatapit.dcat.profiles import (DCATAPIT, ItalianDCATAPProfile)
+from ckanext.dcatapit.dcat.processors import DCATAPITRDFSerializer
+from ckanext.dcatapit.dcat import cache as rdf_cache
+from ckanext.dcatapit.dcat import logic as dcat_logic
 from ckanext.dcatapit.validators import parse_date as pdate
 from ckanext.dcatapit import interfaces
 
@@ -370,3 +381,361 @@ class TestDCATAPITProfileSerializeDataset(BaseSerializeTest):
                                                                                            test_id,
                                                                                            pkg,
                                                                                            s.serialize_dataset(pkg))
+
+    def test_organization_cache(self):
+        org = {'name': 'org-cache-test',
+               'title': 'Test org cache',
+               'identifier': 'cache123'}
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        org_dict = helpers.call_action('organization_create', context=ctx, **org)
+        packages = []
+        for idx in range(3):
+            pkg = {'name': 'test-org-cache-{}'.format(idx),
+                   'title': 'Dataset di test {}'.format(idx),
+                   'notes': 'dcatapit dataset di test',
+                   'identifier': 'ISBNcache{}'.format(idx),
+                   'frequency': 'UPDATE_CONT',
+                   'publisher_name': 'bolzano',
+                   'publisher_identifier': '234234234',
+                   'theme': '{ECON,ENVI}',
+                   'dataset_is_local': True,
+                   'language': '{DEU,ENG,ITA}',
+                   'owner_org': org_dict['id'],
+                   }
+            packages.append(helpers.call_action('package_create', context=ctx, **pkg))
+
+        org_show = mock.Mock(wraps=toolkit.get_action('organization_show'))
+        get_action = toolkit.get_action
+
+        def _get_action(name):
+            # only calls of organization_show are counted
+            if name == 'organization_show':
+                return org_show
+            return get_action(name)
+
+        get_localized = mock.Mock(wraps=interfaces.get_for_group_or_organization)
+        with mock.patch('ckanext.dcatapit.dcat.profiles.logic.get_action', _get_action), \
+                mock.patch('ckanext.dcatapit.dcat.profiles.interfaces.get_for_group_or_organization', get_localized):
+            s = RDFSerializer()
+            for pkg in packages:
+                dataset_ref = s.graph_from_dataset(pkg)
+                holders = list(s.g.objects(dataset_ref, DCT.rightsHolder))
+                eq_(len(holders), 1)
+
+            # organization is fetched once per serialization
+            eq_(org_show.call_count, 1)
+            eq_(get_localized.call_count, 1)
+
+            s = RDFSerializer()
+            s.graph_from_dataset(packages[0])
+            eq_(org_show.call_count, 2)
+
+    def test_catalog_multilang_prefetch(self):
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        packages = []
+        for idx in range(3):
+            pkg = {'name': 'test-prefetch-{}'.format(idx),
+                   'title': 'Dataset di test {}'.format(idx),
+                   'notes': 'dcatapit dataset di test',
+                   'identifier': 'ISBNprefetch{}'.format(idx),
+                   'frequency': 'UPDATE_CONT',
+                   'publisher_name': 'bolzano',
+                   'publisher_identifier': '234234234',
+                   'holder_name': 'bolzano',
+                   'holder_identifier': '234234234',
+                   'theme': '{ECON,ENVI}',
+                   'language': '{DEU,ENG,ITA}',
+                   'resources': [{'url': 'http://test.com/file{}.csv'.format(r),
+                                  'name': 'resource {}'.format(r),
+                                  'format': 'CSV'} for r in range(2)],
+                   }
+            packages.append(helpers.call_action('package_create', context=ctx, **pkg))
+
+        get_for_package = mock.Mock(wraps=interfaces.get_for_package)
+        get_for_resource = mock.Mock(wraps=interfaces.get_for_resource)
+        get_for_packages = mock.Mock(wraps=interfaces.get_for_packages)
+        get_for_resources = mock.Mock(wraps=interfaces.get_for_resources)
+        with mock.patch.multiple('ckanext.dcatapit.dcat.profiles.interfaces',
+                                 get_for_package=get_for_package,
+                                 get_for_resource=get_for_resource,
+                                 get_for_packages=get_for_packages,
+                                 get_for_resources=get_for_resources):
+            s = DCATAPITRDFSerializer()
+            s.serialize_catalog({}, packages)
+
+        eq_(get_for_packages.call_count, 1)
+        eq_(get_for_resources.call_count, 1)
+        eq_(get_for_package.call_count, 0)
+        eq_(get_for_resource.call_count, 0)
+
+        prefetched = interfaces.get_for_packages([p['id'] for p in packages])
+        for pkg in packages:
+            eq_(prefetched[pkg['id']], interfaces.get_for_package(pkg['id']))
+        res_ids = [r['id'] for p in packages for r in p['resources']]
+        prefetched = interfaces.get_for_resources(res_ids)
+        for res_id in res_ids:
+            eq_(prefetched[res_id], interfaces.get_for_resource(res_id))
+
+    def test_catalog_fragments_cache(self):
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        packages = []
+        for idx in range(2):
+            pkg = {'name': 'test-fragments-{}'.format(idx),
+                   'title': 'Dataset di test {}'.format(idx),
+                   'notes': 'dcatapit dataset di test',
+                   'identifier': 'ISBNfragments{}'.format(idx),
+                   'frequency': 'UPDATE_CONT',
+                   'publisher_name': 'bolzano',
+                   'publisher_identifier': '234234234',
+                   'holder_name': 'bolzano',
+                   'holder_identifier': '234234234',
+                   'theme': '{ECON,ENVI}',
+                   'language': '{DEU,ENG,ITA}',
+                   'resources': [{'url': 'http://test.com/file.csv',
+                                  'name': 'resource',
+                                  'format': 'CSV'}],
+                   }
+            packages.append(helpers.call_action('package_create', context=ctx, **pkg))
+
+        def serialize(pkgs):
+            s = DCATAPITRDFSerializer()
+            with mock.patch.object(ItalianDCATAPProfile, 'graph_from_dataset', autospec=True,
+                                   side_effect=ItalianDCATAPProfile.graph_from_dataset) as gfd:
+                s.serialize_catalog({}, pkgs)
+            return s.g, gfd.call_count
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(rdf_cache, 'RDF_CACHE_DIR', cache_dir):
+                g, calls = serialize(packages)
+                eq_(calls, len(packages))
+                cached_g, calls = serialize(packages)
+                eq_(calls, 0)
+                eq_(len(cached_g), len(g))
+                for pkg in packages:
+                    dataset_ref = URIRef(utils.dataset_uri(pkg))
+                    eq_(set(cached_g.objects(dataset_ref, DCT.title)),
+                        set(g.objects(dataset_ref, DCT.title)))
+
+                updated = helpers.call_action('package_patch', context=ctx,
+                                              id=packages[0]['id'],
+                                              title='Dataset aggiornato')
+                packages[0] = updated
+                g, calls = serialize(packages)
+                eq_(calls, 1)
+                dataset_ref = URIRef(utils.dataset_uri(updated))
+                assert_true(u'Dataset aggiornato' in
+                            [unicode(o) for o in g.objects(dataset_ref, DCT.title)])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_catalog_streaming(self):
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        packages = []
+        for idx in range(3):
+            pkg = {'name': 'test-streaming-{}'.format(idx),
+                   'title': 'Dataset di test {}'.format(idx),
+                   'notes': 'dcatapit dataset di test',
+                   'identifier': 'ISBNstreaming{}'.format(idx),
+                   'frequency': 'UPDATE_CONT',
+                   'publisher_name': 'bolzano',
+                   'publisher_identifier': '234234234',
+                   'holder_name': 'bolzano',
+                   'holder_identifier': '234234234',
+                   'theme': '{ECON,ENVI}',
+                   'language': '{DEU,ENG,ITA}',
+                   'resources': [{'url': 'http://test.com/file.csv',
+                                  'name': 'resource',
+                                  'format': 'CSV'}],
+                   }
+            packages.append(helpers.call_action('package_create', context=ctx, **pkg))
+
+        for _format in ('nt', 'turtle',):
+            expected = Graph()
+            expected.parse(data=DCATAPITRDFSerializer().serialize_catalog({}, packages, _format=_format),
+                           format=_format)
+
+            s = DCATAPITRDFSerializer()
+            chunks = list(s.serialize_catalog_iter({}, iter(packages), _format=_format))
+            eq_(len(chunks), len(packages) + 1)
+            g = Graph()
+            g.parse(data=''.join(chunks), format=_format)
+            assert_true(isomorphic(g, expected))
+
+    def test_catalog_show_action(self):
+        if not hasattr(toolkit, 'chained_action'):
+            raise nose.SkipTest('DCAT actions are overridden since CKAN 2.7')
+
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        for idx in range(2):
+            pkg = {'name': 'test-catalog-show-{}'.format(idx),
+                   'title': 'Dataset di test {}'.format(idx),
+                   'notes': 'dcatapit dataset di test',
+                   'identifier': 'ISBNcatalogshow{}'.format(idx),
+                   'frequency': 'UPDATE_CONT',
+                   'publisher_name': 'bolzano',
+                   'publisher_identifier': '234234234',
+                   'holder_name': 'bolzano',
+                   'holder_identifier': '234234234',
+                   'theme': '{ECON,ENVI}',
+                   'language': '{DEU,ENG,ITA}',
+                   'resources': [{'url': 'http://test.com/file.csv',
+                                  'name': 'resource',
+                                  'format': 'CSV'}],
+                   }
+            helpers.call_action('package_create', context=ctx, **pkg)
+
+        get_for_package = mock.Mock(wraps=interfaces.get_for_package)
+        get_for_packages = mock.Mock(wraps=interfaces.get_for_packages)
+        with mock.patch.multiple('ckanext.dcatapit.dcat.profiles.interfaces',
+                                 get_for_package=get_for_package,
+                                 get_for_packages=get_for_packages):
+            output = helpers.call_action('dcat_catalog_show', format='xml')
+
+        eq_(get_for_packages.call_count, 1)
+        eq_(get_for_package.call_count, 0)
+
+        g = Graph()
+        g.parse(data=output, format='xml')
+        assert_true(len(list(g.subjects(RDF.type, DCAT.Dataset))) >= 2)
+
+    def test_catalog_show_action_fragments_cache(self):
+        if not hasattr(toolkit, 'chained_action'):
+            raise nose.SkipTest('DCAT actions are overridden since CKAN 2.7')
+
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        pkg = {'name': 'test-action-fragments',
+               'title': 'Dataset di test',
+               'notes': 'dcatapit dataset di test',
+               'identifier': 'ISBNactionfragments',
+               'frequency': 'UPDATE_CONT',
+               'publisher_name': 'bolzano',
+               'publisher_identifier': '234234234',
+               'holder_name': 'bolzano',
+               'holder_identifier': '234234234',
+               'theme': '{ECON,ENVI}',
+               'language': '{DEU,ENG,ITA}',
+               }
+        dataset = helpers.call_action('package_create', context=ctx, **pkg)
+
+        def show(action, **kwargs):
+            with mock.patch.object(ItalianDCATAPProfile, 'graph_from_dataset', autospec=True,
+                                   side_effect=ItalianDCATAPProfile.graph_from_dataset) as gfd:
+                output = helpers.call_action(action, format='nt', **kwargs)
+            calls = [c for c in gfd.call_args_list if c[0][1]['id'] == dataset['id']]
+            return output, len(calls)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(rdf_cache, 'RDF_CACHE_DIR', cache_dir):
+                output, calls = show('dcat_catalog_show')
+                eq_(calls, 1)
+                assert_true(rdf_cache.get_fragment(dataset))
+
+                cached_output, calls = show('dcat_catalog_show')
+                eq_(calls, 0)
+                eq_(len(Graph().parse(data=cached_output, format='nt')),
+                    len(Graph().parse(data=output, format='nt')))
+
+                output, calls = show('dcat_dataset_show', id=dataset['id'])
+                eq_(calls, 0)
+
+                helpers.call_action('package_patch', context=ctx,
+                                    id=dataset['id'], title='Dataset aggiornato')
+                eq_(rdf_cache.get_fragment(dataset), None)
+                output, calls = show('dcat_dataset_show', id=dataset['id'])
+                eq_(calls, 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @helpers.change_config('ckanext.dcat.datasets_per_page', '2')
+    def test_catalog_stream(self):
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        for idx in range(3):
+            pkg = {'name': 'test-stream-{}'.format(idx),
+                   'title': 'Dataset di test {}'.format(idx),
+                   'notes': 'dcatapit dataset di test',
+                   'identifier': 'ISBNstream{}'.format(idx),
+                   'frequency': 'UPDATE_CONT',
+                   'publisher_name': 'bolzano',
+                   'publisher_identifier': '234234234',
+                   'holder_name': 'bolzano',
+                   'holder_identifier': '234234234',
+                   'theme': '{ECON,ENVI}',
+                   'language': '{DEU,ENG,ITA}',
+                   }
+            helpers.call_action('package_create', context=ctx, **pkg)
+
+        # pages are searched only when the previous one was consumed
+        search = mock.Mock(wraps=dcat_logic._search_datasets)
+        with mock.patch.object(dcat_logic, '_search_datasets', search):
+            datasets = dcat_logic.iter_catalog_datasets({'ignore_auth': True},
+                                                        {'q': 'name:test-stream-*'})
+            eq_(search.call_count, 1)
+            first_page = [next(datasets), next(datasets)]
+            eq_(search.call_count, 1)
+            # datasets modified while reading are neither skipped nor repeated
+            helpers.call_action('package_patch', context=ctx,
+                                id=first_page[0]['id'], title='Modified')
+            rest = list(datasets)
+            eq_(search.call_count, 2)
+        names = [d['name'] for d in first_page + rest]
+        eq_(sorted(names), ['test-stream-{}'.format(idx) for idx in range(3)])
+
+        app = helpers._get_test_app()
+        res = app.get('/catalog/stream.ttl', params={'q': 'name:test-stream-*'})
+        assert_true(res.headers['Content-Type'].startswith('text/turtle'))
+        g = Graph()
+        g.parse(data=res.body, format='turtle')
+        eq_(len(list(g.subjects(RDF.type, DCAT.Dataset))), 3)
+        eq_(len(list(g.subjects(RDF.type, DCAT.Catalog))), 1)
+
+    def test_fragments_cache_profiles(self):
+        ctx = {'ignore_auth': True,
+               'user': self._get_user()['name']}
+
+        pkg = {'name': 'test-fragments-profiles',
+               'title': 'Dataset di test',
+               'notes': 'dcatapit dataset di test',
+               'identifier': 'ISBNfragmentsprofiles',
+               'frequency': 'UPDATE_CONT',
+               'publisher_name': 'bolzano',
+               'publisher_identifier': '234234234',
+               'holder_name': 'bolzano',
+               'holder_identifier': '234234234',
+               'theme': '{ECON,ENVI}',
+               'language': '{DEU,ENG,ITA}',
+               }
+        dataset = helpers.call_action('package_create', context=ctx, **pkg)
+        dataset_ref = URIRef(utils.dataset_uri(dataset))
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(rdf_cache, 'RDF_CACHE_DIR', cache_dir):
+                # fragment without DCAT-AP_IT triples is not used by default serializer
+                s = DCATAPITRDFSerializer(profiles=['euro_dcat_ap'])
+                s.graph_from_dataset(dataset)
+                eq_(self._triple(s.g, dataset_ref, RDF.type, DCATAPIT.Dataset), None)
+
+                s = DCATAPITRDFSerializer()
+                s.graph_from_dataset(dataset)
+                assert_true(self._triple(s.g, dataset_ref, RDF.type, DCATAPIT.Dataset))
+
+                helpers.call_action('package_delete', context=ctx, id=dataset['id'])
+                assert_true(not os.path.exists(os.path.join(cache_dir, dataset['id'])))
+        finally:
+            shutil.rmtree(cache_dir)
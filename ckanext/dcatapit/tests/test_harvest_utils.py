@@ -1,9 +1,12 @@
 
 import nose
 import ckanext.dcatapit.harvesters.utils as utils
+from ckanext.dcatapit.harvesters.csw_harvester import DCATAPITCSWConfig, DCATAPITCSWHarvester
+from ckanext.dcatapit.tests.utils import load_themes
 
 eq_ = nose.tools.eq_
 ok_ = nose.tools.ok_
+assert_raises = nose.tools.assert_raises
 
 csw_harvester_config = {
     "dataset_themes":"OP_DATPRO",
@@ -83,3 +86,62 @@ def test_get_responsible_party():
     eq_(name, 'Comune di Bolzano  - Ufficio Sistema Informativo Territoriale')
     eq_(code, 'c_a952')
 
+
+def test_csw_harvester_config():
+    job_config = DCATAPITCSWConfig({'dcatapit_config': csw_harvester_config},
+                                   DCATAPITCSWHarvester._dcatapit_config)
+
+    eq_(job_config.places_vocab_id, 'theme.places-skos')
+    eq_(job_config.dataset_places, 'ITA_BZO')
+    eq_(job_config.frequency_map, utils._mapping_frequencies_to_mdr_vocabulary)
+    ok_(hasattr(job_config.agents['owner']['code_regex']['regex'], 'search'))
+    # raw config is not changed
+    ok_(isinstance(csw_harvester_config['agents']['owner']['code_regex']['regex'], basestring))
+
+    name, code = utils.get_responsible_party(responsiblePartys, job_config.agents['owner'])
+    eq_(name, 'Comune di Bolzano  - Ufficio Sistema Informativo Territoriale')
+    eq_(code, 'c_a952')
+
+    # defaults
+    job_config = DCATAPITCSWConfig({}, DCATAPITCSWHarvester._dcatapit_config)
+    eq_(job_config.theme_vocab_id, 'theme.data-theme-skos')
+    eq_(job_config.agents['publisher']['code'], 'temp_ipa')
+
+    invalid = {'dcatapit_config': {'agents': {'owner': {'code_regex': {'regex': '(unclosed'}}}}}
+    assert_raises(ValueError, DCATAPITCSWConfig, invalid, DCATAPITCSWHarvester._dcatapit_config)
+    assert_raises(ValueError, DCATAPITCSWConfig, {'default_values': 'ITA'},
+                  DCATAPITCSWHarvester._dcatapit_config)
+
+
+def test_csw_harvester_config_named_group():
+    agent = {'role': 'publisher',
+             'code_regex': {'regex': '\\(IPa: (?P<code>[^)]+)\\)',
+                            'groups': 'code'}}
+    job_config = DCATAPITCSWConfig({'dcatapit_config': {'agents': {'publisher': agent}}},
+                                   DCATAPITCSWHarvester._dcatapit_config)
+    eq_(job_config.agents['publisher']['code_regex']['groups'], 'code')
+
+    name, code = utils.get_responsible_party(responsiblePartys, job_config.agents['publisher'])
+    eq_(code, 'p_bz')
+
+    invalid = {'dcatapit_config': {'agents': {'owner': {'code_regex': {'groups': {}}}}}}
+    assert_raises(ValueError, DCATAPITCSWConfig, invalid, DCATAPITCSWHarvester._dcatapit_config)
+
+
+def test_get_controlled_vocabulary_values():
+    load_themes()
+
+    label_map = utils.get_vocabulary_label_map('eu_themes')
+    eq_(label_map.get(utils.normalize_label(u'Agricoltura, pesca, silvicoltura e prodotti alimentari')), 'AGRI')
+
+    keywords = [{'thesaurus-identifier': 'theme.data-theme-skos',
+                 'thesaurus-title': 'Data theme',
+                 'keyword': [u'  AGRICOLTURA,  pesca, silvicoltura e prodotti alimentari ', u'not a theme']},
+                {'thesaurus-identifier': 'other-thesaurus',
+                 'thesaurus-title': 'Other',
+                 'keyword': [u'Ambiente']}]
+
+    eq_(utils.get_controlled_vocabulary_values('eu_themes', 'theme.data-theme-skos', keywords, label_map), ['AGRI'])
+    # label map is loaded if not passed
+    eq_(utils.get_controlled_vocabulary_values('eu_themes', 'theme.data-theme-skos', keywords), ['AGRI'])
+    eq_(utils.get_controlled_vocabulary_values('eu_themes', None, keywords, label_map), [])
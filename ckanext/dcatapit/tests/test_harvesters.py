@@ -1,8 +1,13 @@
 import os
 import json
+import datetime
 
 import unittest
 import nose
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from ckan.model import Session, Package
 from ckan import model
@@ -14,13 +19,21 @@ try:
 except ImportError:
     from ckan.new_tests import helpers
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra, HarvestJob
 from ckanext.dcatapit.model.license import (load_from_graph, 
     License, LocalizedLicenseName, _get_graph, SKOS)
 
 from ckanext.dcatapit.harvesters.ckanharvester import CKANMappingHarvester
 from ckanext.dcatapit.model.license import load_from_graph, License
 from ckanext.dcat.harvesters.rdf import DCATRDFHarvester
+from ckanext.dcat.processors import RDFParser
+from ckanext.dcatapit import interfaces
+from ckanext.dcatapit.dcat import harvester as dcat_harvester
+from ckanext.dcatapit.dcat.harvester import (CONTENT_HASH_KEY, INDEX_PENDING_KEY,
+                                             DCATAPITRDFHarvester,
+                                             reindex_pending_datasets)
+from ckanext.dcatapit.dcat.profiles import LOCALISED_DICT_NAME_BASE
+from ckanext.dcatapit.dcat.processors import StreamingRDFParser
 
 
 class HarvestersTestCase(unittest.TestCase):
@@ -244,7 +257,198 @@ class HarvestersTestCase(unittest.TestCase):
         self.assertEqual(pkg_dict['title'], dataset2['title'])
         self.assertEqual(pkg_dict['name'], 'duplicated-title1')
 
+    def test_dcat_harvester_skip_unchanged(self):
+        guid = 'http://mock/source/unchanged/dataset'
+        dataset = {'title': 'unchanged title',
+                   'name': 'unchanged-title',
+                   'holder_name': 'test holder',
+                   'holder_identifier': 'abcdef',
+                   'notes': 'some notes',
+                   'modified': '2000-01-01',
+                   'theme': 'AGRI',
+                   'frequency': 'UNKNOWN',
+                   'publisher_name': 'publisher',
+                   'identifier': 'unchanged',
+                   'publisher_identifier': 'publisher',
+                   'resources': [],
+                   'extras': [{'key': 'guid', 'value': guid}],
+                   }
+
+        def harvest(name, content):
+            harvest_dict = self._create_harvest_obj('http://mock/source/{}'.format(name), name=name)
+            harvest_obj = HarvestObject.get(harvest_dict['id'])
+            harvest_obj.guid = guid
+            harvest_obj.content = json.dumps(content)
+            out = DCATRDFHarvester().import_stage(harvest_obj)
+            # as harvest fetch consumer does
+            harvest_obj.state = 'COMPLETE'
+            harvest_obj.import_finished = datetime.datetime.utcnow()
+            harvest_obj.save()
+            return harvest_obj, out
+
+        first, out = harvest('unchanged1', dataset)
+        self.assertTrue(out, first.errors)
+        hashes = [e.value for e in first.extras if e.key == CONTENT_HASH_KEY]
+        self.assertEqual(len(hashes), 1)
+
+        second, out = harvest('unchanged2', dataset)
+        self.assertEqual(out, 'unchanged')
+        self.assertEqual(second.package_id, first.package_id)
+        self.assertEqual([e.value for e in second.extras if e.key == CONTENT_HASH_KEY], hashes)
+
+        dataset['notes'] = 'changed notes'
+        third, out = harvest('unchanged3', dataset)
+        self.assertTrue(out is True, third.errors)
+        pkg = helpers.call_action('package_show', context={}, name_or_id=first.package_id)
+        self.assertEqual(pkg['notes'], 'changed notes')
+
+
+    def test_dcat_harvester_index_buffer(self):
+        with mock.patch.object(interfaces, '_reindex_solr_packages') as reindex, \
+                mock.patch.object(interfaces.search, 'PackageSearchIndex') as psi:
+            index_buffer = interfaces.SolrIndexBuffer(size=2)
+            index_buffer.add({'id': 'pkg1', 'owner_org': 'org'})
+            self.assertEqual(reindex.call_count, 0)
+            index_buffer.add({'id': 'pkg2', 'owner_org': 'org'})
+            self.assertEqual(reindex.call_count, 1)
+            self.assertEqual(reindex.call_args[0][1], {'pkg1': 'org', 'pkg2': 'org'})
+            self.assertEqual(psi.return_value.commit.call_count, 1)
+            self.assertEqual(len(index_buffer), 0)
+
+            # buffered datasets are committed even if reindexing fails
+            reindex.side_effect = ValueError('solr error')
+            index_buffer.add({'id': 'pkg3', 'owner_org': 'org'})
+            self.assertRaises(ValueError, index_buffer.flush)
+            self.assertEqual(psi.return_value.commit.call_count, 2)
+
+    def test_dcat_harvester_reindex_last_object_failed(self):
+        ctx = {'session': Session,
+               'model': model}
+        source = self._create_harvest_source(ctx, 'http://mock/source/reindex',
+                                             name='reindex', source_type='dcatapit_rdf')
+        job_id = self._create_harvest_job(ctx, source['id'])['id']
+        objs = [HarvestObject.get(helpers.call_action('harvest_object_create', context=ctx,
+                                                      job_id=job_id, source_id=source['id'])['id'])
+                for idx in range(2)]
+
+        dataset = {'title': 'reindexed title',
+                   'name': 'reindexed-title',
+                   'holder_name': 'test holder',
+                   'holder_identifier': 'abcdef',
+                   'notes': 'some notes',
+                   'modified': '2000-01-01',
+                   'theme': 'AGRI',
+                   'frequency': 'UNKNOWN',
+                   'publisher_name': 'publisher',
+                   'identifier': 'reindexed',
+                   'publisher_identifier': 'publisher',
+                   'resources': [],
+                   'extras': [{'key': 'guid', 'value': 'http://mock/source/reindex/dataset'}],
+                   LOCALISED_DICT_NAME_BASE: {'title': {'it': 'Titolo', 'en': 'Title'}},
+                   }
+        objs[0].guid = 'http://mock/source/reindex/dataset'
+        objs[0].content = json.dumps(dataset)
+        objs[1].guid = 'http://mock/source/reindex/broken'
+        objs[1].content = 'not json'
+        for obj in objs:
+            obj.state = 'WAITING'
+            obj.save()
+
+        harvester = DCATAPITRDFHarvester()
+        with mock.patch.object(interfaces, '_reindex_solr_packages') as reindex, \
+                mock.patch.object(interfaces.search, 'PackageSearchIndex'):
+            # as harvest fetch consumer does
+            objs[0].state = 'IMPORT'
+            self.assertTrue(harvester.import_stage(objs[0]), objs[0].errors)
+            objs[0].state = 'COMPLETE'
+            objs[0].save()
+            # other object is waiting, dataset is marked for reindexing
+            self.assertEqual(reindex.call_count, 0)
+            self.assertEqual([e.key for e in objs[0].extras if e.key == INDEX_PENDING_KEY],
+                             [INDEX_PENDING_KEY])
+
+            # last object fails before harvester plugin hooks are called
+            objs[1].state = 'IMPORT'
+            self.assertFalse(harvester.import_stage(objs[1]))
+            self.assertEqual(reindex.call_count, 1)
+            self.assertEqual(reindex.call_args[0][1].keys(), [objs[0].package_id])
+
+        self.assertEqual(Session.query(HarvestObjectExtra)
+                                .filter(HarvestObjectExtra.key == INDEX_PENDING_KEY).count(), 0)
+
+    def test_dcat_harvester_reindex_lookup(self):
+        obj = mock.Mock(harvest_job_id='reindex-lookup-job', harvest_source_id='source')
+        with mock.patch.object(dcat_harvester, 'HARVEST_INDEX_BATCH_SIZE', 2), \
+                mock.patch.object(dcat_harvester, '_is_job_finished', return_value=False) as finished, \
+                mock.patch.object(dcat_harvester, '_get_index_pending', return_value=[]) as pending:
+            # marks are looked up once per batch of imported objects
+            reindex_pending_datasets(obj)
+            self.assertEqual(pending.call_count, 0)
+            reindex_pending_datasets(obj)
+            self.assertEqual(pending.call_count, 1)
+            reindex_pending_datasets(obj)
+            self.assertEqual(pending.call_count, 1)
+
+            # and when the job is finished
+            finished.return_value = True
+            reindex_pending_datasets(obj)
+            self.assertEqual(pending.call_count, 2)
+
+    def test_dcatapit_rdf_harvester_gather(self):
+        path = os.path.join(os.path.dirname(__file__),
+                            '..', '..', '..', 'examples', 'catalog_dati_unibo.rdf')
+        with open(path, 'rb') as f:
+            contents = f.read()
 
+        ctx = {'session': Session,
+               'model': model}
+        source = self._create_harvest_source(ctx, 'http://mock/source/streaming',
+                                             name='streaming', source_type='dcatapit_rdf')
+        job = HarvestJob.get(self._create_harvest_job(ctx, source['id'])['id'])
+
+        response = mock.Mock(headers={'content-type': 'application/rdf+xml; charset=utf-8'})
+        # content is downloaded in chunks
+        response.iter_content.return_value = [contents[i:i + 1024]
+                                              for i in range(0, len(contents), 1024)]
+        harvester = DCATAPITRDFHarvester()
+        with mock.patch('ckanext.dcatapit.dcat.harvester.requests.Session') as session, \
+                mock.patch('ckanext.dcatapit.dcat.harvester.StreamingRDFParser',
+                           wraps=StreamingRDFParser) as parser_class:
+            session.return_value.get.return_value = response
+            object_ids = harvester.gather_stage(job)
+
+        self.assertEqual(session.return_value.get.call_args[1], {'stream': True})
+        self.assertEqual(parser_class.call_count, 1)
+        parser = RDFParser()
+        parser.parse(contents.decode('utf-8'), _format='xml')
+        expected = [d['title'] for d in parser.datasets()]
+        harvested = [json.loads(HarvestObject.get(obj_id).content)['title'] for obj_id in object_ids]
+        self.assertEqual(sorted(harvested), sorted(expected))
+
+    def test_multilang_bulk_upsert(self):
+        pkg = Package(name='multilang-bulk', title='Multilang bulk', type='dataset', state='active')
+        Session.add(pkg)
+        Session.flush()
+        res = model.Resource(package_id=pkg.id, url='http://mock/resource', name='Resource')
+        Session.add(res)
+        Session.commit()
+        pkg_id, res_id = pkg.id, res.id
+
+        interfaces.upsert_package_multilang_bulk(pkg_id, {'title': {'it': 'Titolo', 'en': 'Title'},
+                                                          'notes': {'it': 'Note', 'en': ''}})
+        interfaces.upsert_resources_multilang_bulk({res_id: {'name': {'it': 'Risorsa', 'de': 'Ressource'}}})
+        self.assertEqual(interfaces.get_for_package(pkg_id),
+                         {'title': {'it': 'Titolo', 'en': 'Title'}, 'notes': {'it': 'Note'}})
+        self.assertEqual(interfaces.get_for_resource(res_id),
+                         {'name': {'it': 'Risorsa', 'de': 'Ressource'}})
+
+        # update, delete and insert, other values are not changed
+        interfaces.upsert_package_multilang_bulk(pkg_id, {'title': {'it': 'Nuovo titolo', 'en': ''},
+                                                          'notes': {'de': 'Notizen'}})
+        interfaces.upsert_resources_multilang_bulk({res_id: {'name': {'de': ''}}})
+        self.assertEqual(interfaces.get_for_package(pkg_id),
+                         {'title': {'it': 'Nuovo titolo'}, 'notes': {'it': 'Note', 'de': 'Notizen'}})
+        self.assertEqual(interfaces.get_for_resource(res_id), {'name': {'it': 'Risorsa'}})
 
     def setUp(self):
         def get_path(fname):
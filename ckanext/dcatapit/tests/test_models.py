@@ -3,6 +3,10 @@ import json
 
 import unittest
 import nose
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from rdflib import Graph, RDF
 
@@ -82,6 +86,32 @@ class LicenseTestCase(unittest.TestCase):
         self.assertTrue(from_token)
         self.assertTrue('odbl' in from_token.default_name.lower())
 
+    def test_tokens_index(self):
+
+        load_from_graph(path=self.licenses)
+        Session.flush()
+        self.assertIsNone(License._tokens_index)
+
+        from_token, default = License.find_by_token('cc-by-sa')
+        self.assertFalse(default)
+        index = License.get_tokens_index()
+        self.assertTrue(index is License.get_tokens_index())
+
+        # index should keep the newest version for token
+        tokens = License.get_as_tokens()
+        for token in ('ccbysa', 'by-sa',):
+            if token in tokens:
+                newest = sorted(tokens[token], key=lambda t: t.version)[-1]
+                self.assertEqual(index[token], newest.id)
+
+        # reload should invalidate index
+        load_from_graph(path=self.licenses)
+        Session.flush()
+        self.assertIsNone(License._tokens_index)
+        from_token_reloaded, default = License.find_by_token('cc-by-sa')
+        self.assertFalse(default)
+        self.assertEqual(from_token_reloaded.uri, from_token.uri)
+
     def tearDown(self):
         Session.rollback()
 
@@ -121,5 +151,50 @@ class SubthemeTestCase(unittest.TestCase):
             q = Subtheme.for_theme(theme_name)
             self.assertTrue(q.count() >= len(list(theme_len)))
 
+    def test_theme_map(self):
+        clear_subthemes()
+        self.assertIsNone(Subtheme._theme_map)
+        load_subthemes(self.map_f, self.voc_f)
+        self.assertIsNone(Subtheme._theme_map)
+
+        theme_map = Subtheme.get_theme_map()
+        self.assertTrue(theme_map is Subtheme.get_theme_map())
+        self.assertTrue(theme_map)
+        for theme_name in Subtheme.get_theme_names():
+            from_db = [s.uri for s in Subtheme.for_theme(theme_name)]
+            self.assertEqual(list(theme_map[theme_name]), from_db)
+            self.assertEqual(Subtheme.for_theme_values(theme_name), from_db)
+
+        with self.assertRaises(ValueError):
+            Subtheme.for_theme_values('not-a-theme')
+
+        # vocabularies loaded by another process
+        with mock.patch('ckanext.dcatapit.model.subtheme.get_vocabularies_version',
+                        return_value='other-version'):
+            reloaded = Subtheme.get_theme_map()
+            self.assertFalse(reloaded is theme_map)
+            self.assertEqual(reloaded, theme_map)
+            self.assertTrue(reloaded is Subtheme.get_theme_map())
+
+        clear_subthemes()
+        self.assertIsNone(Subtheme._theme_map)
+        self.assertFalse(any(Subtheme.get_theme_map().values()))
+
+    def test_theme_tree(self):
+        clear_subthemes()
+        load_subthemes(self.map_f, self.voc_f)
+        self.assertEqual(Subtheme._theme_trees, {})
+
+        tree = Subtheme.get_theme_tree('it')
+        self.assertTrue(tree is Subtheme.get_theme_tree('it'))
+        self.assertTrue(tree)
+        for theme_name in set(Subtheme.get_theme_names()):
+            from_db = [(s.uri, s.depth, label,) for s, label in Subtheme.for_theme(theme_name, 'it')]
+            self.assertEqual(list(tree[theme_name]), from_db)
+
+        clear_subthemes()
+        self.assertEqual(Subtheme._theme_trees, {})
+        self.assertEqual(Subtheme.get_theme_tree('it'), {})
+
     def tearDown(self):
         Session.rollback()
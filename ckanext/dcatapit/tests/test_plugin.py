@@ -1,6 +1,12 @@
 
 import nose
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 import ckanext.dcatapit.plugin as plugin
+import ckanext.dcatapit.schema as dcatapit_schema
 
 eq_ = nose.tools.eq_
 ok_ = nose.tools.ok_
@@ -113,3 +119,68 @@ def test_package_after_show():
     eq_(out['modified'], '01-02-2013')
 
 
+def test_package_org_index_cache():
+    org_show = mock.Mock(return_value={'id': 'org1',
+                                       'title': 'Org 1',
+                                       'identifier': 'org1id',
+                                       'region': '{ITA_BZO,ITA_TN}'})
+    labels = mock.Mock(side_effect=lambda name: {'it': name.lower(), 'en': name})
+    package_plugin.reset_org_index_cache()
+    with mock.patch.object(plugin.plugins.toolkit, 'get_action', return_value=org_show), \
+            mock.patch.object(plugin.interfaces, 'get_all_localized_tag_labels', labels), \
+            mock.patch.object(plugin, 'get_vocabularies_version', return_value='v1'):
+        org = package_plugin._get_org_for_index('org1', 'rev1')
+        eq_(org['title'], 'Org 1')
+        eq_(org['identifier'], 'org1id')
+        eq_(org['regions'], {'it': ['ita_bzo', 'ita_tn'], 'en': ['ITA_BZO', 'ITA_TN']})
+
+        eq_(package_plugin._get_org_for_index('org1', 'rev1'), org)
+        eq_(org_show.call_count, 1)
+        eq_(labels.call_count, 2)
+
+        # new organization revision
+        package_plugin._get_org_for_index('org1', 'rev2')
+        eq_(org_show.call_count, 2)
+    package_plugin.reset_org_index_cache()
+
+
+def test_package_after_search_batched():
+    results = [{'id': 'pkg{}'.format(idx),
+                'type': 'dataset',
+                'owner_org': 'org1',
+                'holder_name': 'holder',
+                'holder_identifier': 'holderid'} for idx in range(3)]
+    org_show = mock.Mock(return_value={'id': 'org1',
+                                       'title': 'Org 1',
+                                       'identifier': 'org1id'})
+    harvested = mock.Mock(return_value=set(['pkg1']))
+    with mock.patch.object(plugin.toolkit, 'get_action', return_value=org_show), \
+            mock.patch.object(plugin.helpers, 'harvested_datasets', harvested), \
+            mock.patch.object(plugin.helpers, 'dataset_is_local') as is_local:
+        out = package_plugin.after_search({'results': results}, {})
+
+    eq_(harvested.call_count, 1)
+    eq_(is_local.call_count, 0)
+    eq_(org_show.call_count, 1)
+    eq_([r['dataset_is_local'] for r in out['results']], [True, False, True])
+    # local datasets use organization as rights holder
+    eq_(out['results'][0]['holder_name'], 'Org 1')
+    eq_(out['results'][1]['holder_name'], 'holder')
+
+
+def test_compiled_package_schema():
+    dcatapit_schema.reset_compiled_package_schemas()
+    compiled = dcatapit_schema.get_compiled_package_schema('it')
+    ok_(compiled is dcatapit_schema.get_compiled_package_schema('it'))
+
+    ok_('publisher_name' in compiled.localized)
+    ok_('holder_name' in compiled.localized)
+    ok_('holder_identifier' not in compiled.localized)
+    eq_(compiled.couple_parent['holder_name'], 'rights_holder')
+    eq_(compiled.date_formats['issued'], '%d-%m-%Y')
+    ok_('theme' in compiled.promotable)
+
+    leaf_names = [f['name'] for f in compiled.leaf_fields]
+    ok_('publisher_identifier' in leaf_names)
+    ok_('publisher' not in leaf_names)
+    ok_('creator' in leaf_names)
@@ -424,7 +424,7 @@ def dcatapit_subthemes(value, context):
         theme_name = item['theme']
         subthemes = item.get('subthemes') or []
         try:
-            slist = [s.uri for s in Subtheme.for_theme(theme_name)]
+            slist = Subtheme.for_theme_values(theme_name)
         except ValueError:
             raise Invalid(_("Invalid theme {}".format(theme_name)))
          
@@ -83,6 +83,7 @@ setup(
         dcatapit_org=ckanext.dcatapit.plugin:DCATAPITOrganizationPlugin        
         dcatapit_config=ckanext.dcatapit.plugin:DCATAPITConfigurerPlugin
         dcatapit_harvester=ckanext.dcatapit.dcat.harvester:DCATAPITHarvesterPlugin
+        dcatapit_rdf_harvester=ckanext.dcatapit.dcat.harvester:DCATAPITRDFHarvester
         dcatapit_csw_harvester=ckanext.dcatapit.harvesters.csw_harvester:DCATAPITCSWHarvester
         dcatapit_ckan_harvester=ckanext.dcatapit.harvesters.ckanharvester:CKANMappingHarvester
         dcatapit_theme_group_mapper=ckanext.dcatapit.plugin:DCATAPITGroupMapper